@@ -1,14 +1,17 @@
 # agent.py
 import time
 import json
+import random
 import os
 import threading
+import queue
 from multiprocessing import Queue
-from thread_client import send_to_peer
-from thread_server import start_peer_server
+from thread_client import send_to_peer, fan_out
+from thread_server import start_peer_server, sync_scheduler, history_key, merge_history, HISTORY_CHUNKED
 import socket
 from datetime import datetime
 from data_manager import DataManager, Message
+import protocol
 import requests
 import logging
 
@@ -22,8 +25,184 @@ logging.basicConfig(
 
 TRACKER_IP = "127.0.0.1"
 TRACKER_PORT = 12345
+# Primary trước, sau đó là các standby (tracker.py --standby-of), ví dụ thêm (TRACKER_IP, 12346)
+TRACKER_ADDRS = [(TRACKER_IP, TRACKER_PORT)]
+FAILOVER_WAIT = 6  # Thời gian chờ tối đa để standby promote khi primary không còn trả lời
 MY_IP = "127.0.0.1"
 DATA_DIR = "data"
+LIST_PAGE_SIZE = 200  # Số phần tử mỗi trang khi đọc list_channels / get_list
+CHANNEL_PAGE_SIZE = 500  # Số tin nhắn mỗi trang khi tải kênh từ tracker
+AUTO_SYNC_INTERVAL = 60  # Chu kỳ tự động đồng bộ (giây)
+SUBSCRIBED_SYNC_INTERVAL = 600  # Chu kỳ đồng bộ dự phòng khi đang nhận sự kiện đẩy từ tracker
+SUBSCRIBE_MAX_BACKOFF = 60  # Thời gian chờ tối đa giữa các lần kết nối lại kênh sự kiện
+RETRY_MAX_WAIT = 30  # Tổng thời gian tối đa chờ theo RETRY_AFTER của tracker cho một lệnh
+
+_active_tracker = 0  # Chỉ số trong TRACKER_ADDRS của tracker đang dùng
+
+def tracker_address():
+    return TRACKER_ADDRS[_active_tracker % len(TRACKER_ADDRS)]
+
+def _with_failover(call):
+    """Gọi call(addr) trên tracker đang dùng; khi không kết nối được hoặc gặp standby thì thử địa chỉ kế tiếp.
+
+    Nếu chỉ còn standby chưa promote trả lời, chờ một lúc (tối đa FAILOVER_WAIT giây) cho nó promote.
+    """
+    global _active_tracker
+    deadline = time.time() + FAILOVER_WAIT
+    while True:
+        last_error = None
+        standby_seen = False
+        for attempt in range(len(TRACKER_ADDRS)):
+            index = (_active_tracker + attempt) % len(TRACKER_ADDRS)
+            try:
+                result = call(TRACKER_ADDRS[index])
+            except (OSError, protocol.ProtocolError) as e:
+                last_error = e
+                standby_seen = standby_seen or "STANDBY" in str(e)
+                continue
+            if isinstance(result, str) and result.startswith("ERROR: STANDBY"):
+                last_error = ConnectionRefusedError(result.strip())
+                standby_seen = True
+                continue
+            if index != _active_tracker:
+                logging.warning(f"[Agent] Switched to tracker {TRACKER_ADDRS[index][0]}:{TRACKER_ADDRS[index][1]}")
+                _active_tracker = index
+            return result
+        if not standby_seen or time.time() >= deadline:
+            raise last_error
+        time.sleep(0.5)
+
+_sessions = {}  # (ip, port) -> protocol.Session, một kết nối giữ lâu cho mỗi tracker
+_sessions_lock = threading.Lock()
+
+def _session_request(addr, command, timeout, max_wait=None):
+    """Gửi lệnh tới addr; khi tracker trả lời RETRY_AFTER (vượt giới hạn tần suất) thì chờ rồi gửi lại.
+
+    Thời gian chờ được cộng thêm một phần ngẫu nhiên để các agent bị giới hạn cùng lúc không gửi
+    lại đồng loạt. Quá max_wait giây (mặc định RETRY_MAX_WAIT) thì trả về nguyên phản hồi
+    RETRY_AFTER cho nơi gọi.
+    """
+    if max_wait is None:
+        max_wait = RETRY_MAX_WAIT
+    waited = 0
+    while True:
+        response = _send_once(addr, command, timeout)
+        if not (isinstance(response, str) and response.startswith("RETRY_AFTER")):
+            return response
+        try:
+            delay = float(response.split()[1])
+        except (IndexError, ValueError):
+            delay = 1
+        delay *= random.uniform(1, 1.5)
+        if waited + delay > max_wait:
+            logging.warning(f"[Agent] Tracker still rate limiting after {waited:.1f}s: {command.split(None, 1)[0]}")
+            return response
+        time.sleep(delay)
+        waited += delay
+
+def _send_once(addr, command, timeout):
+    """Gửi lệnh qua session pipelining tới addr; tracker cũ không hỗ trợ thì mỗi lệnh một kết nối"""
+    with _sessions_lock:
+        session = _sessions.get(addr)
+        if session is None:
+            session = _sessions[addr] = protocol.Session(addr)
+    for attempt in range(2):
+        if not session.supported:
+            break
+        try:
+            return session.request(command, timeout=timeout)
+        except ConnectionResetError:
+            # Kết nối cũ đã bị tracker đóng (ví dụ tracker khởi động lại): mở lại một lần
+            if attempt:
+                raise
+    return protocol.request(addr, command, timeout=timeout)
+
+def tracker_request(command, timeout=10, max_wait=None):
+    """Gửi một lệnh tới tracker (qua session dùng chung của agent) và trả về phản hồi dạng str"""
+    return _with_failover(lambda addr: _session_request(addr, command, timeout, max_wait))
+
+def tracker_list(command, timeout=10):
+    """Đọc toàn bộ kết quả của một lệnh phân trang (list_channels, get_list) theo từng trang"""
+    return _with_failover(lambda addr: list(protocol.request_pages(addr, command, limit=LIST_PAGE_SIZE,
+                                                                   timeout=timeout, send=_session_request)))
+
+class TrackerSubscription:
+    """Kết nối giữ lâu tới tracker để nhận sự kiện kênh (lệnh subscribe) thay cho việc hỏi định kỳ.
+
+    Sự kiện được đưa vào hàng đợi events và xử lý trên thread chính của agent. Khi kết nối
+    lại, cursor của từng kênh được gửi kèm nên tracker gửi bù những gì đã bỏ lỡ.
+    """
+    def __init__(self, agent, events):
+        self.agent = agent
+        self.events = events
+        self.connected = False
+        self._sock = None
+        self._channels = None
+        self._send_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name="tracker-subscription", daemon=True).start()
+
+    def _subscription(self):
+        """Tập kênh của người dùng và lệnh subscribe tương ứng (kèm tracker_cursor của từng kênh)"""
+        names = set(self.agent.data_manager.get_user_channels(self.agent.username)) if self.agent.username else set()
+        args = []
+        for name in sorted(names):
+            channel = self.agent.data_manager.get_channel(name)
+            args.append(f"{name}={getattr(channel, 'tracker_cursor', 0)}")
+        return names, " ".join([f"subscribe {self.agent.username or 'visitor'}"] + args)
+
+    def resubscribe(self):
+        """Gửi lại danh sách kênh nếu nó đã đổi (đăng nhập, tạo hoặc tham gia kênh)"""
+        names, command = self._subscription()
+        with self._send_lock:
+            if self._sock is None or names == self._channels:
+                return
+            self._channels = names
+            try:
+                protocol.send_frame(self._sock, command)
+            except OSError as e:
+                logging.warning(f"[Agent] Cannot update tracker subscription: {e}")
+
+    def _run(self):
+        delay = 1
+        while True:
+            sock = None
+            try:
+                sock = socket.create_connection(tracker_address(), timeout=5)
+                sock.settimeout(None)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                with self._send_lock:
+                    self._channels, command = self._subscription()
+                    protocol.send_frame(sock, command)
+                    self._sock = sock
+                reader = protocol.MessageReader(sock)
+                while True:
+                    payload, _ = reader.read_message()
+                    if payload is None:
+                        break
+                    if payload.startswith(b"OK"):
+                        if not self.connected:
+                            logging.info("[Agent] Subscribed to channel events from tracker")
+                            self.connected = True
+                            delay = 1
+                        continue
+                    if payload.startswith(b"ERROR"):
+                        # Tracker cũ không hỗ trợ subscribe: vẫn dùng đồng bộ định kỳ
+                        logging.warning(f"[Agent] Tracker rejected subscription: {payload.decode(errors='replace').strip()}")
+                        delay = SUBSCRIBE_MAX_BACKOFF
+                        break
+                    self.events.put(json.loads(payload))
+            except (OSError, ValueError, protocol.ProtocolError) as e:
+                logging.warning(f"[Agent] Tracker subscription interrupted: {e}")
+            finally:
+                with self._send_lock:
+                    self._sock = None
+                self.connected = False
+                if sock is not None:
+                    sock.close()
+            time.sleep(delay)
+            delay = min(delay * 2, SUBSCRIBE_MAX_BACKOFF)
 
 class Agent:
     def __init__(self, port, username, status="online"):
@@ -35,6 +214,8 @@ class Agent:
         self._auto_sync = True  # Mặc định bật tự động đồng bộ
         
         self.data_manager = DataManager()
+        # Delta từ lệnh đồng bộ và từ sự kiện subscribe có thể tới cùng lúc cho một kênh
+        self._delta_lock = threading.RLock()
         
         self.is_authenticated = False
         
@@ -48,24 +229,18 @@ class Agent:
 
     def register_to_tracker(self, get_peers=False):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            response = tracker_request(f"send_info {MY_IP} {self.port} {self.username or 'visitor'} {self.status}")
+            if response and response.startswith("RETRY_AFTER"):
+                logging.warning("[Agent] Tracker is rate limiting registration, will retry on the next sync")
+                return []
+            # Danh sách peer được đọc theo từng trang nên không bị cắt khi vượt quá một lần recv
             if get_peers:
-                s.connect((TRACKER_IP, TRACKER_PORT))
-                s.send(f"send_info {MY_IP} {self.port} {self.username or 'visitor'} {self.status} get_peers\n".encode())
-                data = s.recv(4096).decode()
-                s.close()
                 try:
-                    peers = json.loads(data)
-                    return peers
+                    return tracker_list("get_list")
                 except Exception:
                     return []
             else:
-                s.connect((TRACKER_IP, TRACKER_PORT))
-                s.send(f"send_info {MY_IP} {self.port} {self.username or 'visitor'} {self.status}\n".encode())
-                s.recv(1024)
-                s.send(b"get_list\n")
-                data = json.loads(s.recv(4096).decode())
-                s.close()
+                data = tracker_list("get_list")
                 
                 if self.is_authenticated:
                     logging.info("[Agent] First successful connection to tracker, performing full sync")
@@ -157,6 +332,12 @@ class Agent:
                         channels_to_sync.append(channel)
         
         logging.info(f"[Agent] Preparing to sync {len(channels_to_sync)} channels")
+
+        # Trạng thái của mọi host cần hỏi được lấy trong một lệnh thay vì mỗi kênh một lệnh
+        host_statuses = self.check_peer_statuses({
+            channel.host for channel in channels_to_sync
+            if channel.host and channel.host not in (self.username, "unknown", "visitor")
+        })
         
         for channel in channels_to_sync:
             channel_name = channel.name
@@ -185,20 +366,13 @@ class Agent:
                                 "content": msg.content,
                                 "channel": channel_name,
                                 "timestamp": msg.timestamp
-                            } for msg in channel.messages
+                            } for msg in pending_messages
                         ]
                     }
                     
                     try:
-                        sync_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        sync_socket.settimeout(10)
-                        sync_socket.connect((TRACKER_IP, TRACKER_PORT))
-                        
                         json_data = json.dumps(channel_data)
-                        sync_socket.send(f"sync_channel {json_data}\n".encode())
-                        
-                        response = sync_socket.recv(1024).decode().strip()
-                        sync_socket.close()
+                        response = (tracker_request(f"sync_channel {json_data}", timeout=10) or "").strip()
                         
                         if response.startswith("OK"):
                             logging.info(f"[Agent] Successfully synced channel {channel_name} with tracker")
@@ -228,13 +402,10 @@ class Agent:
                                 "timestamp": pending_msg.timestamp
                             }
                             
-                            success_count = 0
-                            for peer in channel_peers:
-                                try:
-                                    send_to_peer(peer["ip"], int(peer["port"]), json.dumps(message_data))
-                                    success_count += 1
-                                except Exception as e:
-                                    logging.error(f"[Agent] Error sending message to peer {peer['username']}: {e}")
+                            results = fan_out(channel_peers, json.dumps(message_data))
+                            success_count = sum(results.values())
+                            if success_count < len(results):
+                                logging.error(f"[Agent] Error sending message to peers {[f'{u}@{ip}:{port}' for (u, ip, port), ok in results.items() if not ok]}")
                             
                             if success_count > 0:
                                 logging.info(f"[Agent] Message sent to {success_count} peers")
@@ -261,204 +432,189 @@ class Agent:
                     logging.error(f"[Agent] Error fetching channel history from tracker: {e}")
                     sync_success = False
             else:
+                # Delta theo cursor từ tracker chỉ chứa phần mới nên rẻ ở mỗi lần sync; chỉ khi tracker
+                # không trả được mới xin host gửi phần sau tin nhắn cuối cùng đã có
                 host_username = channel.host
-                
-                if not host_username or host_username == "unknown" or host_username == "visitor":
-                    logging.info(f"[Agent] Channel {channel_name} has no valid host, fetching from tracker")
-                    try:
-                        updated_channel = self.fetch_channel_from_tracker(channel_name)
-                        if updated_channel:
-                            logging.info(f"[Agent] Successfully fetched channel {channel_name} data from tracker")
-                            channels_synced += 1
-                    except Exception as e:
-                        logging.error(f"[Agent] Error fetching channel from tracker: {e}")
-                        sync_success = False
+                try:
+                    updated_channel = self.fetch_channel_from_tracker(channel_name)
+                except Exception as e:
+                    logging.error(f"[Agent] Error fetching channel from tracker: {e}")
+                    updated_channel = None
+                if updated_channel:
+                    logging.info(f"[Agent] Successfully fetched channel {channel_name} data from tracker")
+                    channels_synced += 1
+                elif host_statuses.get(host_username) == "online" and self.request_history_from_host(channel, host_username):
+                    channels_synced += 1
                 else:
-                    host_status = self.check_peer_status(host_username)
-                    logging.info(f"[Agent] Host {host_username} status for channel {channel_name}: {host_status}")
-                    
-                    if host_status == "online":
-                        logging.info(f"[Agent] Requesting message history from host {host_username}")
-                        
-                        peers = self.register_to_tracker(get_peers=True)
-                        host_peer = None
-                        for peer in peers:
-                            if peer["username"] == host_username:
-                                host_peer = peer
-                                break
-                                
-                        if host_peer:
-                            try:
-                                request_data = {
-                                    "type": "request_history",
-                                    "channel": channel_name,
-                                    "username": self.username
-                                }
-                                
-                                test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                                test_socket.settimeout(2)
-                                
-                                try:
-                                    test_socket.connect((host_peer["ip"], int(host_peer["port"])))
-                                    test_socket.close()
-                                    
-                                    send_to_peer(host_peer["ip"], int(host_peer["port"]), json.dumps(request_data))
-                                    logging.info(f"[Agent] History request sent to host {host_username}")
-                                    channels_synced += 1
-                                except Exception:
-                                    logging.warning(f"[Agent] Host {host_username} is not responsive, falling back to tracker")
-                                    updated_channel = self.fetch_channel_from_tracker(channel_name)
-                                    if updated_channel:
-                                        logging.info(f"[Agent] Successfully fetched channel {channel_name} data from tracker")
-                                        channels_synced += 1
-                            except Exception as e:
-                                logging.error(f"[Agent] Error requesting history from host: {e}")
-                                sync_success = False
-                        else:
-                            logging.warning(f"[Agent] Could not find host {host_username} in peer list, falling back to tracker")
-                            updated_channel = self.fetch_channel_from_tracker(channel_name)
-                            if updated_channel:
-                                logging.info(f"[Agent] Successfully fetched channel {channel_name} data from tracker")
-                                channels_synced += 1
-                    else:
-                        logging.info(f"[Agent] Host {host_username} is offline, fetching from tracker")
-                        try:
-                            updated_channel = self.fetch_channel_from_tracker(channel_name)
-                            if updated_channel:
-                                logging.info(f"[Agent] Successfully fetched channel {channel_name} data from tracker")
-                                channels_synced += 1
-                        except Exception as e:
-                            logging.error(f"[Agent] Error fetching channel from tracker: {e}")
-                            sync_success = False
+                    sync_success = False
         
         self.last_sync = datetime.now()
         
         logging.info(f"[Agent] Sync complete: {channels_synced} channels synchronized, {messages_synced} messages updated")
         return sync_success
         
+    def request_history_from_host(self, channel, host_username):
+        """Xin host gửi các tin nhắn sau tin cuối cùng đã có của kênh; True nếu đã gửi được yêu cầu"""
+        peers = self.register_to_tracker(get_peers=True) or []
+        host_peer = next((peer for peer in peers if peer["username"] == host_username), None)
+        if host_peer is None:
+            logging.warning(f"[Agent] Could not find host {host_username} in peer list")
+            return False
+        last = max(channel.messages, key=history_key, default=None)
+        request_data = {
+            "type": "request_history",
+            "channel": channel.name,
+            "username": self.username,
+            "history": HISTORY_CHUNKED,
+            "after": list(history_key(last)) if last is not None else None
+        }
+        if not send_to_peer(host_peer["ip"], int(host_peer["port"]), json.dumps(request_data)):
+            logging.warning(f"[Agent] Host {host_username} is not responsive")
+            return False
+        logging.info(f"[Agent] History request sent to host {host_username} (after {request_data['after']})")
+        return True
+
     def fetch_channel_from_tracker(self, channel_name):
+        # Tải theo từng trang CHANNEL_PAGE_SIZE tin nhắn để bộ nhớ và độ trễ mỗi lần gọi có giới hạn
+        while True:
+            channel, more = self._fetch_channel_page(channel_name)
+            if channel is None or not more:
+                return channel
+
+    def _fetch_channel_page(self, channel_name):
+        """Lấy một trang delta của kênh từ tracker; trả về (channel hoặc None, còn trang tiếp theo hay không)"""
         try:
             logging.info(f"[Agent] Fetching channel {channel_name} data from tracker")
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(10)
-            s.connect((TRACKER_IP, TRACKER_PORT))
-            s.send(f"get_channel {channel_name}\n".encode())
-            logging.info(f"[Agent] Sent get_channel request to tracker for {channel_name}")
-            
-            buffer = ""
-            while True:
-                try:
-                    chunk = s.recv(4096).decode()
-                    if not chunk:
-                        logging.warning(f"[Agent] Connection closed by tracker while fetching {channel_name}")
-                        break
-                    
-                    buffer += chunk
-                    logging.info(f"[Agent] Received {len(chunk)} bytes chunk for channel {channel_name}")
-                    
-                    if buffer.count('{') == buffer.count('}') and '{' in buffer:
-                        logging.info(f"[Agent] JSON data for {channel_name} appears complete")
-                        break
-                except socket.timeout:
-                    logging.warning(f"[Agent] Timeout receiving data for channel {channel_name}")
-                    break
-            
-            s.close()
+            # Only ask for what changed after the cursor we already hold for this channel
+            local_channel = self.data_manager.get_channel(channel_name)
+            cursor = getattr(local_channel, "tracker_cursor", 0) if local_channel else 0
+            buffer = tracker_request(f"get_channel_since {channel_name} {cursor} limit={CHANNEL_PAGE_SIZE}", timeout=10) or ""
+            if buffer.startswith("ERROR: Unknown command"):
+                # Tracker cũ chưa hỗ trợ delta sync
+                cursor = None
+                buffer = tracker_request(f"get_channel {channel_name}", timeout=10) or ""
+            logging.info(f"[Agent] Received {len(buffer)} bytes for channel {channel_name} (cursor {cursor})")
             
             if not buffer:
                 logging.warning(f"[Agent] No data received for channel {channel_name}")
-                return None
+                return None, False
                 
             if buffer.startswith("ERROR"):
                 logging.error(f"[Agent] Error fetching channel {channel_name}: {buffer}")
-                return None
+                return None, False
             
             try:
                 logging.info(f"[Agent] Parsing JSON data for channel {channel_name}")
                 channel_data = json.loads(buffer)
                 
-                channel = self.data_manager.get_channel(channel_name)
-                if not channel:
-                    logging.info(f"[Agent] Creating new local channel {channel_name}")
-                    self.data_manager.create_channel(channel_name, channel_data["host"])
-                    channel = self.data_manager.get_channel(channel_name)
-                else:
-                    logging.info(f"[Agent] Updating existing local channel {channel_name}")
-                
-                if channel:
-                    if not channel.host and "host" in channel_data and channel_data["host"]:
-                        logging.info(f"[Agent] Updating channel {channel_name} host to {channel_data['host']}")
-                        channel.host = channel_data["host"]
-                        
-                    members_added = 0
-                    for member in channel_data.get("members", []):
-                        if member not in channel.members:
-                            members_added += 1
-                            self.data_manager.join_channel(channel_name, member)
-                    
-                    if members_added > 0:
-                        logging.info(f"[Agent] Added {members_added} new members to channel {channel_name}")
-                    
-                    existing_timestamps = set()
-                    for msg in channel.messages:
-                        existing_timestamps.add(msg.timestamp)
-                    
-                    msg_count = 0
-                    message_list = channel_data.get("messages", [])
-                    logging.info(f"[Agent] Processing {len(message_list)} messages from tracker for channel {channel_name}")
-                    
-                    for msg_data in message_list:
-                        if isinstance(msg_data, dict):
-                            timestamp = msg_data.get("timestamp")
-                            if timestamp is None:
-                                logging.warning(f"[Agent] Warning: Message without timestamp found, skipping")
-                                continue
-                                
-                            if timestamp not in existing_timestamps:
-                                try:
-                                    self.add_message_direct(
-                                        channel_name, 
-                                        msg_data["sender"], 
-                                        msg_data["content"], 
-                                        timestamp,
-                                        status="received"
-                                    )
-                                    msg_count += 1
-                                except KeyError as e:
-                                    logging.error(f"[Agent] Error adding message: Missing field {e}")
-                            else:
-                                logging.info(f"[Agent] Skipping message with timestamp {timestamp} (already exists locally)")
-                    
-                    if msg_count > 0:
-                        logging.info(f"[Agent] Saving channel {channel_name} after adding {msg_count} messages")
-                        self.data_manager.save_channel(channel_name)
-                        
-                        self.data_manager.sort_channel_messages(channel)
-                        logging.info(f"[Agent] Sorted messages in channel {channel_name} after adding new messages from tracker")
-                    
-                    logging.info(f"[Agent] Fetched channel {channel_name} from tracker: {msg_count} new messages added")
-                    if msg_count == 0:
-                        logging.info(f"[Agent] No new messages for channel {channel_name}")
-                    
-                    return channel
-                else:
-                    logging.error(f"[Agent] Failed to create/update channel {channel_name}")
-                    return None
+                channel = self.apply_channel_delta(channel_name, channel_data)
+                if channel is None:
+                    return None, False
+                return channel, bool(channel_data.get("more"))
                     
             except json.JSONDecodeError as e:
                 logging.error(f"[Agent] JSON decode error: {e}")
                 logging.error(f"[Agent] Received data starts with: {buffer[:100]}...")
-                return None
+                return None, False
                 
         except ConnectionRefusedError:
             logging.error(f"[Agent] Connection refused by tracker. Make sure tracker is running.")
-            return None
+            return None, False
         except socket.timeout:
             logging.error(f"[Agent] Connection to tracker timed out")
-            return None
+            return None, False
         except Exception as e:
             logging.error(f"[Agent] Error fetching channel from tracker: {e}")
-            return None
+            return None, False
+
+    def apply_channel_delta(self, channel_name, channel_data):
+        """Áp dụng một delta của kênh (phản hồi get_channel_since/get_channel hoặc sự kiện subscribe) vào dữ liệu cục bộ"""
+        with self._delta_lock:
+            channel = self.data_manager.get_channel(channel_name)
+            if not channel:
+                logging.info(f"[Agent] Creating new local channel {channel_name}")
+                self.data_manager.create_channel(channel_name, channel_data["host"])
+                channel = self.data_manager.get_channel(channel_name)
+            else:
+                logging.info(f"[Agent] Updating existing local channel {channel_name}")
+                
+            if channel:
+                if channel_data.get("reset"):
+                    logging.info(f"[Agent] Tracker history does not match cursor for {channel_name}, resynchronizing")
+                if not channel.host and "host" in channel_data and channel_data["host"]:
+                    logging.info(f"[Agent] Updating channel {channel_name} host to {channel_data['host']}")
+                    channel.host = channel_data["host"]
+                        
+                members_added = 0
+                for member in channel_data.get("members", []):
+                    if member not in channel.members:
+                        members_added += 1
+                        self.data_manager.join_channel(channel_name, member)
+                    
+                if members_added > 0:
+                    logging.info(f"[Agent] Added {members_added} new members to channel {channel_name}")
+                    
+                message_list = channel_data.get("messages", [])
+                logging.info(f"[Agent] Processing {len(message_list)} messages from tracker for channel {channel_name}")
+                # Loại trùng theo (timestamp, sender, content) như tracker, không chỉ theo timestamp:
+                # hai tin khác nhau cùng timestamp đều được giữ vì cursor đã đi qua cả hai
+                incoming = []
+                for msg_data in message_list:
+                    if not isinstance(msg_data, dict):
+                        continue
+                    if msg_data.get("timestamp") is None:
+                        logging.warning(f"[Agent] Warning: Message without timestamp found, skipping")
+                        continue
+                    try:
+                        incoming.append({"sender": msg_data["sender"], "content": msg_data["content"], "channel": channel_name,
+                                         "timestamp": msg_data["timestamp"], "status": "received"})
+                    except KeyError as e:
+                        logging.error(f"[Agent] Error adding message: Missing field {e}")
+                msg_count = 0
+                if incoming:
+                    # Gộp cả lô vào danh sách đã sắp xếp trong một lượt
+                    msg_count = merge_history(channel, incoming, {history_key(msg) for msg in channel.messages})
+
+                new_cursor = channel_data.get("cursor")
+                cursor_moved = new_cursor is not None and new_cursor != channel.tracker_cursor
+                if new_cursor is not None:
+                    channel.tracker_cursor = new_cursor
+                    
+                if msg_count > 0 or cursor_moved:
+                    logging.info(f"[Agent] Saving channel {channel_name} after adding {msg_count} messages (cursor {channel.tracker_cursor})")
+                    self.data_manager.save_channel(channel_name)
+                    
+                logging.info(f"[Agent] Fetched channel {channel_name} from tracker: {msg_count} new messages added")
+                if msg_count == 0:
+                    logging.info(f"[Agent] No new messages for channel {channel_name}")
+                    
+                return channel
+            else:
+                logging.error(f"[Agent] Failed to create/update channel {channel_name}")
+                return None
+
+    def handle_tracker_event(self, event):
+        """Xử lý một sự kiện do tracker đẩy tới qua TrackerSubscription"""
+        channel_name = event.get("name")
+        if not channel_name:
+            return
+        if event.get("type") == "channel_created":
+            if not self.data_manager.get_channel(channel_name):
+                logging.info(f"[Agent] Discovered new channel {channel_name} from tracker event")
+                self.data_manager.add_channel(channel_name, event.get("host", "unknown"))
+            return
+        if event.get("type") != "channel_event":
+            return
+        channel = self.data_manager.get_channel(channel_name)
+        if channel is None:
+            return
+        if event.get("since", 0) > channel.tracker_cursor:
+            # Thiếu các thay đổi trước sự kiện này: tải phần còn thiếu từ cursor hiện tại
+            self.fetch_channel_from_tracker(channel_name)
+            return
+        self.apply_channel_delta(channel_name, event)
+        if event.get("more"):
+            self.fetch_channel_from_tracker(channel_name)
 
     def add_message_direct(self, channel_name, sender, content, timestamp=None, status="pending"):
         try:
@@ -503,25 +659,14 @@ class Agent:
 
     def list_available_channels(self):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((TRACKER_IP, TRACKER_PORT))
-            s.send(b"list_channels\n")
-            data = s.recv(4096).decode()
-            s.close()
-            
-            channels = json.loads(data)
-            return channels
+            return tracker_list("list_channels")
         except Exception as e:
             logging.error(f"[Agent] Error listing channels: {e}")
             return []
 
     def check_peer_status(self, username):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((TRACKER_IP, TRACKER_PORT))
-            s.send(f"check_status {username}\n".encode())
-            response = s.recv(1024).decode()
-            s.close()
+            response = tracker_request(f"check_status {username}", timeout=10) or ""
             
             logging.info(f"[Agent] Tracker response for {username} status: {response}")
             
@@ -534,6 +679,32 @@ class Agent:
             logging.error(f"[Agent] Error checking peer status: {e}")
             return f"Error: {str(e)}"
 
+    def check_peer_statuses(self, usernames):
+        """Trạng thái của nhiều peer trong một lệnh check_status_many; {username: "online" | "offline" | "stale" | None}
+
+        Chỉ "online" được coi là host đang chạy; "stale" là peer lâu không được thấy mà tracker chưa probe xong.
+        """
+        usernames = sorted(usernames)
+        if not usernames:
+            return {}
+        try:
+            response = tracker_request(f"check_status_many {' '.join(usernames)}", timeout=10) or ""
+            if response.startswith("{"):
+                return json.loads(response)
+            if not response.startswith("ERROR: Unknown command"):
+                logging.warning(f"[Agent] Unexpected check_status_many response: {response.strip()}")
+                return {}
+        except Exception as e:
+            logging.error(f"[Agent] Error checking peer statuses: {e}")
+            return {}
+        # Tracker cũ chưa có check_status_many
+        statuses = {}
+        for username in usernames:
+            # check_peer_status trả về "<username> is <trạng thái>"
+            status = self.check_peer_status(username).rsplit(" ", 1)[-1]
+            statuses[username] = status if status in ("online", "offline", "stale") else None
+        return statuses
+
     def handle_command(self, cmd):
         response = {"status": "error", "message": "Unknown command", "username": self.username, "status_value": self.status}
         
@@ -569,12 +740,8 @@ class Agent:
                 logging.info("[Agent] Shutting down...")
 
                 try:
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.settimeout(3)
-                    s.connect((TRACKER_IP, TRACKER_PORT))
                     offline_username = self.username or "visitor"
-                    s.send(f"send_info {MY_IP} {self.port} {offline_username} offline\n".encode())
-                    s.close()
+                    tracker_request(f"send_info {MY_IP} {self.port} {offline_username} offline", timeout=3)
                     logging.info(f"[Agent] Notified tracker: {offline_username} is offline")
                 except Exception as e:
                     logging.error(f"[Agent] Error notifying tracker about offline status: {e}")
@@ -678,7 +845,8 @@ class Agent:
                     join_data = {
                         "type": "join_channel",
                         "channel": channel_name,
-                        "username": self.username or "visitor"
+                        "username": self.username or "visitor",
+                        "history": HISTORY_CHUNKED
                     }
                     
                     notify_count = 0
@@ -693,10 +861,7 @@ class Agent:
                     logging.info(f"[Agent] Notified {notify_count} peers about join")
                     
                     try:
-                        tracker_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        tracker_sock.connect((TRACKER_IP, TRACKER_PORT))
-                        tracker_sock.send((json.dumps(join_data) + "\n").encode())
-                        tracker_sock.close()
+                        tracker_request(json.dumps(join_data), timeout=10)
                         logging.info("[Agent] Notified tracker about joining channel")
                     except Exception as e:
                         logging.error(f"[Agent] Error notifying tracker about join: {e}")
@@ -884,13 +1049,8 @@ class Agent:
                                 "members": [self.username],
                                 "messages": []
                             }
-                            sync_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                            sync_socket.settimeout(10)
-                            sync_socket.connect((TRACKER_IP, TRACKER_PORT))
                             json_data = json.dumps(channel_data)
-                            sync_socket.send(f"sync_channel {json_data}\n".encode())
-                            response = sync_socket.recv(1024).decode().strip()
-                            sync_socket.close()
+                            response = (tracker_request(f"sync_channel {json_data}", timeout=10) or "").strip()
                             if response.startswith("OK"):
                                 logging.info(f"[Agent] Tracker created channel {channel_name} successfully")
                             else:
@@ -905,7 +1065,8 @@ class Agent:
                         create_data = {
                             "type": "join_channel",
                             "channel": channel_name,
-                            "username": self.username
+                            "username": self.username,
+                            "history": HISTORY_CHUNKED
                         }
                         
                         for peer in peers:
@@ -1005,15 +1166,14 @@ class Agent:
                                     if is_online:
                                         peers = self.register_to_tracker(get_peers=True)
                                         
-                                        sent_count = 0
-                                        for peer in peers:
-                                            if peer["username"] != self.username and peer["username"] in channel.get_all_users():
-                                                try:
-                                                    send_to_peer(peer["ip"], int(peer["port"]), json.dumps(message_data))
-                                                    sent_count += 1
-                                                    sent_successfully = True
-                                                except Exception as e:
-                                                    logging.error(f"[Agent] Error sending message to peer {peer['username']}: {e}")
+                                        channel_users = set(channel.get_all_users())
+                                        results = fan_out([peer for peer in peers if peer["username"] != self.username and peer["username"] in channel_users],
+                                                          json.dumps(message_data))
+                                        sent_count = sum(results.values())
+                                        if sent_count:
+                                            sent_successfully = True
+                                        if sent_count < len(results):
+                                            logging.error(f"[Agent] Error sending message to peers {[f'{u}@{ip}:{port}' for (u, ip, port), ok in results.items() if not ok]}")
                                         
                                         logging.info(f"[Agent] Message sent to {sent_count} peers in channel {channel_name}")
                                         
@@ -1204,7 +1364,8 @@ class Agent:
                 request_data = {
                     "type": "request_history",
                     "channel": channel_name,
-                    "username": self.username or "visitor"
+                    "username": self.username or "visitor",
+                    "history": HISTORY_CHUNKED
                 }
                 
                 logging.info(f"[Agent] Requesting history for channel {channel_name} from host {host}")
@@ -1292,15 +1453,13 @@ class Agent:
         return True
 
     def check_online_status(self):
-        try:    
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(3)
-            s.connect((TRACKER_IP, TRACKER_PORT))
-            s.send(b"ping\n")
-            response = s.recv(1024).decode().strip()
-            s.close()
-            
-            if response == "pong":
+        try:
+            # Heartbeat vừa kiểm tra kết nối vừa gia hạn trạng thái sống của peer trên tracker;
+            # không chờ khi bị giới hạn tần suất, heartbeat sau sẽ gia hạn
+            response = (tracker_request(f"heartbeat {MY_IP} {self.port}", timeout=3, max_wait=0) or "").strip()
+
+            if response == "pong" or response.startswith("RETRY_AFTER"):
+                # RETRY_AFTER: tracker vẫn trả lời được nên agent vẫn online
                 self.status = "online"
                 return True
             else:
@@ -1319,6 +1478,8 @@ def agent_main(command_queue: Queue, my_port: int, username: str = "", status: s
     def get_current_username():
         return server_username[0]
     
+    # Lô tin nhắn host nhận được đi qua session và failover của agent thay vì một kết nối riêng
+    sync_scheduler.send = tracker_request
     server_thread = threading.Thread(target=start_peer_server, args=(my_port, get_current_username))
     server_thread.daemon = True
     server_thread.start()
@@ -1341,6 +1502,10 @@ def agent_main(command_queue: Queue, my_port: int, username: str = "", status: s
     last_connection_check = time.time()
     last_auto_sync = time.time()
     
+    tracker_events = queue.Queue()
+    subscription = TrackerSubscription(agent, tracker_events)
+    subscription.start()
+    
     if not hasattr(agent, '_auto_sync'):
         agent._auto_sync = True
     
@@ -1363,6 +1528,8 @@ def agent_main(command_queue: Queue, my_port: int, username: str = "", status: s
                     new_username = cmd.split(":", 1)[1]
                     server_username[0] = new_username
                     logging.info(f"[Agent] Updated server thread username to {new_username}")
+                
+                subscription.resubscribe()
             
             
             elif current_time - last_connection_check > 10:
@@ -1383,7 +1550,17 @@ def agent_main(command_queue: Queue, my_port: int, username: str = "", status: s
                     response_queue.put(result)
                 tracker_connected = current_connection
         
-            if agent._auto_sync and current_time - last_auto_sync > 60 and agent.status != "offline" and agent.is_authenticated and tracker_connected:
+            while True:
+                try:
+                    event = tracker_events.get_nowait()
+                except queue.Empty:
+                    break
+                agent.handle_tracker_event(event)
+                subscription.resubscribe()
+            
+            # Khi đang nhận sự kiện đẩy, đồng bộ định kỳ chỉ còn là đường dự phòng (và để gửi tin pending)
+            sync_interval = SUBSCRIBED_SYNC_INTERVAL if subscription.connected else AUTO_SYNC_INTERVAL
+            if agent._auto_sync and current_time - last_auto_sync > sync_interval and agent.status != "offline" and agent.is_authenticated and tracker_connected:
                 last_auto_sync = current_time
                 logging.info("[Agent] Performing scheduled automatic sync...")
                 agent.sync_all(sync_type="reconnect")
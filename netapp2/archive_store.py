@@ -0,0 +1,154 @@
+# archive_store.py
+import bisect
+import gzip
+import json
+import os
+from array import array
+import threading
+import logging
+
+DATA_DIR = "data"
+ARCHIVE_DIR = "archive"  # Thư mục con của data/, mỗi kênh một thư mục
+SEGMENT_SUFFIX = ".jsonl.gz"
+IDS_SUFFIX = ".ids"  # Chỉ mục id của segment: các id rút gọn 64 bit đã sắp xếp
+
+def _id_key(message_id):
+    # 64 bit đầu của id (sha1) đủ để phân biệt tin nhắn trong một kênh
+    return int(message_id[:16], 16)
+
+class ArchiveStore:
+    """Tầng lưu trữ của một kênh: các segment nén, chỉ ghi một lần, chứa tin nhắn đã rời tầng nóng.
+
+    Mỗi segment data/archive/<kênh>/<seq đầu>-<seq cuối>.jsonl.gz chứa các tin nhắn theo thứ
+    tự seq, mỗi dòng một JSON. Segment chỉ được đọc khi có truy vấn lịch sử (get_history), nên
+    không làm chậm sync và join. Kiểm tra trùng dùng file <seq đầu>-<seq cuối>.ids cạnh mỗi
+    segment (8 byte mỗi tin), được nạp khi cần và dựng lại từ segment nếu thiếu.
+    """
+    def __init__(self, channel_name, data_dir=DATA_DIR):
+        self.dir = os.path.join(data_dir, ARCHIVE_DIR, channel_name)
+        self._lock = threading.Lock()
+        self._segments = None  # [(seq đầu, seq cuối, đường dẫn)] theo thứ tự seq
+        self._ids = {}  # đường dẫn segment -> array("Q") id rút gọn đã sắp xếp, nạp khi cần kiểm tra trùng
+        self._cached_path = None  # Segment đọc gần nhất (truy vấn lịch sử thường đọc liên tiếp)
+        self._cached = None
+
+    def _load_segments(self):
+        if self._segments is None:
+            segments = []
+            try:
+                filenames = os.listdir(self.dir)
+            except FileNotFoundError:
+                filenames = []
+            for filename in filenames:
+                if not filename.endswith(SEGMENT_SUFFIX):
+                    continue
+                first, _, last = filename[:-len(SEGMENT_SUFFIX)].partition("-")
+                try:
+                    segments.append((int(first), int(last), os.path.join(self.dir, filename)))
+                except ValueError:
+                    continue
+            segments.sort()
+            self._segments = segments
+        return self._segments
+
+    def last_seq(self):
+        """seq lớn nhất đã nằm trong archive (0 nếu chưa có segment nào)"""
+        with self._lock:
+            segments = self._load_segments()
+            return segments[-1][1] if segments else 0
+
+    def write_segment(self, message_dicts):
+        """Ghi một segment mới từ các tin nhắn (theo thứ tự seq); file chỉ xuất hiện khi đã ghi xong"""
+        first, last = message_dicts[0]["seq"], message_dicts[-1]["seq"]
+        path = os.path.join(self.dir, f"{first}-{last}{SEGMENT_SUFFIX}")
+        os.makedirs(self.dir, exist_ok=True)
+        with open(path + ".tmp", "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                for message in message_dicts:
+                    f.write(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(path + ".tmp", path)
+        ids = self._write_ids(path, (message["id"] for message in message_dicts))
+        with self._lock:
+            self._load_segments().append((first, last, path))
+            self._ids[path] = ids
+        logging.info(f"[Archive] Wrote segment {path} with {len(message_dicts)} messages")
+
+    def _read(self, path):
+        if self._cached_path != path:
+            with gzip.open(path, "rb") as f:
+                self._cached = [json.loads(line) for line in f if line.strip()]
+            self._cached_path = path
+        return self._cached
+
+    @staticmethod
+    def _write_ids(path, message_ids):
+        """Ghi chỉ mục id của segment; file thiếu (tắt đột ngột) sẽ được dựng lại khi đọc"""
+        ids = array("Q", sorted(_id_key(message_id) for message_id in message_ids))
+        ids_path = path[:-len(SEGMENT_SUFFIX)] + IDS_SUFFIX
+        with open(ids_path + ".tmp", "wb") as f:
+            ids.tofile(f)
+        os.replace(ids_path + ".tmp", ids_path)
+        return ids
+
+    def _segment_ids(self, path):
+        ids = self._ids.get(path)
+        if ids is None:
+            ids = array("Q")
+            try:
+                with open(path[:-len(SEGMENT_SUFFIX)] + IDS_SUFFIX, "rb") as f:
+                    ids.frombytes(f.read())
+            except FileNotFoundError:
+                # Segment cũ chưa có chỉ mục id
+                with gzip.open(path, "rb") as f:
+                    ids = self._write_ids(path, (json.loads(line)["id"] for line in f if line.strip()))
+            self._ids[path] = ids
+        return ids
+
+    def contains(self, message_id):
+        """Tin nhắn có id này đã được lưu trữ chưa (tìm nhị phân trong chỉ mục id của từng segment)"""
+        key = _id_key(message_id)
+        with self._lock:
+            for _, _, path in self._load_segments():
+                ids = self._segment_ids(path)
+                index = bisect.bisect_left(ids, key)
+                if index < len(ids) and ids[index] == key:
+                    return True
+            return False
+
+    def iter_messages(self):
+        """Mọi tin nhắn đã lưu trữ theo thứ tự seq (dựng chỉ mục tìm kiếm); đọc từng segment, không qua cache"""
+        with self._lock:
+            paths = [path for _, _, path in self._load_segments()]
+        for path in paths:
+            with gzip.open(path, "rb") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def get(self, seq):
+        """Tin nhắn đã lưu trữ có seq này, None nếu không có"""
+        with self._lock:
+            segments = self._load_segments()
+            index = bisect.bisect_right(segments, (seq, float("inf"))) - 1
+            if index < 0 or segments[index][1] < seq:
+                return None
+            messages = self._read(segments[index][2])
+        position = bisect.bisect_left([message["seq"] for message in messages], seq)
+        if position < len(messages) and messages[position]["seq"] == seq:
+            return messages[position]
+        return None
+
+    def page_before(self, before, limit):
+        """Tối đa limit tin nhắn có seq < before, gần before nhất; trả về theo thứ tự seq tăng dần"""
+        result = []
+        with self._lock:
+            for first, _, path in reversed(self._load_segments()):
+                if first >= before:
+                    continue
+                older = [message for message in self._read(path) if message["seq"] < before]
+                result = older[max(0, len(older) - (limit - len(result))):] + result
+                if len(result) >= limit:
+                    break
+        return result
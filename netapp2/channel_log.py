@@ -0,0 +1,165 @@
+# channel_log.py
+import json
+import os
+import threading
+import logging
+from collections import OrderedDict
+
+DATA_DIR = "data"
+
+# Ghi fsync sau mỗi lần commit (an toàn khi mất điện, chậm hơn)
+FSYNC_ON_COMMIT = True
+# Compact khi số bản ghi trong log vượt quá max(COMPACT_MIN_RECORDS, số tin nhắn của kênh),
+# nhờ vậy chi phí ghi snapshot được chia đều và mỗi tin nhắn chỉ tốn O(1) khi ghi
+COMPACT_MIN_RECORDS = 1000
+# Số file log được giữ mở cùng lúc tối đa; log lâu không ghi bị đóng và được mở lại ở lần ghi sau
+MAX_OPEN_LOGS = 256
+
+_open_logs = OrderedDict()  # ChannelLog có file đang mở, log ghi gần nhất ở cuối
+_open_logs_lock = threading.Lock()
+
+class ChannelLog:
+    """Write-ahead log dạng append-only cho một kênh trên tracker.
+
+    data/<kênh>.json là snapshot (cùng định dạng cũ), data/<kênh>.log chứa các thay đổi
+    sau snapshot, mỗi dòng một bản ghi JSON. append() chỉ đưa bản ghi vào hàng đợi;
+    commit() ghi tất cả bản ghi đang chờ bằng một lần write/fsync (group commit), các
+    thread commit cùng lúc sẽ chờ lần ghi của thread dẫn đầu thay vì tự ghi. Người gọi
+    append() khi giữ lock của mình rồi commit(số thứ tự) sau khi nhả lock để các lần ghi
+    gộp được với nhau. Tổng số file log mở của mọi kênh không vượt quá MAX_OPEN_LOGS.
+    """
+    def __init__(self, channel_name, data_dir=DATA_DIR):
+        self.channel_name = channel_name
+        self.snapshot_path = os.path.join(data_dir, f"{channel_name}.json")
+        self.log_path = os.path.join(data_dir, f"{channel_name}.log")
+        self._cond = threading.Condition()
+        self._pending = []
+        self._appended = 0  # Số thứ tự bản ghi cuối cùng đã append
+        self._flushed = 0  # Số thứ tự bản ghi cuối cùng đã ghi xuống disk
+        self._flushing = False
+        self._file = None
+        self.records_since_snapshot = 0
+
+    @property
+    def appended(self):
+        """Số thứ tự của bản ghi cuối cùng đã append, dùng cho commit(upto)"""
+        return self._appended
+
+    def _open(self):
+        """File log để ghi (gọi trong lần ghi của commit); đóng file của log ít dùng nhất nếu mở quá nhiều"""
+        with _open_logs_lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+                self._file = open(self.log_path, "a", encoding="utf-8")
+            _open_logs[self] = None
+            _open_logs.move_to_end(self)
+            for log in list(_open_logs):
+                if len(_open_logs) <= MAX_OPEN_LOGS:
+                    break
+                if log is not self:
+                    log._release_file()
+            return self._file
+
+    def _release_file(self):
+        """Đóng file nếu không có lần ghi nào đang dùng nó (gọi khi giữ _open_logs_lock)"""
+        # Không chờ _cond: thread đang ghi log đó có thể đang chờ _open_logs_lock
+        if not self._cond.acquire(blocking=False):
+            return
+        try:
+            if not self._flushing:
+                self._close_file()
+        finally:
+            self._cond.release()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        _open_logs.pop(self, None)
+
+    def append(self, record):
+        """Đưa một bản ghi vào hàng đợi, trả về số thứ tự để commit()"""
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._cond:
+            self._pending.append(line)
+            self._appended += 1
+            self.records_since_snapshot += 1
+            return self._appended
+
+    def commit(self, upto=None):
+        """Chờ cho tới khi mọi bản ghi tới số thứ tự upto (mặc định: tất cả) đã nằm trên disk"""
+        with self._cond:
+            target = self._appended if upto is None else upto
+            while self._flushed < target:
+                if self._flushing:
+                    # Một thread khác đang ghi, lần ghi đó có thể đã bao gồm bản ghi của mình
+                    self._cond.wait()
+                    continue
+                batch = self._pending
+                self._pending = []
+                batch_end = self._appended
+                self._flushing = True
+                self._cond.release()
+                try:
+                    f = self._open()
+                    f.write("".join(batch))
+                    f.flush()
+                    if FSYNC_ON_COMMIT:
+                        os.fsync(f.fileno())
+                finally:
+                    self._cond.acquire()
+                    self._flushing = False
+                    self._flushed = batch_end
+                    self._cond.notify_all()
+
+    def needs_compaction(self, message_count):
+        return self.records_since_snapshot > max(COMPACT_MIN_RECORDS, message_count)
+
+    def compact(self, snapshot):
+        """Ghi snapshot mới (dict) rồi xoá log. Người gọi phải đảm bảo không có ghi đồng thời vào kênh."""
+        self.commit()
+        with self._cond:
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+                f.flush()
+                if FSYNC_ON_COMMIT:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+            # Snapshot đã chứa mọi thay đổi, log bắt đầu lại từ đầu
+            with _open_logs_lock:
+                self._close_file()
+            with open(self.log_path, "w", encoding="utf-8"):
+                pass
+            self.records_since_snapshot = 0
+        logging.info(f"[ChannelLog] Compacted channel {self.channel_name} into snapshot")
+
+    def read_snapshot(self):
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def replay(self):
+        """Đọc lần lượt các bản ghi trong log; dòng cuối bị ghi dở (crash) sẽ bị bỏ qua"""
+        records = []
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logging.warning(f"[ChannelLog] Skipping torn record in {self.log_path}")
+        except FileNotFoundError:
+            pass
+        self.records_since_snapshot = len(records)
+        return records
+
+    def close(self):
+        self.commit()
+        with self._cond, _open_logs_lock:
+            self._close_file()
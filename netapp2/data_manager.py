@@ -58,6 +58,7 @@ class Channel:
         self.messages = []
         self.members = set()
         self.visitors = set()  # Visitors who can read but not write
+        self.tracker_cursor = 0  # seq cuối cùng đã nhận từ tracker (delta sync)
         # Automatically add host as member
         if host and host != "visitor":
             self.add_member(host)
@@ -164,7 +165,8 @@ class Channel:
                 "host": str(self.host),
                 "members": [str(m) for m in self.members],
                 "visitors": [str(v) for v in self.visitors],
-                "messages": messages_list
+                "messages": messages_list,
+                "tracker_cursor": self.tracker_cursor
             }
         except Exception as e:
             logger.error(f"[Channel] Error in Channel.to_dict: {e}")
@@ -280,6 +282,8 @@ class DataManager:
                                 message = Message.from_dict(msg_data)
                                 channel.add_message(message)
                         
+                        channel.tracker_cursor = data.get("tracker_cursor", 0)
+                        
                         # Sắp xếp tin nhắn sau khi tải
                         self.sort_channel_messages(channel)
                         
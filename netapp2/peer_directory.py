@@ -0,0 +1,105 @@
+# peer_directory.py
+import threading
+import time
+import logging
+
+PEER_DIRECTORY_TTL = 300  # Đọc lại toàn bộ danh sách peer từ tracker sau chừng này giây
+MISS_REFRESH_INTERVAL = 2  # Khoảng cách tối thiểu giữa hai lần đọc lại vì không tìm thấy một username
+
+class PeerDirectory:
+    """Danh bạ peer cục bộ của peer server, tra theo username mà không hỏi tracker.
+
+    Được cập nhật bằng các thông báo status_update tracker đẩy tới (kèm ip và port) và đọc lại
+    toàn bộ bằng fetch() (get_list) khi quá TTL, việc đọc lại chạy ở nền nếu danh bạ đã có dữ liệu.
+    Khi không tìm thấy một username (ví dụ peer vừa đăng ký, thông báo chưa tới), danh bạ được
+    đọc lại ngay nhưng không quá một lần mỗi MISS_REFRESH_INTERVAL giây.
+    """
+    def __init__(self, fetch, ttl=PEER_DIRECTORY_TTL, miss_refresh_interval=MISS_REFRESH_INTERVAL):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.miss_refresh_interval = miss_refresh_interval
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()  # Chỉ một lần đọc lại cùng lúc
+        self._peers = {}  # username -> dict peer {"ip", "port", "username", "status"}
+        self._updated = {}  # username -> thời điểm nhận status_update gần nhất
+        self._refreshed_at = None
+        self._refreshing = False
+        self.refreshes = 0
+
+    def __len__(self):
+        return len(self._peers)
+
+    def apply_update(self, update):
+        """Áp dụng một thông báo status_update của tracker"""
+        username = update.get("username")
+        if not username or update.get("ip") is None or update.get("port") is None:
+            return
+        with self._lock:
+            self._peers[username] = {
+                "ip": update["ip"],
+                "port": update["port"],
+                "username": username,
+                "status": update.get("status", "online")
+            }
+            self._updated[username] = time.monotonic()
+
+    def refresh(self):
+        """Đọc lại toàn bộ danh sách từ tracker; thông báo đến trong lúc đọc được giữ lại"""
+        with self._refresh_lock:
+            started = time.monotonic()
+            peers = self._fetch()
+            by_username = {}
+            for peer in peers:
+                # Cùng username ở nhiều địa chỉ: ưu tiên bản chưa offline, rồi bản đứng trước
+                current = by_username.get(peer["username"])
+                if current is None or (current.get("status") == "offline" and peer.get("status") != "offline"):
+                    by_username[peer["username"]] = peer
+            with self._lock:
+                for username, updated in self._updated.items():
+                    if updated >= started and username in self._peers:
+                        by_username[username] = self._peers[username]
+                self._peers = by_username
+                self._updated = {username: updated for username, updated in self._updated.items() if updated >= started}
+                self._refreshed_at = time.monotonic()
+                self.refreshes += 1
+            logging.info(f"[Server] Peer directory refreshed with {len(by_username)} peers")
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"[Server] Error refreshing peer directory: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+        threading.Thread(target=run, name="peer-directory-refresh", daemon=True).start()
+
+    def _ensure_fresh(self):
+        if self._refreshed_at is None:
+            self.refresh()
+        elif time.monotonic() - self._refreshed_at > self.ttl:
+            self._refresh_in_background()
+
+    def get(self, username):
+        """dict peer của username, hoặc None nếu tracker không biết username này"""
+        self._ensure_fresh()
+        with self._lock:
+            peer = self._peers.get(username)
+        if peer is None and time.monotonic() - self._refreshed_at > self.miss_refresh_interval:
+            self.refresh()
+            with self._lock:
+                peer = self._peers.get(username)
+        return peer
+
+    def resolve(self, usernames):
+        """Các peer nhận được tin trong usernames (bỏ qua username chưa biết hoặc đang offline)"""
+        self._ensure_fresh()
+        with self._lock:
+            peers = [self._peers.get(username) for username in usernames]
+        return [peer for peer in peers if peer is not None and peer.get("status") != "offline"]
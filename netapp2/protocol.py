@@ -0,0 +1,343 @@
+# protocol.py
+import socket
+import struct
+import threading
+import asyncio
+import json
+import logging
+
+# Giao thức đóng gói (framing) dùng chung cho tracker, peer server và peer client.
+#
+# Mỗi frame gồm header cố định 7 byte và payload:
+#   magic (2 byte) | version (1 byte) | độ dài payload (4 byte, big-endian)
+#
+# Byte đầu của magic là \x00 nên không bao giờ trùng với một lệnh dạng text cũ
+# ("send_info ...", "{...}"), nhờ đó server nhận diện được từng message là frame
+# hay một dòng kết thúc bằng "\n" của client cũ và trả lời theo đúng kiểu đó.
+# Server chỉ hiểu giao thức dòng trả lời frame bằng một dòng; client ghi nhớ địa chỉ đó và
+# gửi bằng dòng từ lần sau. Server đóng kết nối mà không trả lời thì không được coi là server cũ.
+#
+# Frame version 2 mang thêm request id (4 byte, big-endian, khác 0) ở đầu payload.
+# Server trả lời bằng frame version 2 cùng id, nên client có thể gửi nhiều lệnh liên tiếp
+# trên một kết nối (pipelining) và ghép phản hồi theo id dù chúng về không theo thứ tự.
+# Frame version 1 trên cùng kết nối là dữ liệu server tự đẩy (sự kiện subscribe).
+FRAME_MAGIC = b"\x00\xfa"
+PROTOCOL_VERSION = 2  # Version cao nhất hiểu được
+REQUEST_ID_VERSION = 2
+FRAME_HEADER = struct.Struct("!2sBI")
+REQUEST_ID = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+RECV_SIZE = 65536
+
+# Các địa chỉ (ip, port) đã được xác định là chỉ hiểu giao thức dòng cũ
+_legacy_hosts = set()
+
+class ProtocolError(Exception):
+    def __init__(self, message="", framed=True):
+        super().__init__(message)
+        self.framed = framed  # Kiểu đóng gói để trả lời lỗi, như giá trị thứ hai của read_message
+
+def encode_frame(payload, version=1):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame too large ({len(payload)} bytes)")
+    return FRAME_HEADER.pack(FRAME_MAGIC, version, len(payload)) + payload
+
+def encode_request(request_id, payload):
+    """Frame version 2: payload kèm request id để ghép phản hồi trên kết nối pipelining"""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return encode_frame(REQUEST_ID.pack(request_id) + payload, REQUEST_ID_VERSION)
+
+def encode_reply(payload, framed):
+    """Đóng gói phản hồi theo cùng kiểu với request.
+
+    framed là giá trị thứ hai mà read_message trả về: False (dòng kết thúc bằng newline),
+    True (frame version 1) hoặc request id (frame version 2, phản hồi mang lại đúng id đó).
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if framed is True:
+        return encode_frame(payload.rstrip(b"\n"))
+    if framed:
+        return encode_request(framed, payload.rstrip(b"\n"))
+    if not payload.endswith(b"\n"):
+        payload += b"\n"
+    return payload
+
+def send_frame(sock, payload):
+    sock.sendall(encode_frame(payload))
+
+def _parse_header(header, max_size=MAX_FRAME_SIZE):
+    magic, version, length = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        raise ProtocolError("Invalid frame magic")
+    if version > PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if length > max_size:
+        raise ProtocolError(f"Frame too large ({length} bytes)")
+    if version == REQUEST_ID_VERSION and length < REQUEST_ID.size:
+        raise ProtocolError("Frame too short for a request id")
+    return version, length
+
+def _split_request_id(version, payload):
+    """(payload, framed) của một frame: framed là True với version 1, request id với version 2"""
+    if version != REQUEST_ID_VERSION:
+        return payload, True
+    request_id = REQUEST_ID.unpack_from(payload)[0]
+    if request_id == 0:
+        raise ProtocolError("Request id must not be 0")
+    return payload[REQUEST_ID.size:], request_id
+
+class MessageReader:
+    """Đọc lần lượt các message từ một socket blocking.
+
+    Mỗi message có thể là frame hoặc một dòng kiểu cũ; bộ đệm chỉ được quét một lần
+    nên dữ liệu lớn được nhận trong O(n) thay vì quét lại toàn bộ sau mỗi lần recv.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = bytearray()
+        self._scan_pos = 0  # Vị trí đã tìm newline tới, tránh quét lại
+
+    def _fill(self):
+        chunk = self.sock.recv(RECV_SIZE)
+        if not chunk:
+            return False
+        self._buffer += chunk
+        return True
+
+    def read_message(self):
+        """Trả về (payload: bytes, framed), hoặc (None, False) khi kết nối đóng.
+
+        framed là False với dòng kiểu cũ, True với frame version 1, request id với frame version 2.
+        """
+        buffer = self._buffer
+        while True:
+            if buffer:
+                if buffer[0] == FRAME_MAGIC[0]:
+                    if len(buffer) >= FRAME_HEADER.size:
+                        version, length = _parse_header(bytes(buffer[:FRAME_HEADER.size]))
+                        end = FRAME_HEADER.size + length
+                        if len(buffer) >= end:
+                            payload = bytes(buffer[FRAME_HEADER.size:end])
+                            del buffer[:end]
+                            self._scan_pos = 0
+                            return _split_request_id(version, payload)
+                else:
+                    idx = buffer.find(b"\n", self._scan_pos)
+                    if idx != -1:
+                        line = bytes(buffer[:idx])
+                        del buffer[:idx + 1]
+                        self._scan_pos = 0
+                        return line, False
+                    self._scan_pos = len(buffer)
+            if not self._fill():
+                break
+
+        # Kết nối đã đóng: client cũ có thể gửi dòng cuối không có newline
+        if buffer and buffer[0] != FRAME_MAGIC[0]:
+            line = bytes(buffer)
+            buffer.clear()
+            self._scan_pos = 0
+            return line, False
+        return None, False
+
+async def read_message_async(reader, max_size=MAX_FRAME_SIZE, on_start=None):
+    """Phiên bản asyncio của MessageReader.read_message cho asyncio.StreamReader.
+
+    Dòng kiểu cũ dài hơn limit của StreamReader được đọc thành nhiều phần, nên limit chỉ cần
+    đủ cho một lệnh thông thường. on_start (coroutine, nếu có) được chờ sau byte đầu tiên của
+    message, trước khi đọc phần còn lại: kết nối đang rỗi không giữ gì của server.
+    """
+    first = await reader.read(1)
+    if not first:
+        return None, False
+    if on_start is not None:
+        await on_start()
+    try:
+        if first[0] == FRAME_MAGIC[0]:
+            header = first + await reader.readexactly(FRAME_HEADER.size - 1)
+            version, length = _parse_header(header)
+            if length > max_size:
+                # Đọc request id (nếu có) để lỗi được trả lời đúng cho lệnh đó
+                framed = True
+                if version == REQUEST_ID_VERSION and length >= REQUEST_ID.size:
+                    framed = REQUEST_ID.unpack(await reader.readexactly(REQUEST_ID.size))[0] or True
+                raise ProtocolError(f"Frame too large ({length} bytes)", framed)
+            payload = await reader.readexactly(length)
+            return _split_request_id(version, payload)
+    except asyncio.IncompleteReadError as e:
+        logging.warning(f"[Protocol] Connection closed in the middle of a frame ({len(e.partial)} bytes)")
+        return None, False
+    parts = [first]
+    size = 1
+    while True:
+        try:
+            part = await reader.readuntil(b"\n")
+        except asyncio.LimitOverrunError as e:
+            part = await reader.readexactly(e.consumed)
+        except asyncio.IncompleteReadError as e:
+            # Kết nối đã đóng: client cũ có thể gửi dòng cuối không có newline
+            parts.append(e.partial)
+            break
+        size += len(part)
+        if size > max_size + 1:
+            raise ProtocolError(f"Line too long (more than {max_size} bytes)", False)
+        parts.append(part)
+        if part.endswith(b"\n"):
+            break
+    return b"".join(parts).rstrip(b"\n"), False
+
+def recv_reply(sock):
+    """Đọc một phản hồi (frame hoặc dòng) từ socket, trả về str hoặc None nếu không có dữ liệu"""
+    payload, _ = MessageReader(sock).read_message()
+    if payload is None:
+        return None
+    return payload.decode()
+
+def request(addr, payload, timeout=10):
+    """Gửi một lệnh tới server tại addr và chờ một phản hồi (str), hoặc None nếu không có phản hồi.
+
+    Mặc định gửi bằng frame. Nếu server trả lời frame bằng một dòng (chỉ hiểu giao thức dòng),
+    địa chỉ đó được ghi nhớ để các lần sau gửi bằng dòng. Lệnh không bao giờ được tự gửi lại:
+    server đóng kết nối mà không trả lời (lệnh lỗi, hết chỗ kết nối...) thì trả về None.
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode()
+    addr = (addr[0], int(addr[1]))
+    legacy = addr in _legacy_hosts
+    s = socket.create_connection(addr, timeout=timeout)
+    try:
+        if legacy:
+            s.sendall(payload.rstrip("\n").encode() + b"\n")
+        else:
+            send_frame(s, payload)
+        response, framed = MessageReader(s).read_message()
+    except ConnectionResetError:
+        return None
+    finally:
+        s.close()
+    if response is None:
+        return None
+    if framed is False and not legacy:
+        logging.info(f"[Protocol] {addr[0]}:{addr[1]} answered a framed request with a line, using line protocol from now on")
+        _legacy_hosts.add(addr)
+    return response.decode()
+
+def request_pages(addr, command, limit=200, timeout=10, send=None):
+    """Lấy lần lượt từng trang của một lệnh phân trang (list_channels, get_list) và yield từng phần tử.
+
+    Mỗi lần chỉ giữ một trang trong bộ nhớ. Server cũ không hiểu tham số phân trang và trả về
+    toàn bộ danh sách JSON; khi đó các phần tử của danh sách được yield luôn. send(addr, lệnh,
+    timeout) thay cho request() khi người gọi có kết nối riêng (ví dụ một Session).
+    """
+    send = send or request
+    cursor = None
+    while True:
+        page_command = f"{command} limit={limit}" + (f" after={cursor}" if cursor is not None else "")
+        response = send(addr, page_command, timeout)
+        if response is None:
+            raise ProtocolError(f"No response to {command}")
+        if response.startswith("ERROR"):
+            raise ProtocolError(response.strip())
+        data = json.loads(response)
+        if isinstance(data, list):
+            yield from data
+            return
+        yield from data["items"]
+        cursor = data.get("next")
+        if cursor is None:
+            return
+
+class Session:
+    """Một kết nối giữ lâu tới server, nhiều lệnh được gửi liên tiếp (pipelining) bằng frame version 2.
+
+    request() an toàn khi gọi từ nhiều thread: mỗi lệnh mang một request id và thread gọi chờ
+    phản hồi cùng id, do một thread đọc riêng phân phát. Kết nối được mở lại khi cần. Nếu server
+    trả lời frame version 2 bằng một dòng (server cũ), supported thành False và người gọi nên quay
+    về request(); kết nối bị đóng mà không có phản hồi không làm thay đổi supported.
+    """
+    def __init__(self, addr, connect_timeout=5):
+        self.addr = (addr[0], int(addr[1]))
+        self.connect_timeout = connect_timeout
+        self.supported = True
+        self._lock = threading.Lock()
+        self._sock = None
+        self._pending = {}  # request id -> [threading.Event, phản hồi]
+        self._next_id = 0
+        self._answered = False  # Đã từng nhận phản hồi version 2 nào chưa
+
+    def _connect(self):
+        sock = socket.create_connection(self.addr, timeout=self.connect_timeout)
+        sock.settimeout(None)
+        self._sock = sock
+        threading.Thread(target=self._read_loop, args=(sock,), name=f"session-{self.addr[1]}", daemon=True).start()
+
+    def request(self, payload, timeout=10):
+        """Gửi một lệnh và chờ phản hồi (str); ném OSError nếu mất kết nối hoặc quá timeout"""
+        waiter = [threading.Event(), None]
+        with self._lock:
+            if self._sock is None:
+                self._connect()
+            self._next_id = self._next_id % 0xFFFFFFFF + 1
+            request_id = self._next_id
+            self._pending[request_id] = waiter
+            try:
+                self._sock.sendall(encode_request(request_id, payload))
+            except OSError:
+                self._pending.pop(request_id, None)
+                self._drop(self._sock)
+                raise
+        if not waiter[0].wait(timeout):
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise socket.timeout(f"No response to request {request_id}")
+        if isinstance(waiter[1], Exception):
+            raise waiter[1]
+        return waiter[1]
+
+    def _read_loop(self, sock):
+        reader = MessageReader(sock)
+        try:
+            while True:
+                payload, framed = reader.read_message()
+                if payload is None:
+                    break
+                if framed is False and not self._answered:
+                    # Server cũ trả lời frame version 2 bằng một dòng lỗi rồi đóng kết nối
+                    logging.info(f"[Protocol] {self.addr[0]}:{self.addr[1]} does not support pipelined sessions")
+                    self.supported = False
+                    break
+                if framed is True or framed is False:
+                    continue  # Dữ liệu server tự đẩy, session không dùng
+                with self._lock:
+                    self._answered = True
+                    waiter = self._pending.pop(framed, None)
+                if waiter is not None:
+                    waiter[1] = payload.decode(errors="replace")
+                    waiter[0].set()
+        except (OSError, ProtocolError) as e:
+            logging.info(f"[Protocol] Session to {self.addr[0]}:{self.addr[1]} closed: {e}")
+        with self._lock:
+            self._drop(sock)
+
+    def _drop(self, sock):
+        """Đóng kết nối và báo lỗi cho mọi lệnh đang chờ trên nó (gọi khi đang giữ _lock)"""
+        if self._sock is not sock:
+            return
+        self._sock = None
+        try:
+            sock.close()
+        except OSError:
+            pass
+        for waiter in self._pending.values():
+            waiter[1] = ConnectionResetError("Session closed")
+            waiter[0].set()
+        self._pending.clear()
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._drop(self._sock)
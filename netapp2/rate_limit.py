@@ -0,0 +1,56 @@
+# rate_limit.py
+import threading
+import time
+
+class TokenBucket:
+    """Bucket token: nạp rate token mỗi giây, chứa tối đa burst token; mỗi lệnh tốn một token"""
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+class RateLimiter:
+    """Giới hạn tần suất lệnh theo (client, nhóm lệnh) bằng token bucket.
+
+    limits là dict nhóm -> (rate mỗi giây, burst). acquire() trả về 0 nếu lệnh được chạy,
+    nếu không thì số giây client nên chờ trước khi gửi lại. Bucket đã đầy và không được dùng
+    quá idle_after giây bị xoá để số bucket không tăng theo số client từng kết nối.
+    """
+    def __init__(self, limits, idle_after=300):
+        self.limits = dict(limits)
+        self.idle_after = idle_after
+        self._buckets = {}  # (client, nhóm) -> TokenBucket
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + idle_after
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def acquire(self, client, group):
+        limit = self.limits.get(group)
+        if limit is None:
+            return 0
+        rate, burst = limit
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            bucket = self._buckets.get((client, group))
+            if bucket is None:
+                bucket = self._buckets[(client, group)] = TokenBucket(burst, now)
+            else:
+                bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+                bucket.updated = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0
+            self.rejected += 1
+            return (1 - bucket.tokens) / rate
+
+    def _sweep(self, now):
+        self._next_sweep = now + self.idle_after
+        idle = [key for key, bucket in self._buckets.items() if now - bucket.updated > self.idle_after]
+        for key in idle:
+            del self._buckets[key]
@@ -0,0 +1,58 @@
+# replication_log.py
+import itertools
+import threading
+import time
+from collections import deque
+
+# Số bản ghi giữ trong bộ nhớ cho standby; standby tụt lại xa hơn phải đồng bộ lại toàn bộ
+REPLICATION_BACKLOG = 100000
+
+class ReplicationLog:
+    """Journal các thay đổi của tracker (registry peer và bản ghi log kênh) cho standby đọc theo.
+
+    Mỗi bản ghi có một số thứ tự tăng dần. epoch định danh journal: nó đổi mỗi khi process
+    khởi động hoặc được promote, nên standby có epoch khác phải đồng bộ lại toàn bộ trước khi
+    đọc tiếp. Journal chỉ bắt đầu ghi khi có standby đầu tiên kết nối, tracker không có standby
+    không tốn bộ nhớ cho nó.
+    """
+    def __init__(self, capacity=REPLICATION_BACKLOG):
+        self._cond = threading.Condition()
+        self._records = deque(maxlen=capacity)  # (seq, bản ghi), seq liên tiếp
+        self.epoch = str(time.time_ns())
+        self.seq = 0
+        self.enabled = False
+
+    def append(self, record):
+        if not self.enabled:
+            return
+        with self._cond:
+            self.seq += 1
+            self._records.append((self.seq, record))
+            self._cond.notify_all()
+
+    def reset(self):
+        """Bắt đầu một journal mới (sau khi standby được promote thành primary)"""
+        with self._cond:
+            self._records.clear()
+            self.epoch = str(time.time_ns())
+            self.seq = 0
+            self.enabled = False
+
+    def read(self, epoch, seq, limit, timeout):
+        """Các bản ghi sau seq (tối đa limit), chờ tối đa timeout giây nếu chưa có gì mới.
+
+        Trả về (seq cuối, danh sách bản ghi), hoặc None nếu standby phải đồng bộ lại toàn bộ
+        (khác epoch, hoặc các bản ghi nó cần đã bị đẩy ra khỏi journal).
+        """
+        with self._cond:
+            self.enabled = True
+            if epoch != self.epoch or seq > self.seq:
+                return None
+            if seq == self.seq:
+                self._cond.wait(timeout)
+            first = self._records[0][0] if self._records else self.seq + 1
+            if seq < first - 1:
+                return None
+            start = seq - first + 1
+            records = [record for _, record in itertools.islice(self._records, start, start + limit)]
+            return seq + len(records), records
@@ -0,0 +1,170 @@
+# search_index.py
+import re
+import math
+import bisect
+import heapq
+import threading
+from array import array
+from datetime import datetime, timedelta
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+MAX_TOKEN_LENGTH = 64
+# Tham số BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Số tin khớp bộ lọc tối đa được chấm điểm cho một truy vấn: với từ quá phổ biến chỉ xét các tin
+# mới nhất để thời gian chấm điểm không tăng theo kích thước lịch sử
+MAX_CANDIDATES = 50000
+
+def tokenize(text):
+    """Các từ (chữ thường) của text; giữ nguyên dấu tiếng Việt"""
+    return [token for token in TOKEN_RE.findall((text or "").casefold()) if len(token) <= MAX_TOKEN_LENGTH]
+
+EPOCH = datetime(1970, 1, 1)
+
+def timestamp_value(timestamp):
+    """Timestamp dạng isoformat thành số micro giây (lưu gọn trong mảng); ValueError nếu không đọc được"""
+    moment = datetime.fromisoformat((timestamp or "").strip().replace(" ", "T", 1))
+    return (moment.replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+
+class SearchIndex:
+    """Chỉ mục ngược (inverted index) trên nội dung tin nhắn, cập nhật dần khi có tin mới.
+
+    Mỗi tin nhắn là một document với id tăng dần. Postings của một từ là mảng id document
+    theo thứ tự tăng, một id lặp lại bao nhiêu lần thì từ xuất hiện bấy nhiêu lần trong tin
+    (tần suất dùng cho BM25). Vì tin nhắn không bị xoá, chỉ mục chỉ cần thêm vào cuối.
+    Ngoài postings chỉ giữ các cột số của document (kênh, seq, độ dài, người gửi, thời gian)
+    để lọc và chấm điểm; nội dung của kết quả do người gọi đọc từ kênh theo (kênh, seq).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}  # từ -> array id document
+        self._df = {}  # từ -> số document chứa từ
+        self._channel_ids = {}  # tên kênh -> số
+        self._channel_names = []
+        self._sender_ids = {}  # người gửi -> số
+        self._doc_channel = array("I")
+        self._doc_seq = array("Q")
+        self._doc_length = array("I")
+        self._doc_sender = array("I")
+        self._doc_timestamp = array("q")  # micro giây, 0 nếu timestamp không đọc được
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._doc_seq)
+
+    def add(self, channel_name, seq, sender, timestamp, content):
+        tokens = tokenize(content)
+        try:
+            moment = timestamp_value(timestamp)
+        except ValueError:
+            moment = 0
+        with self._lock:
+            channel_id = self._channel_ids.get(channel_name)
+            if channel_id is None:
+                channel_id = self._channel_ids[channel_name] = len(self._channel_names)
+                self._channel_names.append(channel_name)
+            sender_id = self._sender_ids.setdefault(sender, len(self._sender_ids))
+            doc = len(self._doc_seq)
+            self._doc_channel.append(channel_id)
+            self._doc_seq.append(seq)
+            self._doc_length.append(len(tokens))
+            self._doc_sender.append(sender_id)
+            self._doc_timestamp.append(moment)
+            self._total_length += len(tokens)
+            for token in tokens:
+                postings = self._postings.get(token)
+                if postings is None:
+                    postings = self._postings[token] = array("I")
+                postings.append(doc)
+            for token in set(tokens):
+                self._df[token] = self._df.get(token, 0) + 1
+
+    @staticmethod
+    def _term_frequency(postings, doc, end):
+        """Số lần doc xuất hiện trong postings[:end] (0 nếu không có); O(log n)"""
+        start = bisect.bisect_left(postings, doc, 0, end)
+        if start == end or postings[start] != doc:
+            return 0
+        return bisect.bisect_right(postings, doc, start, end) - start
+
+    def search(self, query, channel=None, sender=None, since=None, until=None, offset=0, limit=20):
+        """Tìm các tin nhắn chứa mọi từ của query, xếp hạng theo BM25 (bằng điểm thì tin mới hơn trước).
+
+        Trả về (tổng số kết quả, danh sách {"channel", "seq", "score"} của trang offset..offset + limit,
+        truncated); truncated là True khi có hơn MAX_CANDIDATES tin chứa từ hiếm nhất và khớp bộ lọc
+        (kênh, người gửi, thời gian) và chỉ MAX_CANDIDATES tin mới nhất trong số đó được xét. since/until phải đọc được bằng timestamp_value().
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return 0, [], False
+        # Chỉ giữ lock để chụp kích thước hiện tại; các mảng chỉ được nối thêm nên phần đã chụp
+        # đọc được an toàn mà không chặn add() (add() chạy khi tracker đang giữ channel_lock)
+        with self._lock:
+            postings = [self._postings.get(term) for term in terms]
+            if any(p is None for p in postings):
+                return 0, [], False
+            ends = [len(p) for p in postings]
+            dfs = [self._df[term] for term in terms]
+            channel_id = sender_id = None
+            if channel is not None:
+                channel_id = self._channel_ids.get(channel)
+                if channel_id is None:
+                    return 0, [], False
+            if sender is not None:
+                sender_id = self._sender_ids.get(sender)
+                if sender_id is None:
+                    return 0, [], False
+            doc_count = len(self._doc_seq)
+            average_length = self._total_length / doc_count if doc_count else 0
+            channel_names = list(self._channel_names)
+        # Bắt đầu từ từ hiếm nhất, các từ còn lại chỉ được tra bằng tìm kiếm nhị phân
+        order = sorted(range(len(terms)), key=lambda i: ends[i])
+        rarest, end = postings[order[0]], ends[order[0]]
+        since_value = timestamp_value(since) if since else None
+        until_value = timestamp_value(until) if until else None
+        scored = []
+        candidates = 0
+        truncated = False
+        # Duyệt postings của từ hiếm nhất từ tin mới nhất; bộ lọc được áp dụng trước khi đếm
+        # MAX_CANDIDATES nên truy vấn có lọc không bị mất kết quả vì các tin mới không khớp lọc
+        position = end
+        while position > 0:
+            doc = rarest[position - 1]
+            run_start = bisect.bisect_left(rarest, doc, 0, position)
+            first_tf = position - run_start
+            position = run_start
+            if channel_id is not None and self._doc_channel[doc] != channel_id:
+                continue
+            if sender_id is not None and self._doc_sender[doc] != sender_id:
+                continue
+            if since_value is not None or until_value is not None:
+                moment = self._doc_timestamp[doc]
+                if (since_value is not None and moment < since_value) or (until_value is not None and moment > until_value):
+                    continue
+            if candidates == MAX_CANDIDATES:
+                # Còn tin khớp lọc chưa được xét
+                truncated = True
+                break
+            candidates += 1
+            frequencies = {order[0]: first_tf}
+            for i in order[1:]:
+                tf = self._term_frequency(postings[i], doc, ends[i])
+                if not tf:
+                    break
+                frequencies[i] = tf
+            else:
+                length_norm = 1 - BM25_B + BM25_B * self._doc_length[doc] / average_length if average_length else 1
+                score = 0.0
+                for i, tf in frequencies.items():
+                    df = min(dfs[i], doc_count)
+                    idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+                    score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+                scored.append((score, doc))
+        top = heapq.nlargest(offset + limit, scored)[offset:]
+        results = [{
+            "channel": channel_names[self._doc_channel[doc]],
+            "seq": self._doc_seq[doc],
+            "score": round(score, 4)
+        } for score, doc in top]
+        return len(scored), results, truncated
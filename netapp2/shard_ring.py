@@ -0,0 +1,30 @@
+# shard_ring.py
+import bisect
+import hashlib
+
+# Số điểm ảo của mỗi shard trên vòng băm, càng nhiều thì kênh chia càng đều
+VIRTUAL_NODES = 64
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8", "replace")).digest()[:8], "big")
+
+class HashRing:
+    """Vòng băm nhất quán (consistent hashing) dùng để chia kênh cho các shard của tracker.
+
+    Mỗi shard có VIRTUAL_NODES điểm trên vòng; một kênh thuộc về shard có điểm đầu tiên
+    đứng sau giá trị băm của tên kênh. Khi thêm/bớt shard chỉ khoảng 1/N số kênh đổi chủ.
+    """
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        self._points = []
+        self._owners = []
+        ring = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(virtual_nodes))
+        for point, node in ring:
+            self._points.append(point)
+            self._owners.append(node)
+
+    def owner(self, key):
+        """Trả về shard sở hữu key"""
+        if not self._points:
+            raise ValueError("Hash ring is empty")
+        idx = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[idx]
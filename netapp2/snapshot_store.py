@@ -0,0 +1,109 @@
+# snapshot_store.py
+import json
+import mmap
+import os
+import time
+import logging
+
+DATA_DIR = "data"
+SNAPSHOT_DIR = "snapshot"  # Thư mục con của data/, tách khỏi các file <kênh>.json/.log
+SNAPSHOT_MAGIC = b"NTSNAP1\n"
+MANIFEST_VERSION = 1
+
+class SnapshotStore:
+    """Snapshot gộp của mọi kênh trên tracker: một file dữ liệu và một manifest.
+
+    File dữ liệu (<tên>-<thế hệ>.snapshot) chứa lần lượt các khối JSON dạng cột của từng
+    kênh (mỗi trường tin nhắn là một mảng). Manifest (<tên>.manifest.json) nhỏ, chứa
+    host/members/seq của từng kênh và vị trí khối của kênh trong file dữ liệu. Khi khởi
+    động, file dữ liệu được mmap và chỉ những khối cần thiết mới được giải mã.
+    """
+    def __init__(self, name="tracker", data_dir=DATA_DIR):
+        self.name = name
+        self.dir = os.path.join(data_dir, SNAPSHOT_DIR)
+        self.manifest_path = os.path.join(self.dir, f"{name}.manifest.json")
+        self.manifest = None
+        self._file = None
+        self._mmap = None
+
+    def write(self, states):
+        """Ghi snapshot mới từ các state (dict của Channel.snapshot_state) rồi thay manifest một cách nguyên tử"""
+        os.makedirs(self.dir, exist_ok=True)
+        snapshot_name = f"{self.name}-{time.time_ns()}.snapshot"
+        snapshot_path = os.path.join(self.dir, snapshot_name)
+        entries = {}
+        with open(snapshot_path + ".tmp", "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            for state in states:
+                # Kênh không được nạp vào bộ nhớ mang sẵn khối cũ ("blob"), chép nguyên khối
+                blob = state.pop("blob", None)
+                if blob is None:
+                    blob = json.dumps(state.pop("columns"), separators=(",", ":")).encode()
+                state["offset"] = f.tell()
+                state["length"] = len(blob)
+                f.write(blob)
+                entries[state.pop("name")] = state
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "snapshot": snapshot_name,
+            "created": time.time(),
+            "channels": entries
+        }
+        with open(self.manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+        # Các file dữ liệu cũ không còn được manifest nào trỏ tới
+        # (trên Linux file đang được mmap vẫn đọc được sau khi bị xoá)
+        for filename in os.listdir(self.dir):
+            if filename.startswith(f"{self.name}-") and filename != snapshot_name:
+                try:
+                    os.remove(os.path.join(self.dir, filename))
+                except OSError:
+                    pass
+        logging.info(f"[Snapshot] Wrote {snapshot_name} with {len(entries)} channels")
+        return manifest
+
+    def open(self):
+        """Đọc manifest và mmap file dữ liệu; trả về dict kênh -> mục manifest (rỗng nếu chưa có snapshot)"""
+        self.close()
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("version") != MANIFEST_VERSION:
+                logging.warning(f"[Snapshot] Unsupported manifest version {manifest.get('version')}, ignoring")
+                return {}
+            self._file = open(os.path.join(self.dir, manifest["snapshot"]), "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._mmap[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError("Invalid snapshot file")
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError, OSError) as e:
+            logging.error(f"[Snapshot] Cannot open snapshot, falling back to channel files: {e}")
+            self.close()
+            return {}
+        self.manifest = manifest
+        return manifest["channels"]
+
+    def read_blob(self, entry):
+        """Bytes của khối dữ liệu một kênh (để chép sang snapshot mới mà không giải mã)"""
+        return self._mmap[entry["offset"]:entry["offset"] + entry["length"]]
+
+    def read_columns(self, entry):
+        """Giải mã khối dữ liệu dạng cột của một kênh từ file đã mmap"""
+        return json.loads(self.read_blob(entry))
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,87 @@
+# sync_scheduler.py
+import json
+import threading
+import time
+import logging
+
+SYNC_DELAY = 1.0  # Chờ chừng này giây sau thay đổi đầu tiên để gộp cả loạt tin vào một lần gửi
+SYNC_RETRY_DELAY = 5.0  # Chờ trước khi gửi lại khi tracker lỗi hoặc đang giới hạn tần suất
+SYNC_BATCH = 1000  # Số tin nhắn tối đa mỗi lệnh sync_channel
+
+class SyncScheduler:
+    """Gửi thay đổi của các kênh lên tracker ở nền, gộp nhiều thay đổi thành một lệnh mỗi kênh.
+
+    mark_dirty() chỉ ghi nhận tin nhắn mới của kênh; một thread nền chờ SYNC_DELAY giây từ thay
+    đổi đầu tiên rồi gửi một sync_channel chứa mọi tin đang chờ của từng kênh. Gửi lỗi thì tin
+    được giữ lại cho lần sau. send(lệnh) trả về phản hồi dạng str của tracker; channel_info(tên)
+    trả về (host, members) của kênh hoặc None nếu kênh không còn.
+    """
+    def __init__(self, send, channel_info, delay=SYNC_DELAY):
+        self.send = send
+        self.channel_info = channel_info
+        self.delay = delay
+        self._cond = threading.Condition()
+        self._dirty = {}  # tên kênh -> {id tin: dict tin nhắn} theo thứ tự thêm
+        self._due = None  # Thời điểm gửi lô kế tiếp
+        self._thread = None
+        self.uploads = 0
+
+    def mark_dirty(self, channel_name, message_dicts):
+        with self._cond:
+            pending = self._dirty.setdefault(channel_name, {})
+            for message in message_dicts:
+                pending[(message["sender"], message["timestamp"], message["content"])] = message
+            if self._due is None:
+                self._due = time.monotonic() + self.delay
+                self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tracker-sync", daemon=True)
+                self._thread.start()
+
+    def pending(self):
+        with self._cond:
+            return sum(len(messages) for messages in self._dirty.values())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._due is None or time.monotonic() < self._due:
+                    self._cond.wait(None if self._due is None else self._due - time.monotonic())
+                batch, self._dirty = self._dirty, {}
+                self._due = None
+            failed = {}
+            for channel_name, messages in batch.items():
+                messages = list(messages.values())
+                for start in range(0, len(messages), SYNC_BATCH):
+                    chunk = messages[start:start + SYNC_BATCH]
+                    if not self._upload(channel_name, chunk):
+                        failed.setdefault(channel_name, []).extend(messages[start:])
+                        break
+            if failed:
+                with self._cond:
+                    for channel_name, messages in failed.items():
+                        pending = self._dirty.setdefault(channel_name, {})
+                        # Tin đến sau lần thử này được giữ phía sau tin cũ
+                        restored = {(m["sender"], m["timestamp"], m["content"]): m for m in messages}
+                        restored.update(pending)
+                        self._dirty[channel_name] = restored
+                    retry_at = time.monotonic() + SYNC_RETRY_DELAY
+                    self._due = max(self._due or 0, retry_at)
+
+    def _upload(self, channel_name, messages):
+        info = self.channel_info(channel_name)
+        if info is None:
+            return True  # Kênh đã bị xoá cục bộ, không còn gì để gửi
+        host, members = info
+        data = {"name": channel_name, "host": host, "members": list(members), "messages": messages}
+        try:
+            response = (self.send(f"sync_channel {json.dumps(data)}") or "").strip()
+        except Exception as e:
+            logging.error(f"[Sync] Error syncing channel {channel_name} with tracker: {e}")
+            return False
+        if not response.startswith("OK"):
+            logging.warning(f"[Sync] Tracker rejected sync of channel {channel_name}: {response[:200]}")
+            return False
+        self.uploads += 1
+        logging.info(f"[Sync] Synced {len(messages)} messages of channel {channel_name} with tracker")
+        return True
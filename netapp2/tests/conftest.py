@@ -0,0 +1,79 @@
+# conftest.py
+import asyncio
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+# Các module cấu hình logging ra app.log / tracker.log của thư mục hiện tại khi được import;
+# trong test thì bỏ log đi để không ghi vào các file log của repo
+logging.basicConfig(handlers=[logging.NullHandler()])
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tracker
+from rate_limit import RateLimiter
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    """Mỗi test chạy trong một thư mục riêng (data/ của tracker và peer nằm ở đó)"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def fresh_tracker(monkeypatch):
+    """Trạng thái kênh, peer và journal của tracker mới cho mỗi test"""
+    monkeypatch.setattr(tracker, "channels", tracker.ChannelCache(tracker.CHANNEL_CACHE_MB * 1024 * 1024))
+    monkeypatch.setattr(tracker, "peer_registry", tracker.PeerRegistry())
+    monkeypatch.setattr(tracker, "peer_lock", tracker.peer_registry.lock)
+    monkeypatch.setattr(tracker, "replication_log", tracker.ReplicationLog())
+    monkeypatch.setattr(tracker, "search_index", tracker.SearchIndex())
+    monkeypatch.setattr(tracker, "search_indexed", {})
+    monkeypatch.setattr(tracker, "search_index_ready", False)
+    monkeypatch.setattr(tracker, "snapshot_store", None)
+    monkeypatch.setattr(tracker, "rate_limiter", RateLimiter(tracker.RATE_LIMITS))
+    monkeypatch.setattr(tracker, "liveness", tracker.LivenessMonitor(tracker.peer_registry, tracker.HEARTBEAT_TIMEOUT, tracker.PURGE_AFTER))
+    return tracker
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=5):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.02)
+
+@pytest.fixture
+def tracker_server(fresh_tracker):
+    """Chạy serve_async của tracker trên một port trống trong thread riêng; trả về port"""
+    port = free_port()
+    running = {}
+
+    async def main():
+        running["loop"] = asyncio.get_running_loop()
+        running["task"] = asyncio.current_task()
+        await tracker.serve_async(port, host="127.0.0.1")
+
+    def run():
+        # asyncio.run huỷ cả các kết nối còn mở trước khi đóng loop
+        try:
+            asyncio.run(main())
+        except asyncio.CancelledError:
+            pass
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    wait_for_port(port)
+    yield port
+    running["loop"].call_soon_threadsafe(running["task"].cancel)
+    thread.join(5)
@@ -0,0 +1,57 @@
+# test_channel_cache.py
+import tracker
+
+def message(name, i):
+    return {"sender": "alice", "content": f"{name}-{i}", "channel": name,
+            "timestamp": f"2026-01-01 00:00:{i:02d}.{i:06d}"}
+
+def add_channel(cache, name, count=50):
+    """Tạo kênh có count tin nhắn đã ghi xuống disk rồi đưa vào cache (giữ channel_lock)"""
+    channel = tracker.Channel(name, "alice")
+    cache[name] = channel
+    for i in range(count):
+        channel.add_message(message(name, i))
+    channel.save_to_disk()()
+    return channel
+
+def test_cold_channels_are_evicted_and_reloaded(fresh_tracker):
+    size = tracker.CHANNEL_OVERHEAD + 50 * tracker.message_size(tracker.Message.from_dict(message("a", 0)))
+    cache = tracker.ChannelCache(int(size * 1.5))
+    with tracker.channel_lock:
+        for name in ("a", "b", "c"):
+            add_channel(cache, name)
+        cache["c"]  # Kích thước của c được tính ở lần truy cập tiếp theo
+        assert [channel.name for channel in cache.loaded()] == ["c"]
+        assert cache.evictions == 2 and cache.total_bytes <= cache.budget
+        # Metadata của kênh bị evict vẫn thường trú
+        assert len(cache) == 3 and "a" in cache
+        assert cache.peek("a").message_count == 50
+
+        reloaded = cache["a"]
+        assert cache.loads == 1
+        assert [m.content for m in reloaded.messages] == [f"a-{i}" for i in range(50)]
+        assert [channel.name for channel in cache.loaded()] == ["a"]
+
+def test_recently_used_channel_is_kept(fresh_tracker):
+    cache = tracker.ChannelCache(1 << 30)
+    with tracker.channel_lock:
+        for name in ("a", "b", "c"):
+            add_channel(cache, name, count=5)
+        cache["a"]
+        cache.budget = cache.total_bytes - 1
+        add_channel(cache, "d", count=5)
+        # b là kênh ít dùng nhất sau khi a được truy cập lại
+        assert "b" not in [channel.name for channel in cache.loaded()]
+        assert "a" in [channel.name for channel in cache.loaded()]
+
+def test_discard_forgets_channel(fresh_tracker):
+    cache = tracker.ChannelCache(1 << 30)
+    with tracker.channel_lock:
+        add_channel(cache, "a", count=5)
+        add_channel(cache, "b", count=5)
+        cache["b"]
+        before = cache.total_bytes
+        assert cache.discard("a").name == "a"
+        assert "a" not in cache and len(cache) == 1
+        assert cache.total_bytes < before
+        assert cache.discard("a") is None
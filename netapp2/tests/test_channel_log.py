@@ -0,0 +1,106 @@
+# test_channel_log.py
+import json
+import threading
+import time
+
+import channel_log
+import tracker
+from channel_log import ChannelLog
+
+def test_commit_and_replay(data_dir):
+    log = ChannelLog("general")
+    for i in range(3):
+        log.append({"op": "message", "n": i})
+    log.commit()
+    assert [r["n"] for r in ChannelLog("general").replay()] == [0, 1, 2]
+
+def test_uncommitted_records_are_lost_and_torn_record_skipped(data_dir):
+    log = ChannelLog("general")
+    log.append({"n": 1})
+    log.commit()
+    log.append({"n": 2})  # Chưa commit khi "crash"
+    with open(log.log_path, "a", encoding="utf-8") as f:
+        f.write('{"n": 3, "torn')  # Dòng cuối ghi dở
+    assert ChannelLog("general").replay() == [{"n": 1}]
+
+def test_commit_upto_only_waits_for_its_records(data_dir):
+    log = ChannelLog("general")
+    ticket = log.append({"n": 1})
+    log.append({"n": 2})
+    log.commit(ticket)
+    assert log.appended == 2
+    # Lần ghi dẫn đầu gộp mọi bản ghi đang chờ
+    assert len(ChannelLog("general").replay()) == 2
+
+def test_concurrent_commits_share_fsyncs(data_dir, monkeypatch):
+    fsyncs = []
+
+    def slow_fsync(fd):
+        fsyncs.append(fd)
+        time.sleep(0.02)
+    monkeypatch.setattr(channel_log.os, "fsync", slow_fsync)
+    log = ChannelLog("general")
+    lock = threading.Lock()
+
+    def writer(i):
+        with lock:
+            ticket = log.append({"n": i})
+        log.commit(ticket)
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(r["n"] for r in ChannelLog("general").replay()) == list(range(20))
+    assert len(fsyncs) < 20
+
+def test_compact_writes_snapshot_and_truncates_log(data_dir):
+    log = ChannelLog("general")
+    log.append({"n": 1})
+    log.compact({"name": "general", "messages": []})
+    assert log.records_since_snapshot == 0
+    assert ChannelLog("general").replay() == []
+    assert ChannelLog("general").read_snapshot() == {"name": "general", "messages": []}
+
+def test_open_log_files_are_capped(data_dir, monkeypatch):
+    monkeypatch.setattr(channel_log, "MAX_OPEN_LOGS", 3)
+    monkeypatch.setattr(channel_log, "_open_logs", channel_log.OrderedDict())
+    logs = [ChannelLog(f"c{i}") for i in range(10)]
+    for round_ in range(2):
+        for log in logs:
+            log.append({"round": round_})
+            log.commit()
+            assert len(channel_log._open_logs) <= 3
+    assert sum(log._file is not None for log in logs) <= 3
+    for log in logs:
+        assert [r["round"] for r in ChannelLog(log.channel_name).replay()] == [0, 1]
+
+def test_channel_recovers_from_snapshot_and_log(fresh_tracker, monkeypatch):
+    monkeypatch.setattr(channel_log, "COMPACT_MIN_RECORDS", 5)
+    channel = tracker.Channel("general", "alice")
+    for i in range(12):
+        channel.add_message({"sender": "alice", "content": f"m{i}", "channel": "general",
+                             "timestamp": f"2026-01-01 00:00:{i:02d}"})
+        channel.save_to_disk()()
+    channel.add_member("bob")
+    channel.save_to_disk()()
+    # Đã compact ít nhất một lần, phần sau nằm trong log
+    assert ChannelLog("general").read_snapshot() is not None
+
+    restored = tracker.Channel.load_from_disk("general")
+    assert [m.content for m in restored.messages] == [f"m{i}" for i in range(12)]
+    assert restored.members == {"alice", "bob"}
+    assert restored.seq == channel.seq
+    assert restored.meta_seq == channel.meta_seq
+
+def test_sync_channel_commits_outside_channel_lock(fresh_tracker, monkeypatch):
+    held = []
+
+    def fsync(fd):
+        held.append(tracker.channel_lock._lock._is_owned())
+    monkeypatch.setattr(channel_log.os, "fsync", fsync)
+    data = {"name": "general", "host": "alice", "members": ["alice"],
+            "messages": [{"sender": "alice", "content": "hi", "channel": "general", "timestamp": "2026-01-01 00:00:00"}]}
+    assert tracker.dispatch_request(f"sync_channel {json.dumps(data)}", "127.0.0.1").startswith(b"OK")
+    assert held == [False]
+    assert len(ChannelLog("general").replay()) == 2  # create + message
@@ -0,0 +1,40 @@
+# test_channel_merge.py
+import random
+
+import tracker
+
+def make_message(i, second):
+    return {"sender": f"user{i % 3}", "content": f"m{i}", "channel": "general",
+            "timestamp": f"2026-01-01 00:{second // 60:02d}:{second % 60:02d}"}
+
+def check_sorted(channel):
+    keys = [(m.timestamp, m.id) for m in channel.messages]
+    assert keys == sorted(keys)
+    assert channel._sort_keys == keys
+    assert [m.seq for m in channel._by_seq] == channel._seq_keys == sorted(channel._seq_keys)
+
+def test_bulk_merge_interleaves_and_dedupes(fresh_tracker):
+    channel = tracker.Channel("general", "alice")
+    existing = [make_message(i, 2 * i) for i in range(100)]
+    assert channel.merge_messages(existing) == 100
+    # Lô lớn chen giữa các tin cũ, có tin trùng và trùng trong cùng lô
+    batch = [make_message(1000 + i, 2 * i + 1) for i in range(100)] + existing[:10]
+    batch += batch[:5]
+    random.Random(1).shuffle(batch)
+    assert channel.merge_messages(batch) == 100
+    assert len(channel.messages) == 200
+    check_sorted(channel)
+
+def test_small_batches_insert_in_place(fresh_tracker):
+    channel = tracker.Channel("general", "alice")
+    assert channel.merge_messages([make_message(i, 59 - i) for i in range(tracker.MERGE_INSERT_MAX)]) == tracker.MERGE_INSERT_MAX
+    channel.add_message(make_message(999, 0))
+    check_sorted(channel)
+
+def test_bulk_merge_survives_replay(fresh_tracker):
+    channel = tracker.Channel("general", "alice")
+    channel.merge_messages([make_message(i, 500 - i) for i in range(200)])
+    channel.save_to_disk()()
+    restored = tracker.Channel.load_from_disk("general")
+    assert [m.id for m in restored.messages] == [m.id for m in channel.messages]
+    check_sorted(restored)
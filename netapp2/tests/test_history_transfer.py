@@ -0,0 +1,203 @@
+# test_history_transfer.py
+import json
+import socket
+import threading
+
+import pytest
+
+from data_manager import Channel, Message
+from protocol import MessageReader, send_frame
+
+@pytest.fixture
+def peer(monkeypatch):
+    """thread_server với DataManager mới (data/ nằm trong thư mục của test)"""
+    import data_manager
+    import thread_server
+    monkeypatch.setattr(data_manager.DataManager, "_instance", None)
+    monkeypatch.setattr(thread_server, "data_manager", data_manager.DataManager())
+    monkeypatch.setattr(thread_server, "history_transfers", {})
+    monkeypatch.setattr(thread_server, "HISTORY_RESUME_AFTER", 3600)
+    return thread_server
+
+def make_channel(name, count, same_timestamp_every=1):
+    channel = Channel(name, "alice")
+    channel.messages = [
+        Message("alice", f"m{i}", name, f"2024-01-01 00:00:{i // same_timestamp_every:06d}", "sent")
+        for i in range(count)
+    ]
+    return channel
+
+def count_saves(peer, monkeypatch):
+    saves = []
+    save_channel = peer.data_manager.save_channel
+    def counting(channel_name):
+        saves.append(channel_name)
+        save_channel(channel_name)
+    monkeypatch.setattr(peer.data_manager, "save_channel", counting)
+    return saves
+
+class Receiver:
+    """Bên nhận giả: áp dụng mọi thông điệp lịch sử bằng handler của thread_server và xác nhận chunk"""
+    def __init__(self, peer, stop_after=None):
+        self.peer = peer
+        self.stop_after = stop_after
+        self.received = []
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(8)
+        self.info = {"username": "bob", "ip": "127.0.0.1", "port": self.server.getsockname()[1]}
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            with conn:
+                reader = MessageReader(conn)
+                while True:
+                    payload, _ = reader.read_message()
+                    if payload is None:
+                        break
+                    data = json.loads(payload)
+                    self.received.append(data)
+                    if data["type"] == "channel_history":
+                        self.peer.handle_message_channel_history(data)
+                    elif data["type"] == "channel_history_chunk":
+                        if self.stop_after is not None and data["seq"] >= self.stop_after:
+                            break
+                        send_frame(conn, self.peer.handle_message_channel_history_chunk(data, "bob"))
+
+    def close(self):
+        self.server.close()
+
+def test_chunked_history_saves_every_n_chunks(peer, monkeypatch):
+    monkeypatch.setattr(peer, "HISTORY_CHUNK", 10)
+    monkeypatch.setattr(peer, "HISTORY_SAVE_EVERY", 4)
+    peer.data_manager.create_channel("general", "alice")
+    saves = count_saves(peer, monkeypatch)
+    receiver = Receiver(peer)
+    try:
+        assert peer.send_channel_history(receiver.info, make_channel("general", 95)) is True
+    finally:
+        receiver.close()
+    chunks = [data for data in receiver.received if data["type"] == "channel_history_chunk"]
+    assert len(chunks) == 10 and chunks[-1]["final"]
+    # 10 chunk có tin mới: ghi sau chunk thứ 4, thứ 8 và chunk cuối
+    assert saves == ["general"] * 3
+    channel = peer.data_manager.get_channel("general")
+    assert [msg.content for msg in channel.messages] == [f"m{i}" for i in range(95)]
+    assert "general" not in peer.history_transfers
+
+def test_resume_after_key_sends_only_later_messages(peer, monkeypatch):
+    monkeypatch.setattr(peer, "HISTORY_CHUNK", 10)
+    # Ba tin cùng timestamp: gửi tiếp theo timestamp sẽ gửi lại, theo khoá thì không thiếu không trùng
+    channel = make_channel("general", 60, same_timestamp_every=3)
+    receiver = Receiver(peer, stop_after=2)
+    try:
+        assert peer.send_channel_history(receiver.info, channel, transfer_id="t1") is False
+        after = peer.history_transfers["general"]["after"]
+        assert after == list(peer.history_key(sorted(channel.messages, key=peer.history_key)[19]))
+
+        receiver.stop_after = None
+        receiver.received.clear()
+        assert peer.send_channel_history(receiver.info, channel, after=after, transfer_id="t1") is True
+    finally:
+        receiver.close()
+    assert receiver.received[0]["total"] == 40
+    received = peer.data_manager.get_channel("general").messages
+    assert sorted(msg.content for msg in received) == sorted(msg.content for msg in channel.messages)
+
+def test_legacy_receiver_gets_single_channel_history(peer):
+    local = peer.data_manager.create_channel("general", "alice")
+    local.messages = [Message("bob", "local", "general", "2024-01-01 00:00:000005", "sent")]
+    receiver = Receiver(peer)
+    try:
+        assert peer.send_channel_history(receiver.info, make_channel("general", 10), chunked=False) is True
+        receiver.thread.join(timeout=0.5)
+    finally:
+        receiver.close()
+    assert [data["type"] for data in receiver.received] == ["channel_history"]
+    contents = [msg.content for msg in peer.data_manager.get_channel("general").messages]
+    # Tin chỉ có ở bên nhận được giữ lại và nằm đúng vị trí theo timestamp
+    assert len(contents) == 11 and contents.index("local") == 5
+
+def test_merge_history_interleaves_and_skips_known(peer):
+    channel = make_channel("general", 6)
+    older = channel.messages[::2]
+    channel.messages = list(older)
+    keys = {peer.history_key(msg) for msg in channel.messages}
+    incoming = [msg.to_dict() for msg in make_channel("general", 6).messages]
+    assert peer.merge_history(channel, incoming, keys) == 3
+    assert [msg.content for msg in channel.messages] == [f"m{i}" for i in range(6)]
+    assert peer.merge_history(channel, incoming, keys) == 0
+
+def test_request_history_does_not_block_peer_worker(peer, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    def slow_send(peer_info, channel, after, transfer_id, chunked):
+        started.set()
+        release.wait(5)
+        return True
+    monkeypatch.setattr(peer, "send_channel_history", slow_send)
+    monkeypatch.setattr(peer, "history_senders", None)
+    future = peer.submit_channel_history({"username": "bob"}, make_channel("general", 1))
+    try:
+        assert started.wait(2)
+        assert not future.done()
+    finally:
+        release.set()
+    assert future.result(timeout=2) is True
+
+def test_merge_history_keeps_distinct_messages_with_same_timestamp(peer):
+    channel = Channel("general", "alice")
+    channel.messages = [Message("alice", "hi", "general", "2024-01-01 00:00:01", "sent")]
+    incoming = [{"sender": sender, "content": content, "channel": "general", "timestamp": "2024-01-01 00:00:01"}
+                for sender, content in (("alice", "hi"), ("bob", "hi"), ("alice", "again"))]
+    assert peer.merge_history(channel, incoming, {peer.history_key(msg) for msg in channel.messages}) == 2
+    assert sorted((msg.sender, msg.content) for msg in channel.messages) == [("alice", "again"), ("alice", "hi"), ("bob", "hi")]
+
+def test_chunks_reuse_one_watcher_and_save_outside_locks(peer, monkeypatch):
+    monkeypatch.setattr(peer, "HISTORY_CHUNK", 5)
+    monkeypatch.setattr(peer, "HISTORY_SAVE_EVERY", 2)
+    def no_timer(*args, **kwargs):
+        raise AssertionError("history transfer must not start a Timer per chunk")
+    monkeypatch.setattr(peer.threading, "Timer", no_timer)
+    peer.data_manager.create_channel("general", "alice")
+    locks_held = []
+    save_channel = peer.data_manager.save_channel
+    def checking(channel_name):
+        locks_held.append(peer.history_lock.locked() or peer.history_channel_lock(channel_name).locked())
+        save_channel(channel_name)
+    monkeypatch.setattr(peer.data_manager, "save_channel", checking)
+    receiver = Receiver(peer)
+    try:
+        assert peer.send_channel_history(receiver.info, make_channel("general", 50)) is True
+    finally:
+        receiver.close()
+    assert locks_held == [False] * 5
+    assert [t.name for t in threading.enumerate()].count("history-watcher") == 1
+
+def test_watcher_resumes_stalled_transfer(peer, monkeypatch):
+    monkeypatch.setattr(peer, "HISTORY_CHUNK", 10)
+    monkeypatch.setattr(peer, "HISTORY_RESUME_AFTER", 0.2)
+    monkeypatch.setattr(peer, "HISTORY_WATCH_INTERVAL", 0.05)
+    requests = []
+    resumed = threading.Event()
+    def fake_send(ip, port, payload):
+        requests.append(json.loads(payload))
+        resumed.set()
+        return True
+    monkeypatch.setattr(peer, "send_to_peer", fake_send)
+    monkeypatch.setattr(peer.peer_directory, "get", lambda username: {"username": username, "ip": "127.0.0.1", "port": 1})
+    receiver = Receiver(peer, stop_after=1)
+    try:
+        assert peer.send_channel_history(receiver.info, make_channel("general", 30), transfer_id="t1") is False
+    finally:
+        receiver.close()
+    assert resumed.wait(3)
+    assert requests[0]["type"] == "request_history" and requests[0]["transfer"] == "t1"
+    assert requests[0]["after"] == list(peer.history_key(make_channel("general", 30).messages[9]))
+    # Phần đã nhận được ghi xuống disk khi xin gửi tiếp
+    assert peer.history_transfers["general"]["unsaved"] == 0
@@ -0,0 +1,156 @@
+# test_protocol.py
+import asyncio
+import socket
+import threading
+
+import pytest
+
+import protocol
+from protocol import MessageReader, Session, encode_frame, encode_reply, encode_request, read_message_async, request
+
+class RawServer:
+    """Server thử nghiệm: mỗi kết nối đọc một message, ghi lại rồi gọi reply(payload, framed, conn)"""
+    def __init__(self, reply):
+        self.reply = reply
+        self.received = []
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.addr = self.sock.getsockname()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                payload, framed = MessageReader(conn).read_message()
+                self.received.append((payload, framed))
+                self.reply(payload, framed, conn)
+
+    def close(self):
+        self.sock.close()
+
+@pytest.fixture
+def legacy_hosts(monkeypatch):
+    hosts = set()
+    monkeypatch.setattr(protocol, "_legacy_hosts", hosts)
+    return hosts
+
+def test_encode_reply_matches_request_framing():
+    for framed in (False, True, 42):
+        sock_a, sock_b = socket.socketpair()
+        with sock_a, sock_b:
+            sock_a.sendall(encode_reply(b"OK\n", framed))
+            assert MessageReader(sock_b).read_message() == (b"OK", framed)
+
+def test_request_does_not_resend_or_downgrade_when_server_closes(legacy_hosts):
+    server = RawServer(lambda payload, framed, conn: None)
+    try:
+        assert request(server.addr, "send_info 1.2.3.4") is None
+        assert server.received == [(b"send_info 1.2.3.4", True)]
+        assert legacy_hosts == set()
+    finally:
+        server.close()
+
+def test_request_switches_to_lines_after_a_line_reply(legacy_hosts):
+    server = RawServer(lambda payload, framed, conn: conn.sendall(b"pong\n"))
+    try:
+        assert request(server.addr, "ping") == "pong"
+        assert legacy_hosts == {server.addr}
+        assert request(server.addr, "ping") == "pong"
+        assert server.received == [(b"ping", True), (b"ping", False)]
+    finally:
+        server.close()
+
+def test_request_keeps_frames_after_a_framed_reply(legacy_hosts):
+    server = RawServer(lambda payload, framed, conn: conn.sendall(encode_reply(b"pong", framed)))
+    try:
+        assert request(server.addr, "ping") == "pong"
+        assert legacy_hosts == set()
+    finally:
+        server.close()
+
+def test_malformed_send_info_gets_an_error_reply(tracker_server, legacy_hosts):
+    addr = ("127.0.0.1", tracker_server)
+    assert request(addr, "send_info 127.0.0.1").startswith("ERROR: Usage: send_info")
+    assert legacy_hosts == set()
+    assert request(addr, "ping") == "pong"
+
+def test_session_marks_line_only_server_unsupported():
+    server = RawServer(lambda payload, framed, conn: conn.sendall(b"ERROR: Request too large or malformed\n"))
+    try:
+        session = Session(server.addr)
+        with pytest.raises(ConnectionResetError):
+            session.request("ping", timeout=5)
+        assert not session.supported
+    finally:
+        server.close()
+
+def test_session_stays_supported_when_server_closes_without_reply():
+    server = RawServer(lambda payload, framed, conn: None)
+    try:
+        session = Session(server.addr)
+        with pytest.raises(ConnectionResetError):
+            session.request("ping", timeout=5)
+        assert session.supported
+    finally:
+        server.close()
+
+def test_session_survives_a_failing_pipelined_request(tracker_server):
+    session = Session(("127.0.0.1", tracker_server))
+    results = {}
+
+    def call(name, command):
+        results[name] = session.request(command, timeout=5)
+    threads = [threading.Thread(target=call, args=(f"bad{i}", "send_info x")) for i in range(5)]
+    threads += [threading.Thread(target=call, args=(f"ping{i}", "ping")) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    session.close()
+    assert all(results[f"bad{i}"].startswith("ERROR") for i in range(5))
+    assert all(results[f"ping{i}"] == "pong" for i in range(5))
+    assert session.supported
+
+def test_session_matches_out_of_order_replies():
+    server_sock = socket.socket()
+    server_sock.bind(("127.0.0.1", 0))
+    server_sock.listen()
+
+    def serve():
+        conn, _ = server_sock.accept()
+        with conn:
+            reader = MessageReader(conn)
+            first = reader.read_message()
+            second = reader.read_message()
+            # Trả lời lệnh thứ hai trước
+            for payload, request_id in (second, first):
+                conn.sendall(encode_request(request_id, b"re:" + payload))
+            reader.read_message()
+    threading.Thread(target=serve, daemon=True).start()
+
+    session = Session(server_sock.getsockname())
+    results = {}
+    threads = [threading.Thread(target=lambda c=c: results.__setitem__(c, session.request(c, timeout=5))) for c in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    session.close()
+    server_sock.close()
+    assert results == {"a": "re:a", "b": "re:b"}
+
+def test_async_reader_reads_messages_larger_than_buffer_limit():
+    async def read_all():
+        reader = asyncio.StreamReader(limit=64 * 1024)
+        frame, line = b"f" * (1 << 20), b"l" * (200 * 1024)
+        reader.feed_data(encode_frame(frame) + line + b"\n")
+        reader.feed_eof()
+        first = await read_message_async(reader)
+        second = await read_message_async(reader)
+        return first[0] == frame, second[0] == line
+    assert asyncio.run(read_all()) == (True, True)
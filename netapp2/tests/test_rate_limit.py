@@ -0,0 +1,109 @@
+# test_rate_limit.py
+import socket
+
+import rate_limit
+import tracker
+from protocol import MessageReader, send_frame
+from rate_limit import RateLimiter
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_token_bucket_burst_refill_and_retry_delay(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    limiter = RateLimiter({"read": (2, 3)})
+    assert [limiter.acquire("a", "read") for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire("a", "read") == 0.5  # Thiếu một token, nạp 2 token mỗi giây
+    assert limiter.acquire("b", "read") == 0  # Bucket riêng cho mỗi client
+    assert limiter.acquire("a", "unlimited") == 0
+    clock.now += 0.5
+    assert limiter.acquire("a", "read") == 0
+    assert limiter.acquire("a", "read") > 0
+    clock.now += 100
+    assert [limiter.acquire("a", "read") for _ in range(4)][:3] == [0, 0, 0]  # Không vượt burst
+    assert limiter.rejected == 3
+
+def test_idle_buckets_are_swept(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    limiter = RateLimiter({"read": (1, 1)}, idle_after=10)
+    for client in range(5):
+        limiter.acquire(client, "read")
+    assert len(limiter) == 5
+    clock.now += 11
+    limiter.acquire("new", "read")
+    assert len(limiter) == 1
+
+def register(ip, port, username):
+    with tracker.peer_lock:
+        tracker.peer_registry.add(tracker.Peer(ip, str(port), username, "online"))
+
+def test_buckets_follow_registered_peer_identity(fresh_tracker, monkeypatch):
+    monkeypatch.setattr(tracker, "rate_limiter", RateLimiter({"read": (0.001, 2), "cheap": (0.001, 100)}))
+    register("10.0.0.1", 5001, "alice")
+    register("10.0.0.1", 5002, "bob")
+    alice, bob = tracker.ClientIdentity("10.0.0.1"), tracker.ClientIdentity("10.0.0.1")
+    assert tracker.admission_delay("heartbeat 10.0.0.1 5001", alice) == 0
+    assert tracker.admission_delay("heartbeat 10.0.0.1 5002", bob) == 0
+    assert alice.key == "10.0.0.1:5001"
+    assert [tracker.admission_delay("get_list", alice) > 0 for _ in range(3)] == [False, False, True]
+    assert tracker.admission_delay("get_list", bob) == 0  # Cùng IP, peer khác
+
+    anonymous = tracker.ClientIdentity("10.0.0.1")
+    assert [tracker.admission_delay("get_list", anonymous) > 0 for _ in range(3)] == [False, False, True]
+
+def test_replicate_does_not_exempt_other_commands(fresh_tracker, monkeypatch):
+    monkeypatch.setattr(tracker, "rate_limiter", RateLimiter({"read": (0.001, 3)}))
+    client = tracker.ClientIdentity("10.0.0.9")
+    assert tracker.admission_delay("replicate x", client) == 0
+    assert all(tracker.admission_delay("replicate None 0", client) == 0 for _ in range(10))
+    assert [tracker.admission_delay("list_channels", client) > 0 for _ in range(4)] == [False, False, False, True]
+
+def test_rotating_unregistered_ports_keeps_ip_bucket(fresh_tracker, monkeypatch):
+    monkeypatch.setattr(tracker, "rate_limiter", RateLimiter({"read": (0.001, 3), "cheap": (0.001, 100)}))
+    client = tracker.ClientIdentity("10.0.0.7")
+    delays = []
+    for port in range(7000, 7010):
+        tracker.admission_delay(f"heartbeat 10.0.0.7 {port}", client)
+        delays.append(tracker.admission_delay("list_channels", client))
+    assert client.key == "10.0.0.7"
+    assert delays[:3] == [0, 0, 0] and all(delay > 0 for delay in delays[3:])
+
+    # Peer đã đăng ký ở IP khác không cho bucket mới
+    register("10.0.0.8", 7100, "mallory")
+    tracker.admission_delay("heartbeat 10.0.0.8 7100", client)
+    assert client.key == "10.0.0.7"
+
+def request(sock, reader, command):
+    send_frame(sock, command)
+    return reader.read_message()[0].decode()
+
+def test_peers_behind_one_address_are_limited_separately(tracker_server, monkeypatch):
+    monkeypatch.setattr(tracker, "rate_limiter", RateLimiter({"read": (0.001, 3), "cheap": (0.001, 100), "write": (0.001, 100)}))
+    conns = []
+    for port in (6001, 6002):
+        sock = socket.create_connection(("127.0.0.1", tracker_server), timeout=5)
+        reader = MessageReader(sock)
+        request(sock, reader, f"send_info 127.0.0.1 {port} user{port} online")
+        assert request(sock, reader, f"heartbeat 127.0.0.1 {port}").strip() == "pong"
+        conns.append((sock, reader))
+    first, second = conns
+    replies = [request(*first, "list_channels") for _ in range(4)]
+    assert replies[-1].startswith("RETRY_AFTER")
+    assert not request(*second, "list_channels").startswith("RETRY_AFTER")
+    for sock, _ in conns:
+        sock.close()
+
+def test_replicate_then_flood_is_limited(tracker_server, monkeypatch):
+    monkeypatch.setattr(tracker, "rate_limiter", RateLimiter({"read": (0.001, 3)}))
+    sock = socket.create_connection(("127.0.0.1", tracker_server), timeout=5)
+    reader = MessageReader(sock)
+    assert request(sock, reader, "replicate x").startswith("ERROR")
+    replies = [request(sock, reader, "list_channels") for _ in range(5)]
+    assert [reply.startswith("RETRY_AFTER") for reply in replies] == [False, False, False, True, True]
+    sock.close()
@@ -0,0 +1,81 @@
+# test_replication.py
+import os
+import threading
+
+import tracker
+from conftest import free_port
+
+def message(i):
+    return {"sender": "alice", "content": f"m{i}", "channel": "general", "timestamp": f"2026-01-01 00:00:{i:02d}", "seq": i + 2}
+
+class FakePrimary(tracker.StandbyReplicator):
+    """Trả lời get_channel từ dữ liệu có sẵn thay vì kết nối tới primary"""
+    def __init__(self, pages):
+        super().__init__(("127.0.0.1", 1))
+        self.pages = pages
+
+    def _call(self, command):
+        assert command.startswith("get_channel ")
+        return self.pages[command.split()[1]]
+
+def test_resync_replaces_data_and_drops_missing_channels(fresh_tracker, monkeypatch):
+    monkeypatch.setattr(tracker, "standby_of", ("127.0.0.1", 1))
+    with tracker.channel_lock:
+        for name in ("general", "gone"):
+            channel = tracker.Channel(name, "bob")
+            tracker.channels[name] = channel
+            channel.save_to_disk()()
+    assert os.path.exists("data/gone.log")
+
+    page = {"name": "general", "host": "alice", "members": ["alice", "carol"], "seq": 7, "meta_seq": 1,
+            "messages": [message(i) for i in range(5)], "next": None}
+    replicator = FakePrimary({"general": page})
+    replicator.resync({"epoch": "e1", "seq": 42, "channels": ["general"],
+                       "peers": [{"ip": "10.0.0.1", "port": 5000, "username": "alice", "status": "online"}]})
+
+    assert (replicator.epoch, replicator.seq) == ("e1", 42)
+    assert "gone" not in tracker.channels
+    assert not os.path.exists("data/gone.log") and not os.path.exists("data/gone.json")
+    with tracker.channel_lock:
+        general = tracker.channels["general"]
+        assert general.host == "alice" and general.members == {"alice", "carol"}
+        assert [m.content for m in general.messages] == [f"m{i}" for i in range(5)]
+    assert tracker.peer_registry.get_by_username("alice").ip == "10.0.0.1"
+
+    # Sau khi khởi động lại, kênh đã xoá không quay lại từ snapshot gộp
+    monkeypatch.setattr(tracker, "channels", tracker.ChannelCache(1 << 30))
+    monkeypatch.setattr(tracker, "snapshot_store", None)
+    tracker.load_channels()
+    assert list(tracker.channels) == ["general"]
+
+def test_apply_replays_records_without_archiving(fresh_tracker, monkeypatch):
+    monkeypatch.setattr(tracker, "standby_of", ("127.0.0.1", 1))
+    monkeypatch.setattr(tracker, "RETENTION_MESSAGES", 2)
+    monkeypatch.setattr(tracker, "ARCHIVE_BATCH", 1)
+    records = [{"channel": "general", "record": {"op": "create", "host": "alice", "seq": 1}}]
+    records += [{"channel": "general", "record": {"op": "message", "message": message(i)}} for i in range(5)]
+    replicator = tracker.StandbyReplicator(("127.0.0.1", 1))
+    replicator.apply(records)
+    replicator.apply(records)  # Bản ghi đã áp dụng bị bỏ qua
+
+    with tracker.channel_lock:
+        channel = tracker.channels["general"]
+        assert len(channel.messages) == 5
+        assert channel.archived_seq == 0
+    assert not os.path.exists(os.path.join("data", "archive", "general"))
+    restored = tracker.Channel.load_from_disk("general")
+    assert restored.seq == channel.seq and len(restored.messages) == 5
+
+def test_standby_promotes_when_primary_is_unreachable(fresh_tracker, monkeypatch):
+    primary = ("127.0.0.1", free_port())
+    monkeypatch.setattr(tracker, "standby_of", primary)
+    monkeypatch.setattr(tracker, "PROMOTE_AFTER", 0.3)
+    replicator = tracker.StandbyReplicator(primary)
+    thread = threading.Thread(target=replicator.run, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert tracker.standby_of is None
+    # Sau khi promote, tracker nhận lệnh ghi
+    reply = tracker.dispatch_request('sync_channel {"name": "general", "host": "alice", "members": [], "messages": []}', "127.0.0.1")
+    assert reply.startswith(b"OK")
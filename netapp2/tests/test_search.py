@@ -0,0 +1,86 @@
+# test_search.py
+import json
+import math
+
+import search_index
+import tracker
+from search_index import SearchIndex
+
+def test_bm25_ranks_rarer_terms_and_shorter_documents_higher():
+    index = SearchIndex()
+    index.add("general", 1, "alice", "2026-01-01 00:00:01", "deploy the tracker today")
+    index.add("general", 2, "bob", "2026-01-01 00:00:02", "deploy")
+    index.add("general", 3, "bob", "2026-01-01 00:00:03", "the tracker is down")
+    total, results, truncated = index.search("deploy")
+    assert (total, truncated) == (2, False)
+    assert [r["seq"] for r in results] == [2, 1]
+    assert set(results[0]) == {"channel", "seq", "score"}
+    total, results, _ = index.search("deploy tracker")
+    assert [r["seq"] for r in results] == [1]
+
+def test_document_frequency_counts_documents_not_occurrences():
+    index = SearchIndex()
+    index.add("general", 1, "alice", "2026-01-01", "spam " * 50)
+    for seq in range(2, 6):
+        index.add("general", seq, "bob", "2026-01-01", f"hello {seq}")
+    _, results, _ = index.search("spam")
+    df, n = 1, 5
+    tf, length_norm = 50, 1 - 0.75 + 0.75 * 50 / (58 / 5)
+    expected = math.log(1 + (n - df + 0.5) / (df + 0.5)) * tf * 2.2 / (tf + 1.2 * length_norm)
+    assert results[0]["score"] == round(expected, 4)
+
+def test_filters_use_compact_columns():
+    index = SearchIndex()
+    index.add("general", 1, "alice", "2026-01-01 10:00:00", "hello world")
+    index.add("random", 2, "bob", "2026-01-02T10:00:00", "hello there")
+    index.add("general", 3, "bob", "2026-01-03 10:00:00.5", "hello again")
+    assert [r["seq"] for r in index.search("hello", channel="general")[1]] == [3, 1]
+    assert [r["seq"] for r in index.search("hello", sender="bob")[1]] == [3, 2]
+    assert [r["seq"] for r in index.search("hello", since="2026-01-02", until="2026-01-02 23:59")[1]] == [2]
+    assert index.search("hello", sender="carol")[0] == 0
+    assert not hasattr(index, "_doc_content")
+
+def test_filters_apply_before_candidate_cut(monkeypatch):
+    monkeypatch.setattr(search_index, "MAX_CANDIDATES", 5)
+    index = SearchIndex()
+    for seq in range(1, 4):
+        index.add("quiet", seq, "alice", "2026-01-01 00:00:00", "hello")
+    for seq in range(4, 24):
+        index.add("busy", seq, "bob", "2026-01-02 00:00:00", "hello")
+    # 20 tin mới hơn ở kênh khác không làm mất kết quả của kênh được lọc
+    total, results, truncated = index.search("hello", channel="quiet")
+    assert (total, truncated) == (3, False)
+    assert [(r["channel"], r["seq"]) for r in results] == [("quiet", 3), ("quiet", 2), ("quiet", 1)]
+    assert index.search("hello", sender="alice")[0] == 3
+    assert index.search("hello", until="2026-01-01 12:00")[0] == 3
+    total, results, truncated = index.search("hello", channel="busy")
+    assert (total, truncated) == (5, True)
+    assert [r["seq"] for r in results] == [23, 22, 21, 20, 19]
+
+def search(query):
+    return json.loads(tracker.dispatch_request("search " + json.dumps(query), "127.0.0.1"))
+
+def test_search_reads_content_from_hot_tier_and_archive(fresh_tracker, monkeypatch):
+    monkeypatch.setattr(tracker, "search_index_ready", True)
+    monkeypatch.setattr(tracker, "RETENTION_MESSAGES", 4)
+    monkeypatch.setattr(tracker, "ARCHIVE_BATCH", 2)
+    with tracker.channel_lock:
+        channel = tracker.Channel("general", "alice")
+        tracker.channels["general"] = channel
+        for i in range(10):
+            channel.add_message({"sender": "alice", "content": f"needle number {i}", "channel": "general",
+                                 "timestamp": f"2026-01-01 00:00:{i:02d}"})
+            channel.save_to_disk()()
+    assert channel.archived_seq > 0
+    reply = search({"q": "needle", "limit": 20})
+    assert reply["total"] == 10
+    assert sorted(r["content"] for r in reply["results"]) == sorted(f"needle number {i}" for i in range(10))
+    assert all(r["sender"] == "alice" and r["timestamp"].startswith("2026-01-01") for r in reply["results"])
+
+    # Tin của kênh đã bị xoá không được trả về
+    with tracker.channel_lock:
+        tracker.channels.discard("general")
+    assert search({"q": "needle"})["results"] == []
+
+def test_invalid_time_filter_is_rejected(fresh_tracker):
+    assert tracker.dispatch_request('search {"q": "x", "since": "yesterday"}', "127.0.0.1") == b"ERROR: Invalid since\n"
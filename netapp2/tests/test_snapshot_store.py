@@ -0,0 +1,80 @@
+# test_snapshot_store.py
+import os
+
+import tracker
+from snapshot_store import SNAPSHOT_DIR
+
+def message(name, i):
+    return {"sender": "alice", "content": f"{name}-{i}", "channel": name,
+            "timestamp": f"2026-01-01 00:00:{i:02d}.{i:06d}"}
+
+def populate(names, count=20):
+    with tracker.channel_lock:
+        for name in names:
+            channel = tracker.Channel(name, "alice")
+            tracker.channels[name] = channel
+            for i in range(count):
+                channel.add_message(message(name, i))
+            channel.save_to_disk()()
+
+def restart(monkeypatch):
+    """Bỏ trạng thái trong bộ nhớ rồi nạp lại như khi tracker khởi động"""
+    with tracker.channel_lock:
+        for channel in tracker.channels.loaded():
+            channel.log.close()
+    monkeypatch.setattr(tracker, "channels", tracker.ChannelCache(1 << 30))
+    tracker.load_channels()
+
+def test_startup_from_snapshot_is_lazy(fresh_tracker, monkeypatch):
+    populate(["a", "b"])
+    with tracker.channel_lock:
+        seqs = tracker.channels.seqs()
+    tracker.write_snapshot()
+
+    restart(monkeypatch)
+    with tracker.channel_lock:
+        assert tracker.channels.loaded() == []
+        assert tracker.channels.seqs() == seqs
+        assert tracker.channels.peek("b").message_count == 20
+        assert [m.content for m in tracker.channels["b"].messages] == [f"b-{i}" for i in range(20)]
+        assert [channel.name for channel in tracker.channels.loaded()] == ["b"]
+
+def test_channel_newer_than_snapshot_loads_from_its_files(fresh_tracker, monkeypatch):
+    populate(["a"])
+    tracker.write_snapshot()
+    populate(["late"], count=3)
+
+    restart(monkeypatch)
+    with tracker.channel_lock:
+        assert [channel.name for channel in tracker.channels.loaded()] == ["late"]
+        assert len(tracker.channels) == 2
+        assert len(tracker.channels["a"].messages) == 20
+
+def test_rewrite_copies_unloaded_channels_and_drops_old_file(fresh_tracker, monkeypatch):
+    populate(["a", "b"])
+    tracker.write_snapshot()
+    restart(monkeypatch)
+    with tracker.channel_lock:
+        tracker.channels["a"].add_message(message("a", 20))
+        tracker.channels["a"].save_to_disk()()
+    tracker.write_snapshot()
+
+    snapshot_dir = os.path.join("data", SNAPSHOT_DIR)
+    assert len([f for f in os.listdir(snapshot_dir) if f.endswith(".snapshot")]) == 1
+    restart(monkeypatch)
+    with tracker.channel_lock:
+        assert [m.content for m in tracker.channels["b"].messages] == [f"b-{i}" for i in range(20)]
+        assert len(tracker.channels["a"].messages) == 21
+
+def test_corrupt_snapshot_falls_back_to_channel_files(fresh_tracker, monkeypatch):
+    populate(["a", "b"])
+    tracker.write_snapshot()
+    snapshot_dir = os.path.join("data", SNAPSHOT_DIR)
+    [data_file] = [f for f in os.listdir(snapshot_dir) if f.endswith(".snapshot")]
+    with open(os.path.join(snapshot_dir, data_file), "r+b") as f:
+        f.write(b"garbage!")
+
+    restart(monkeypatch)
+    with tracker.channel_lock:
+        assert sorted(channel.name for channel in tracker.channels.loaded()) == ["a", "b"]
+        assert [m.content for m in tracker.channels["a"].messages] == [f"a-{i}" for i in range(20)]
@@ -0,0 +1,79 @@
+# test_status_fanout.py
+import json
+import socket
+import time
+
+import tracker
+from protocol import MessageReader
+
+def listener():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    server.settimeout(5)
+    return server, server.getsockname()[1]
+
+def read_update(reader):
+    payload, framed = reader.read_message()
+    assert framed
+    return json.loads(payload)
+
+def accept(server):
+    conn, _ = server.accept()
+    conn.settimeout(5)
+    return conn, MessageReader(conn)
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+def test_updates_skip_self_and_reconnect_after_eof(fresh_tracker):
+    server, port = listener()
+    bob = fresh_tracker.peer_registry.add(tracker.Peer("127.0.0.1", port, "bob", "online"))
+    alice = fresh_tracker.peer_registry.add(tracker.Peer("127.0.0.2", 1, "alice", "online"))
+    fanout = tracker.StatusFanout(workers=2, idle_timeout=60)
+    fanout.notify(bob)  # Không gửi trạng thái của bob cho chính bob
+    fanout.notify(alice)
+    conn, reader = accept(server)
+    assert read_update(reader)["username"] == "alice"
+
+    # Peer đóng kết nối rảnh: lần gửi sau phải mở kết nối mới thay vì ghi vào kết nối đã chết
+    conn.close()
+    fresh_tracker.peer_registry.update(alice, status="invisible")
+    fanout.notify(alice)
+    conn, reader = accept(server)
+    update = read_update(reader)
+    assert (update["username"], update["status"]) == ("alice", "invisible")
+    conn.close()
+    server.close()
+
+def test_burst_sends_latest_status_once(fresh_tracker):
+    server, port = listener()
+    fresh_tracker.peer_registry.add(tracker.Peer("127.0.0.1", port, "bob", "online"))
+    fanout = tracker.StatusFanout(workers=1, idle_timeout=60)
+    peers = [fresh_tracker.peer_registry.add(tracker.Peer("127.0.0.3", i, f"user{i}", "online")) for i in range(50)]
+    for peer in peers:
+        fanout.notify(peer)
+    conn, reader = accept(server)
+    seen = {}
+    while len(seen) < 50:
+        update = read_update(reader)
+        assert update["username"] not in seen
+        seen[update["username"]] = update["status"]
+    conn.close()
+    server.close()
+
+def test_idle_connections_are_swept_without_notify(fresh_tracker):
+    server, port = listener()
+    fresh_tracker.peer_registry.add(tracker.Peer("127.0.0.1", port, "bob", "online"))
+    alice = fresh_tracker.peer_registry.add(tracker.Peer("127.0.0.2", 1, "alice", "online"))
+    fanout = tracker.StatusFanout(workers=1, idle_timeout=0.2)
+    fanout.notify(alice)
+    conn, reader = accept(server)
+    read_update(reader)
+    wait_until(lambda: not fanout._conns)
+    assert conn.recv(1) == b""  # Tracker đã đóng kết nối
+    conn.close()
+    server.close()
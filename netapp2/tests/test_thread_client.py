@@ -0,0 +1,29 @@
+# test_thread_client.py
+import socket
+
+from conftest import free_port
+from protocol import MessageReader
+from thread_client import fan_out
+
+def test_fan_out_reports_each_peer_of_a_username():
+    servers = []
+    for _ in range(2):
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        server.settimeout(5)
+        servers.append(server)
+    dead_port = free_port()
+    peers = [{"username": "bob", "ip": "127.0.0.1", "port": server.getsockname()[1]} for server in servers]
+    peers.append({"username": "bob", "ip": "127.0.0.1", "port": dead_port})
+
+    results = fan_out(peers, "hello", timeout=2)
+    assert len(results) == 3
+    assert results[("bob", "127.0.0.1", dead_port)] is False
+    for server in servers:
+        assert results[("bob", "127.0.0.1", server.getsockname()[1])] is True
+        conn, _ = server.accept()
+        conn.settimeout(5)
+        assert MessageReader(conn).read_message() == (b"hello", True)
+        conn.close()
+        server.close()
@@ -0,0 +1,92 @@
+# test_tracker_server.py
+import socket
+import threading
+import time
+
+import tracker
+from protocol import MessageReader, encode_frame, encode_request
+
+def connect(port):
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    return sock, MessageReader(sock)
+
+def test_framed_ping(tracker_server):
+    sock, reader = connect(tracker_server)
+    with sock:
+        sock.sendall(encode_frame("ping"))
+        assert reader.read_message() == (b"pong", True)
+
+def test_too_large_frame_is_rejected_in_client_framing(tracker_server, monkeypatch):
+    monkeypatch.setattr(tracker, "MAX_REQUEST_SIZE", 1024)
+    sock, reader = connect(tracker_server)
+    with sock:
+        sock.sendall(encode_request(7, "x" * 2000))
+        payload, framed = reader.read_message()
+        assert framed == 7
+        assert payload.startswith(b"ERROR: Request too large")
+
+    sock, reader = connect(tracker_server)
+    with sock:
+        sock.sendall(encode_frame("x" * 2000))
+        payload, framed = reader.read_message()
+        assert framed is True
+        assert payload.startswith(b"ERROR: Request too large")
+
+def test_too_long_line_is_rejected_as_line(tracker_server, monkeypatch):
+    monkeypatch.setattr(tracker, "MAX_REQUEST_SIZE", 1024)
+    sock, reader = connect(tracker_server)
+    with sock:
+        sock.sendall(b"ping " + b"x" * 200000 + b"\n")
+        payload, framed = reader.read_message()
+        assert framed is False
+        assert payload.startswith(b"ERROR: Request too large")
+
+def test_line_longer_than_read_buffer_is_read_in_parts(tracker_server):
+    # Lớn hơn READ_BUFFER_LIMIT nhưng nhỏ hơn MAX_REQUEST_SIZE
+    sock, reader = connect(tracker_server)
+    with sock:
+        sock.sendall(b"ping " + b" " * (3 * tracker.READ_BUFFER_LIMIT) + b"\n")
+        assert reader.read_message() == (b"pong", False)
+
+def test_in_flight_requests_are_bounded(fresh_tracker, monkeypatch, request):
+    monkeypatch.setattr(tracker, "MAX_IN_FLIGHT", 2)
+    release = threading.Event()
+    running = []
+
+    def slow_handle_request(data, sender_ip):
+        running.append(data)
+        release.wait(5)
+        return b"pong\n"
+    monkeypatch.setattr(tracker, "handle_request", slow_handle_request)
+    port = request.getfixturevalue("tracker_server")
+
+    sock, reader = connect(port)
+    with sock:
+        for request_id in range(1, 6):
+            sock.sendall(encode_request(request_id, "ping"))
+        time.sleep(0.3)
+        # Chỉ MAX_IN_FLIGHT lệnh được đưa vào pool, phần còn lại chờ trong socket
+        assert len(running) == 2
+        assert tracker.queued_requests == 2
+        release.set()
+        replies = {reader.read_message()[1] for _ in range(5)}
+        assert replies == {1, 2, 3, 4, 5}
+        # Slot của lệnh cuối được trả ngay sau khi phản hồi được ghi
+        deadline = time.monotonic() + 2
+        while tracker.request_slots._value != 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert tracker.request_slots._value == 2
+
+def test_peer_unseen_past_heartbeat_deadline_is_stale(fresh_tracker, monkeypatch):
+    probes = []
+    monkeypatch.setattr(tracker.liveness, "request_probe", probes.append)
+    peer = tracker.Peer("10.0.0.1", "5001", "alice", "online")
+    with tracker.peer_lock:
+        tracker.peer_registry.add(peer)
+    assert tracker.cached_peer_status("alice") == "online"
+    peer.last_seen -= tracker.timedelta(seconds=tracker.STATUS_FRESHNESS + 1)
+    assert tracker.cached_peer_status("alice") == "online"
+    peer.last_seen -= tracker.timedelta(seconds=tracker.STATUS_STALE_AFTER)
+    assert tracker.cached_peer_status("alice") == "stale"
+    assert probes == [peer, peer]
+    assert tracker.handle_request("check_status_many alice bob", "10.0.0.2") == b'{"alice": "stale", "bob": null}\n'
@@ -1,31 +1,48 @@
 # thread_client.py
 import socket
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from protocol import send_frame
 
-def send_to_peer(ip, port, message):
+FANOUT_WORKERS = 32  # Số kết nối gửi đồng thời tối đa khi gửi một tin tới nhiều peer
+FANOUT_TIMEOUT = 5  # Thời gian tối đa (giây) cho kết nối và gửi tới một peer khi fan-out
+
+_fanout_pool = None
+_fanout_pool_lock = threading.Lock()
+
+def send_to_peer(ip, port, message, timeout=10):
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(10)  # Increase timeout for larger messages
+        s.settimeout(timeout)  # Increase timeout for larger messages
         s.connect((ip, port))
         
-        # Encode the message
-        encoded_message = message.encode()
-        
-        # Send in chunks if large
-        chunk_size = 4096
-        for i in range(0, len(encoded_message), chunk_size):
-            chunk = encoded_message[i:i+chunk_size]
-            s.send(chunk)
-            # Small pause between chunks
-            time.sleep(0.01)
-            
-        # Send end marker
-        s.send(b"\n")
+        # Send the whole message as one length-prefixed frame, the receiver
+        # knows exactly where it ends without scanning for a delimiter
+        send_frame(s, message)
         
-        # Wait to ensure message is sent
-        time.sleep(0.2)
+        # Signal end of stream so the peer's reader sees EOF after the frame
+        s.shutdown(socket.SHUT_WR)
         s.close()
         return True
     except Exception as e:
         print(f"[Peer client] Failed to connect to {ip}:{port} - {e}")
         return False
+
+def fan_out(peers, message, timeout=FANOUT_TIMEOUT):
+    """Gửi cùng một message tới nhiều peer song song (tối đa FANOUT_WORKERS kết nối cùng lúc).
+
+    peers là các dict {"username", "ip", "port"}. Mỗi peer có timeout riêng nên một peer không
+    trả lời không làm chậm các peer khác. Trả về {(username, ip, port): True nếu gửi được}; một
+    username có thể đăng nhập từ nhiều peer nên mỗi peer có một kết quả riêng.
+    """
+    global _fanout_pool
+    peers = list(peers)
+    if not peers:
+        return {}
+    with _fanout_pool_lock:
+        if _fanout_pool is None:
+            _fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="peer-fanout")
+    futures = {_fanout_pool.submit(send_to_peer, peer["ip"], int(peer["port"]), message, timeout):
+               (peer["username"], peer["ip"], int(peer["port"])) for peer in peers}
+    wait(futures)
+    return {key: future.result() for future, key in futures.items()}
@@ -3,9 +3,18 @@ import socket
 import threading
 import json
 import os
+import time
+import asyncio
+import uuid
+import bisect
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from thread_client import send_to_peer
+from thread_client import send_to_peer, fan_out
+from protocol import MessageReader, ProtocolError, read_message_async, encode_reply, send_frame, request, request_pages
 from data_manager import DataManager, Message
+from peer_directory import PeerDirectory
+from sync_scheduler import SyncScheduler
 import logging
 
 # Thiết lập logging để ghi ra file app.log dùng chung
@@ -20,9 +29,39 @@ logging.basicConfig(
 TRACKER_IP = "10.0.114.226"  # <-- Thay bằng IP LAN thực tế của laptop bạn
 TRACKER_PORT = 12345
 
+PEER_LISTEN_BACKLOG = 1024  # Hàng đợi kết nối chờ accept (trước đây 5, kết nối bị từ chối khi kênh đông)
+PEER_MAX_CONNECTIONS = 1000  # Số kết nối vào đồng thời tối đa, kết nối vượt quá bị đóng ngay
+PEER_WORKERS = 16  # Số thread chạy các handler (handler ghi disk và gửi tới peer khác nên có thể chặn)
+PEER_IDLE_TIMEOUT = 60  # Đóng kết nối không gửi gì trong chừng này giây
+PEER_READ_BUFFER_LIMIT = 64 * 1024  # Bộ đệm đọc của mỗi kết nối; thông điệp lớn hơn được đọc thành nhiều phần
+HISTORY_CHUNK = 500  # Số tin nhắn mỗi chunk channel_history_chunk
+HISTORY_ACK_TIMEOUT = 10  # Thời gian chờ bên nhận xác nhận một chunk
+HISTORY_RESUME_AFTER = 15  # Bên nhận xin gửi tiếp nếu không có chunk mới trong chừng này giây
+HISTORY_MAX_RESUMES = 5
+HISTORY_WATCH_INTERVAL = 1  # Chu kỳ thread history-watcher kiểm tra hạn chờ chunk của các lần nhận
+HISTORY_SAVE_EVERY = 8  # Bên nhận ghi kênh xuống disk sau chừng này chunk (và ở chunk cuối)
+HISTORY_SENDERS = 4  # Số lần gửi lịch sử chạy cùng lúc, ngoài pool xử lý kết nối
+HISTORY_CHUNKED = "chunked"  # Giá trị "history" trong request_history/join_channel của bên nhận hỗ trợ chunk
+
 # Global data manager
 data_manager = DataManager()
 
+def fetch_peer_list():
+    """Đọc danh sách peer từ tracker theo từng trang (get_list phân trang)"""
+    return list(request_pages((TRACKER_IP, TRACKER_PORT), "get_list"))
+
+def channel_sync_info(channel_name):
+    channel = data_manager.get_channel(channel_name)
+    if channel is None:
+        return None
+    return channel.host, channel.members
+
+# Tin nhắn host nhận được được gửi lên tracker theo lô ở nền (agent thay send bằng tracker_request)
+sync_scheduler = SyncScheduler(lambda command: request((TRACKER_IP, TRACKER_PORT), command), channel_sync_info)
+
+# Danh bạ peer theo username, giữ mới bằng status_update của tracker (không hỏi tracker mỗi tin nhắn)
+peer_directory = PeerDirectory(fetch_peer_list)
+
 def handle_message(conn, message_data, username):
     channel_name = message_data["channel"]
     content = message_data["content"]
@@ -55,43 +94,25 @@ def handle_message(conn, message_data, username):
             
             # As host, forward to all other members/visitors with the same timestamp
             try:
-                # Get updated peer list
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect((TRACKER_IP, TRACKER_PORT))
-                s.send(b"get_list\n")
-                peers = json.loads(s.recv(4096).decode())
-                s.close()
-                
-                # Forward to all users in channel
-                for recipient in channel.get_all_users():
-                    if recipient != username and recipient != sender:
-                        # Find recipient in peer list
-                        for peer in peers:
-                            if peer["username"] == recipient:
-                                try:
-                                    # Make sure we're forwarding the original message_data 
-                                    # with its timestamp preserved
-                                    send_to_peer(peer["ip"], int(peer["port"]), json.dumps(message_data))
-                                    logging.info(f"[DEBUG] Host forwarded message to {recipient} with timestamp {timestamp}")
-                                except Exception as e:
-                                    logging.error(f"[Error forwarding message to {recipient}]: {e}")
-                                break
+                # Forward to all users in channel, concurrently; the original message_data keeps its timestamp
+                recipients = peer_directory.resolve(recipient for recipient in channel.get_all_users()
+                                                    if recipient not in (username, sender))
+                results = fan_out(recipients, json.dumps(message_data))
+                failed = [f"{recipient}@{ip}:{port}" for (recipient, ip, port), ok in results.items() if not ok]
+                logging.info(f"[DEBUG] Host forwarded message to {len(results) - len(failed)}/{len(results)} recipients with timestamp {timestamp}")
+                if failed:
+                    logging.error(f"[Error forwarding message to {', '.join(failed)}]")
             except Exception as e:
                 logging.error(f"[Error forwarding messages]: {e}")
             
-            # Sync with tracker
-            try:
-                sync_data = {
-                    "type": "sync_with_tracker",
-                    "channel": channel_name
-                }
-                # Send to self to trigger tracker sync
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect(("127.0.0.1", int(conn.getsockname()[1])))
-                s.send(json.dumps(sync_data).encode())
-                s.close()
-            except Exception as e:
-                logging.error(f"[Error triggering tracker sync]: {e}")
+            # Sync with tracker: chỉ đánh dấu kênh, thread nền gộp cả loạt tin thành một lệnh
+            if message is not None:
+                sync_scheduler.mark_dirty(channel_name, [{
+                    "sender": message.sender,
+                    "content": message.content,
+                    "channel": channel_name,
+                    "timestamp": message.timestamp
+                }])
                 
         # If sender is host, store the message
         elif channel.is_host(sender):
@@ -126,30 +147,17 @@ def handle_message_join_channel(message_data, username, is_authenticated):
                 }
                 
                 # Get peer information
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect((TRACKER_IP, TRACKER_PORT))
-                s.send(b"get_list\n")
-                peers = json.loads(s.recv(4096).decode())
-                s.close()
-                
-                for peer in peers:
-                    if peer["username"] == visitor_username:
-                        try:
-                            send_to_peer(peer["ip"], int(peer["port"]), json.dumps(welcome_data))
-                            logging.info(f"[DEBUG] Sent welcome message to {visitor_username}")
+                peer = peer_directory.get(visitor_username)
+                if peer is not None:
+                    try:
+                        send_to_peer(peer["ip"], int(peer["port"]), json.dumps(welcome_data))
+                        logging.info(f"[DEBUG] Sent welcome message to {visitor_username}")
                             
-                            # Send channel history
-                            if channel.messages:
-                                history_data = {
-                                    "type": "channel_history",
-                                    "channel": channel_name,
-                                    "messages": [msg.to_dict() for msg in channel.messages]
-                                }
-                                send_to_peer(peer["ip"], int(peer["port"]), json.dumps(history_data))
-                                logging.info(f"[DEBUG] Sent history ({len(channel.messages)} messages) to {visitor_username}")
-                        except Exception as e:
-                            logging.error(f"[Error sending welcome/history to {visitor_username}]: {e}")
-                        break
+                        # Send channel history (ở pool riêng, dạng chunk nếu bên nhận hỗ trợ)
+                        if channel.messages:
+                            submit_channel_history(peer, channel, chunked=message_data.get("history") == HISTORY_CHUNKED)
+                    except Exception as e:
+                        logging.error(f"[Error sending welcome/history to {visitor_username}]: {e}")
             except Exception as e:
                 logging.error(f"[Error processing join event]: {e}")
     else:
@@ -181,30 +189,109 @@ def handle_message_request_history(message_data, username):
         
     # Only respond if we're the host
     if channel.is_host(username):
-        # Send channel history to requester
+        # Send channel history to requester; "after" và "transfer" có khi bên nhận xin gửi tiếp
         try:
-            # Get peer information
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((TRACKER_IP, TRACKER_PORT))
-            s.send(b"get_list\n")
-            peers = json.loads(s.recv(4096).decode())
-            s.close()
-            
-            # Find requester in peer list
-            for peer in peers:
-                if peer["username"] == requester:
-                    history_data = {
-                        "type": "channel_history",
-                        "channel": channel_name,
-                        "messages": [msg.to_dict() for msg in channel.messages]
-                    }
-                    send_to_peer(peer["ip"], int(peer["port"]), json.dumps(history_data))
-                    logging.info(f"[DEBUG] Sent history ({len(channel.messages)} messages) to {requester}")
-                    break
+            # Find requester in the peer directory
+            peer = peer_directory.get(requester)
+            if peer is not None:
+                submit_channel_history(peer, channel, message_data.get("after"), message_data.get("transfer"),
+                                       message_data.get("history") == HISTORY_CHUNKED)
         except Exception as e:
             logging.error(f"[Error sending history to {requester}]: {e}")
 
+def history_key(message):
+    """Khoá thứ tự toàn phần của tin nhắn trong lịch sử (Message hoặc dict), dùng để gửi tiếp và loại trùng"""
+    if isinstance(message, dict):
+        return (message.get("timestamp") or "", message.get("sender") or "", message.get("content") or "")
+    return (message.timestamp or "", message.sender or "", message.content or "")
+
+def submit_channel_history(peer, channel, after=None, transfer_id=None, chunked=True):
+    """Gửi lịch sử ở pool riêng để thread xử lý kết nối của peer không bị chặn suốt lần gửi"""
+    global history_senders
+    with history_senders_lock:
+        if history_senders is None:
+            history_senders = ThreadPoolExecutor(max_workers=HISTORY_SENDERS, thread_name_prefix="history-sender")
+    return history_senders.submit(send_channel_history, peer, channel, after, transfer_id, chunked)
+
+def send_channel_history(peer, channel, after=None, transfer_id=None, chunked=True):
+    """Gửi lịch sử kênh thành các chunk tối đa HISTORY_CHUNK tin, chờ bên nhận xác nhận từng chunk.
+
+    Tin nhắn được gửi theo thứ tự history_key; after là khoá của tin cuối cùng bên nhận đã xác
+    nhận và chỉ các tin sau nó được gửi, nên khi kết nối đứt bên nhận xin gửi tiếp đúng từ chỗ
+    dừng. after dạng timestamp (bên nhận cũ) được hiểu là mọi tin có timestamp >= after. Bên nhận
+    không báo hỗ trợ chunk (chunked=False) nhận cả lịch sử trong một thông điệp channel_history.
+    Trả về True nếu đã gửi hết.
+    """
+    messages = sorted(list(channel.messages), key=history_key)
+    if not chunked:
+        sent = send_to_peer(peer["ip"], int(peer["port"]), json.dumps({
+            "type": "channel_history",
+            "channel": channel.name,
+            "messages": [msg.to_dict() for msg in messages]
+        }))
+        logging.info(f"[DEBUG] Sent history ({len(messages)} messages) to {peer['username']} in one message")
+        return sent
+    if isinstance(after, list) and len(after) == 3:
+        keys = [history_key(msg) for msg in messages]
+        messages = messages[bisect.bisect_right(keys, tuple(after)):]
+    elif isinstance(after, str):
+        messages = [msg for msg in messages if msg.timestamp >= after]
+    transfer_id = transfer_id or uuid.uuid4().hex
+    total = len(messages)
+    sock = None
+    try:
+        sock = socket.create_connection((peer["ip"], int(peer["port"])), timeout=HISTORY_ACK_TIMEOUT)
+        reader = MessageReader(sock)
+        for seq, start in enumerate(range(0, max(total, 1), HISTORY_CHUNK)):
+            chunk = messages[start:start + HISTORY_CHUNK]
+            send_frame(sock, json.dumps({
+                "type": "channel_history_chunk",
+                "channel": channel.name,
+                "host": channel.host,
+                "transfer": transfer_id,
+                "seq": seq,
+                "first": start,  # Vị trí của chunk trong lần gửi này: [first, first + len(messages))
+                "total": total,
+                "final": start + HISTORY_CHUNK >= total,
+                "messages": [msg.to_dict() for msg in chunk]
+            }))
+            reply, _ = reader.read_message()
+            if reply is None or json.loads(reply).get("ack") != seq:
+                logging.warning(f"[Server] History transfer of {channel.name} to {peer['username']} stopped at chunk {seq}")
+                return False
+        logging.info(f"[DEBUG] Sent history ({total} messages) to {peer['username']}")
+        return True
+    except (OSError, ValueError, ProtocolError) as e:
+        logging.error(f"[Error sending history to {peer['username']}]: {e}")
+        return False
+    finally:
+        if sock is not None:
+            sock.close()
+
+def merge_history(channel, message_dicts, keys):
+    """Thêm các tin chưa có (theo tập khoá keys, được cập nhật) vào channel.messages đã sắp xếp.
+
+    Tin mới được sắp xếp rồi gắn vào cuối nếu không cũ hơn tin cuối cùng, nếu không thì gộp với
+    danh sách hiện có trong một lượt; trả về số tin đã thêm.
+    """
+    new_messages = []
+    for msg_data in message_dicts:
+        key = history_key(msg_data)
+        if key in keys:
+            continue
+        keys.add(key)
+        new_messages.append(Message.from_dict(msg_data))
+    if not new_messages:
+        return 0
+    new_messages.sort(key=lambda msg: msg.timestamp)
+    if not channel.messages or new_messages[0].timestamp >= channel.messages[-1].timestamp:
+        channel.messages.extend(new_messages)
+    else:
+        channel.messages = list(heapq.merge(channel.messages, new_messages, key=lambda msg: msg.timestamp))
+    return len(new_messages)
+
 def handle_message_channel_history(message_data):
+    """Lịch sử trong một thông điệp (host cũ, hoặc host gửi cho bên nhận không hỗ trợ chunk)"""
     channel_name = message_data["channel"]
     messages = message_data["messages"]
     
@@ -215,98 +302,257 @@ def handle_message_channel_history(message_data):
         channel = data_manager.get_channel(channel_name)
     
     if channel and messages:
-        # Clear existing messages and add new ones
-        channel.messages = []
-        for msg_data in messages:
-            message = Message.from_dict(msg_data)
-            channel.add_message(message)
-        
-        # Save channel to disk
-        data_manager.save_channel(channel_name)
-        logging.info(f"[DEBUG] Updated channel {channel_name} with {len(messages)} messages from history")
-        
-        # Display the history to the user
-        logging.info(f"[Message History for {channel_name}]")
-        for msg in channel.messages:
-            # Format the timestamp for better display
+        with history_channel_lock(channel_name):
+            added = merge_history(channel, messages, {history_key(msg) for msg in channel.messages})
+        if added:
+            data_manager.save_channel(channel_name)
+        logging.info(f"[DEBUG] Updated channel {channel_name} with {added} new of {len(messages)} messages from history")
+
+history_transfers = {}  # tên kênh -> trạng thái lần nhận lịch sử đang dở
+history_lock = threading.Lock()  # Chỉ bảo vệ history_transfers và history_channel_locks
+history_channel_locks = {}  # tên kênh -> Lock, giữ khi gộp lịch sử vào kênh (không giữ khi ghi disk)
+history_watcher = None  # Thread duy nhất theo dõi hạn chờ của mọi lần nhận, tạo khi cần
+history_senders = None  # ThreadPoolExecutor gửi lịch sử, tạo khi cần
+history_senders_lock = threading.Lock()
+
+def history_channel_lock(channel_name):
+    with history_lock:
+        lock = history_channel_locks.get(channel_name)
+        if lock is None:
+            lock = history_channel_locks[channel_name] = threading.Lock()
+        return lock
+
+def _start_history_watcher():
+    # Gọi khi giữ history_lock
+    global history_watcher
+    if history_watcher is None:
+        history_watcher = threading.Thread(target=history_watch_loop, name="history-watcher", daemon=True)
+        history_watcher.start()
+
+def history_watch_loop():
+    """Xin host gửi tiếp các lần nhận lịch sử quá HISTORY_RESUME_AFTER giây không có chunk mới"""
+    while True:
+        time.sleep(HISTORY_WATCH_INTERVAL)
+        now = time.monotonic()
+        with history_lock:
+            expired = [(name, state["transfer"], state["username"]) for name, state in history_transfers.items()
+                       if state["deadline"] is not None and state["deadline"] <= now]
+        for channel_name, transfer_id, username in expired:
             try:
-                timestamp = datetime.fromisoformat(msg.timestamp).strftime("%Y-%m-%d %H:%M:%S")
-            except:
-                timestamp = msg.timestamp
-            logging.info(f"[{timestamp}] {msg.sender}: {msg.content}")
-    
+                resume_history_transfer(channel_name, transfer_id, username)
+            except Exception as e:
+                logging.error(f"[Error resuming history of {channel_name}]: {e}")
 
-def handle_peer(conn, username_fn):
-    # Get current username (might change if user logs in/out)
+def handle_message_channel_history_chunk(message_data, username):
+    """Áp dụng ngay một chunk lịch sử (bỏ tin đã có) rồi xác nhận; trả về phản hồi ack.
+
+    Kênh được ghi xuống disk sau mỗi HISTORY_SAVE_EVERY chunk có tin mới, ở chunk cuối và khi
+    lần nhận bị dừng, thay vì sau mỗi chunk; việc ghi chạy sau khi nhả lock của kênh.
+    """
+    channel_name = message_data["channel"]
+    messages = message_data["messages"]
+    save = False
+    with history_channel_lock(channel_name):
+        with history_lock:
+            state = history_transfers.get(channel_name)
+            if state is None or state["transfer"] != message_data["transfer"]:
+                # Lần gửi mới thay lần đang dở: phần đã nhận của lần cũ được ghi cùng lần này
+                save = state is not None and state["unsaved"] > 0
+                state = history_transfers[channel_name] = {
+                    "transfer": message_data["transfer"], "host": message_data.get("host"), "username": username,
+                    "keys": None, "after": None, "received": 0, "unsaved": 0, "resumes": 0, "deadline": None
+                }
+                _start_history_watcher()
+
+        channel = data_manager.get_channel(channel_name)
+        if not channel:
+            # Create channel if it doesn't exist
+            data_manager.create_channel(channel_name, message_data.get("host") or "unknown")
+            channel = data_manager.get_channel(channel_name)
+        if state["keys"] is None:
+            state["keys"] = {history_key(msg) for msg in channel.messages}
+        if merge_history(channel, messages, state["keys"]):
+            state["unsaved"] += 1
+        state["received"] += len(messages)
+        if messages:
+            state["after"] = list(history_key(messages[-1]))
+
+        if message_data.get("final") or state["unsaved"] >= HISTORY_SAVE_EVERY:
+            save = save or state["unsaved"] > 0
+            state["unsaved"] = 0
+        if message_data.get("final"):
+            with history_lock:
+                history_transfers.pop(channel_name, None)
+            logging.info(f"[DEBUG] Updated channel {channel_name} with {state['received']} messages from history")
+        else:
+            # Không nhận được chunk tiếp theo (kết nối đứt): history-watcher xin host gửi tiếp từ tin cuối cùng
+            state["deadline"] = time.monotonic() + HISTORY_RESUME_AFTER
+    if save:
+        data_manager.save_channel(channel_name)
+    return json.dumps({"ack": message_data["seq"]}).encode()
+
+def resume_history_transfer(channel_name, transfer_id, username):
+    with history_channel_lock(channel_name):
+        with history_lock:
+            state = history_transfers.get(channel_name)
+            if state is None or state["transfer"] != transfer_id:
+                return
+            if state["resumes"] >= HISTORY_MAX_RESUMES:
+                del history_transfers[channel_name]
+        # Phần đã nhận được giữ lại dù lần gửi tiếp có thành công hay không
+        save = state["unsaved"] > 0
+        state["unsaved"] = 0
+        given_up = state["resumes"] >= HISTORY_MAX_RESUMES
+        if not given_up:
+            state["resumes"] += 1
+            # Lần xin gửi tiếp sau cũng phải có hạn chờ
+            state["deadline"] = time.monotonic() + HISTORY_RESUME_AFTER
+        host, after = state["host"], state["after"]
+    if save:
+        data_manager.save_channel(channel_name)
+    if given_up:
+        logging.error(f"[Error] Giving up history transfer of {channel_name} after {state['resumes']} resumes")
+        return
+    peer = peer_directory.get(host) if host else None
+    if peer is None:
+        logging.warning(f"[Server] Cannot resume history of {channel_name}: host {host} not found")
+        return
+    logging.info(f"[Server] Resuming history transfer of {channel_name} after {after}")
+    send_to_peer(peer["ip"], int(peer["port"]), json.dumps({
+        "type": "request_history",
+        "channel": channel_name,
+        "username": username,
+        "history": HISTORY_CHUNKED,
+        "after": after,
+        "transfer": transfer_id
+    }))
+
+def dispatch_peer_message(data, conn, username_fn):
+    """Xử lý một thông điệp từ peer (hoặc tracker); trả về phản hồi (bytes) hoặc None"""
+    # Always get the latest username before processing each message
     username = username_fn() if callable(username_fn) else username_fn
     is_authenticated = bool(username) and username != "visitor"  # Empty username or visitor means visitor mode
-    
+
+    # Xử lý lệnh ping từ tracker
+    if data.strip() == "ping":
+        logging.info("[Server] Received ping from tracker, sending pong")
+        return b"pong"
+
+    try:
+        message_data = json.loads(data)
+        if message_data["type"] == "message":
+            handle_message(conn, message_data, username)
+        elif message_data["type"] == "join_channel":
+            handle_message_join_channel(message_data, username, is_authenticated)
+        elif message_data["type"] == "leave_channel":
+            handle_message_leave_channel(message_data)
+        elif message_data["type"] == "request_history":
+            handle_message_request_history(message_data, username)
+        elif message_data["type"] == "channel_history_chunk":
+            return handle_message_channel_history_chunk(message_data, username)
+        elif message_data["type"] == "channel_history":
+            # Peer cũ gửi cả lịch sử trong một thông điệp
+            handle_message_channel_history(message_data)
+        elif message_data["type"] == "status_update":
+            # Tracker đẩy trạng thái mới của một peer (kèm ip, port) qua kết nối giữ lâu
+            peer_directory.apply_update(message_data)
+        elif message_data["type"] == "sync_with_tracker":
+            # This is a request for the local agent to sync a channel with the tracker
+            # We just ignore it in the server handler, as the agent will handle it separately
+            pass
+
+    except json.JSONDecodeError:
+        logging.error(f"[Error] Invalid JSON data received: {data}")
+    except Exception as e:
+        logging.error(f"[Error handling message]: {e}")
+    return None
+
+def handle_peer(conn, username_fn):
+    """Xử lý một kết nối trong chế độ threaded (mỗi kết nối một thread)"""
     try:
-        buffer = ""
+        reader = MessageReader(conn)
         while True:
-            # Receive data in chunks
-            chunk = conn.recv(4096).decode()
-            if not chunk:
+            # Each message is either a length-prefixed frame or a legacy newline-terminated line
+            payload, framed = reader.read_message()
+            if payload is None:
                 break
-                
-            # Add to buffer
-            buffer += chunk
-            
-            # Process complete messages (each message ends with a newline)
-            if '\n' in buffer:
-                messages = buffer.split('\n')
-                # Last element might be an incomplete message
-                buffer = messages.pop()
-                
-                for data in messages:
-                    if not data.strip():
-                        continue
-                        
-                    # Always get the latest username before processing each message
-                    username = username_fn() if callable(username_fn) else username_fn
-                    is_authenticated = bool(username) and username != "visitor"
-
-                    # Xử lý lệnh ping từ tracker
-                    if data.strip() == "ping":
-                        logging.info("[Server] Received ping from tracker, sending pong")
-                        conn.send(b"pong\n")
-                        continue
-                    
-                    try:
-                        message_data = json.loads(data)
-                        if message_data["type"] == "message":
-                            handle_message(conn, message_data, username)
-                        elif message_data["type"] == "join_channel":
-                            handle_message_join_channel(conn, message_data, username, is_authenticated)
-                        elif message_data["type"] == "leave_channel":
-                            handle_message_leave_channel(message_data)
-                        elif message_data["type"] == "request_history":
-                            handle_message_request_history(conn, message_data, username)
-                        elif message_data["type"] == "channel_history":
-                            handle_message_channel_history(message_data)
-                        elif message_data["type"] == "sync_with_tracker":
-                            # This is a request for the local agent to sync a channel with the tracker
-                            # We just ignore it in the server handler, as the agent will handle it separately
-                            pass
-                        
-                    except json.JSONDecodeError:
-                        logging.error(f"[Error] Invalid JSON data received: {data}")
-                    except Exception as e:
-                        logging.error(f"[Error handling message]: {e}")
+
+            data = payload.decode(errors="replace")
+            if not data.strip():
+                continue
+
+            response = dispatch_peer_message(data, conn, username_fn)
+            if response:
+                conn.sendall(encode_reply(response, framed))
     except Exception as e:
         logging.error(f"[Error in peer connection]: {e}")
     finally:
         conn.close()
 
-def start_peer_server(port, username_fn):
-    # Create data directory if it doesn't exist
-    os.makedirs("data", exist_ok=True)
-    
+active_peer_connections = 0
+
+async def handle_peer_async(reader, writer, username_fn, executor, max_connections):
+    """Xử lý một kết nối trên event loop; handler chạy trong pool thread giới hạn"""
+    global active_peer_connections
+    if active_peer_connections >= max_connections:
+        logging.warning(f"[Server] Connection limit ({max_connections}) reached, rejecting {writer.get_extra_info('peername')}")
+        writer.close()
+        return
+    active_peer_connections += 1
+    loop = asyncio.get_running_loop()
+    # Socket của kết nối, truyền cho handler như ở chế độ threaded
+    conn = writer.get_extra_info("socket")
+    try:
+        while True:
+            try:
+                payload, framed = await asyncio.wait_for(read_message_async(reader), PEER_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+            except (ValueError, ProtocolError) as e:
+                logging.warning(f"[Server] Rejecting message from {writer.get_extra_info('peername')}: {e}")
+                break
+            if payload is None:
+                break
+
+            data = payload.decode(errors="replace")
+            if not data.strip():
+                continue
+
+            # Các thông điệp của một kết nối được xử lý lần lượt, các kết nối khác nhau song song
+            response = await loop.run_in_executor(executor, dispatch_peer_message, data, conn, username_fn)
+            if response:
+                writer.write(encode_reply(response, framed))
+                await writer.drain()
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+        pass
+    except Exception as e:
+        logging.error(f"[Error in peer connection]: {e}")
+    finally:
+        active_peer_connections -= 1
+        writer.close()
+
+async def serve_peer_async(port, username_fn, backlog, max_connections, workers):
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="peer-worker")
+    server = await asyncio.start_server(
+        lambda r, w: handle_peer_async(r, w, username_fn, executor, max_connections),
+        "0.0.0.0", port,
+        limit=PEER_READ_BUFFER_LIMIT,
+        backlog=backlog,
+        reuse_address=True
+    )
+    logging.info(f"[Server] Peer server (asyncio) started on port {port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False)
+
+def serve_peer_threaded(port, username_fn, backlog):
     host = '0.0.0.0'
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind((host, port))
-    server_socket.listen(5)
+    server_socket.listen(backlog)
     logging.info(f"[Server] Peer server started on port {port}")
     
     while True:
@@ -315,3 +561,14 @@ def start_peer_server(port, username_fn):
         client_thread = threading.Thread(target=handle_peer, args=(conn, username_fn))
         client_thread.daemon = True
         client_thread.start()
+
+def start_peer_server(port, username_fn, backlog=PEER_LISTEN_BACKLOG, max_connections=PEER_MAX_CONNECTIONS,
+                      workers=PEER_WORKERS, threaded=False):
+    """Chạy peer server (chặn thread gọi): mặc định một event loop asyncio, threaded=True dùng server cũ"""
+    # Create data directory if it doesn't exist
+    os.makedirs("data", exist_ok=True)
+
+    if threaded:
+        serve_peer_threaded(port, username_fn, backlog)
+    else:
+        asyncio.run(serve_peer_async(port, username_fn, backlog, max_connections, workers))
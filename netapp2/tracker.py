@@ -1,11 +1,33 @@
 # tracker.py
 import socket
+import select
 import threading
 import json
 import os
 import time
-from datetime import datetime
+import bisect
+import heapq
+import hashlib
+import asyncio
+import argparse
+import signal
+import queue
+import multiprocessing
+import functools
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import logging
+from channel_log import ChannelLog
+from protocol import MessageReader, ProtocolError, read_message_async, encode_reply, encode_frame, send_frame, recv_reply
+from replication_log import ReplicationLog
+from shard_ring import HashRing
+from snapshot_store import SnapshotStore
+from archive_store import ArchiveStore
+from search_index import SearchIndex, timestamp_value
+from rate_limit import RateLimiter
 
 # Thiết lập logging để ghi ra file app.log dùng chung
 logging.basicConfig(
@@ -15,6 +37,241 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+DEFAULT_PAGE_LIMIT = 200  # Số phần tử mặc định của một trang
+MAX_PAGE_LIMIT = 1000
+
+def parse_page_args(args):
+    """Đọc các tham số phân trang dạng limit=N after=X before=X; trả về None nếu không có tham số nào"""
+    page = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or key not in ("limit", "after", "before"):
+            raise ValueError(f"Invalid page argument {arg}")
+        page[key] = value
+    if not page:
+        return None
+    if "after" in page and "before" in page:
+        raise ValueError("Only one of after/before is allowed")
+    limit = int(page.get("limit", DEFAULT_PAGE_LIMIT))
+    if limit <= 0:
+        raise ValueError("limit must be positive")
+    page["limit"] = min(limit, MAX_PAGE_LIMIT)
+    return page
+
+def page_slice(keys, after=None, before=None, limit=DEFAULT_PAGE_LIMIT):
+    """Cắt một trang từ danh sách keys đã sắp xếp; trả về (trang, cursor để lấy trang kế tiếp hoặc None).
+
+    after: các key lớn hơn after theo thứ tự tăng dần; before: limit key ngay trước before
+    (đi ngược về đầu danh sách), cursor tiếp theo khi đó là key nhỏ nhất của trang.
+    """
+    if before is not None:
+        end = bisect.bisect_left(keys, before)
+        start = max(0, end - limit)
+        return keys[start:end], (keys[start] if start > 0 else None)
+    start = bisect.bisect_right(keys, after) if after is not None else 0
+    end = start + limit
+    return keys[start:end], (keys[end - 1] if end < len(keys) else None)
+
+# Giới hạn trên (giây) của các bucket histogram độ trễ, tăng dần theo cấp số nhân
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+# Các lệnh được thống kê riêng; lệnh khác gộp vào "other" để số nhãn không tăng vô hạn
+KNOWN_COMMANDS = ("send_info", "get_list", "ping", "heartbeat", "check_status", "sync_channel",
+                  "get_channel", "get_channel_since", "list_channels", "debug", "stats", "join_channel",
+                  "subscribe", "replicate", "promote", "get_history", "set_retention", "search",
+                  "check_status_many")
+
+class Histogram:
+    """Histogram với bucket cố định; phân vị được ước lượng bằng nội suy trong bucket"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if self.buckets[i] != float("inf") else lower * 2
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-2]
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": round(self.percentile(0.50), 6),
+            "p95": round(self.percentile(0.95), 6),
+            "p99": round(self.percentile(0.99), 6)
+        }
+
+class CommandStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram()
+
+class TrackerMetrics:
+    """Số liệu vận hành của tracker: theo từng lệnh, thời gian chờ lock và độ sâu các hàng đợi.
+
+    Mỗi lần ghi chỉ tốn vài phép cộng dưới một lock riêng; lệnh stats và endpoint
+    Prometheus (--metrics-port) đọc snapshot của các số liệu này.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.commands = {}  # tên lệnh -> CommandStats
+        self.lock_waits = {}  # tên lock -> Histogram thời gian chờ (chỉ các lần bị tranh chấp)
+        self.lock_acquires = {}  # tên lock -> tổng số lần acquire
+        self._gauges = {}  # tên -> hàm trả về giá trị hiện tại
+
+    def observe_request(self, cmd, bytes_in, bytes_out, elapsed, error=False):
+        with self._lock:
+            stats = self.commands.get(cmd)
+            if stats is None:
+                stats = self.commands[cmd] = CommandStats()
+            stats.count += 1
+            stats.errors += error
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            stats.latency.observe(elapsed)
+
+    def observe_lock(self, name, wait):
+        with self._lock:
+            self.lock_acquires[name] = self.lock_acquires.get(name, 0) + 1
+            if wait is not None:
+                hist = self.lock_waits.get(name)
+                if hist is None:
+                    hist = self.lock_waits[name] = Histogram()
+                hist.observe(wait)
+
+    def gauge(self, name, fn):
+        """Đăng ký một giá trị đọc lúc lấy snapshot (ví dụ độ sâu hàng đợi)"""
+        self._gauges[name] = fn
+
+    def snapshot(self):
+        gauges = {}
+        for name, fn in list(self._gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception:
+                gauges[name] = None
+        with self._lock:
+            return {
+                "uptime": round(time.time() - self.started, 3),
+                "commands": {
+                    cmd: {
+                        "count": st.count,
+                        "errors": st.errors,
+                        "bytes_in": st.bytes_in,
+                        "bytes_out": st.bytes_out,
+                        "latency": st.latency.to_dict()
+                    } for cmd, st in self.commands.items()
+                },
+                "locks": {
+                    name: {
+                        "acquires": acquires,
+                        "contended": self.lock_waits[name].count if name in self.lock_waits else 0,
+                        "wait": self.lock_waits[name].to_dict() if name in self.lock_waits else Histogram().to_dict()
+                    } for name, acquires in self.lock_acquires.items()
+                },
+                "gauges": gauges
+            }
+
+    def prometheus_text(self):
+        """Snapshot theo định dạng text của Prometheus"""
+        lines = []
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP netapp_tracker_{name} {help_text}")
+            lines.append(f"# TYPE netapp_tracker_{name} {kind}")
+        gauges = {}
+        for name, fn in list(self._gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception:
+                pass
+        with self._lock:
+            metric("requests_total", "counter", "Number of requests per command")
+            for cmd, st in self.commands.items():
+                lines.append(f'netapp_tracker_requests_total{{command="{cmd}"}} {st.count}')
+            metric("request_errors_total", "counter", "Number of error replies per command")
+            for cmd, st in self.commands.items():
+                lines.append(f'netapp_tracker_request_errors_total{{command="{cmd}"}} {st.errors}')
+            metric("bytes_in_total", "counter", "Request bytes received per command")
+            for cmd, st in self.commands.items():
+                lines.append(f'netapp_tracker_bytes_in_total{{command="{cmd}"}} {st.bytes_in}')
+            metric("bytes_out_total", "counter", "Response bytes sent per command")
+            for cmd, st in self.commands.items():
+                lines.append(f'netapp_tracker_bytes_out_total{{command="{cmd}"}} {st.bytes_out}')
+            metric("request_duration_seconds", "histogram", "Request handling latency")
+            for cmd, st in self.commands.items():
+                lines.extend(self._histogram_lines("request_duration_seconds", f'command="{cmd}"', st.latency))
+            metric("lock_wait_seconds", "histogram", "Time spent waiting for contended locks")
+            for name, hist in self.lock_waits.items():
+                lines.extend(self._histogram_lines("lock_wait_seconds", f'lock="{name}"', hist))
+        for name, value in gauges.items():
+            if isinstance(value, (int, float)):
+                metric(name, "gauge", name.replace("_", " "))
+                lines.append(f"netapp_tracker_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _histogram_lines(name, labels, hist):
+        cumulative = 0
+        for bound, n in zip(hist.buckets, hist.counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f'netapp_tracker_{name}_bucket{{{labels},le="{le}"}} {cumulative}'
+        yield f"netapp_tracker_{name}_sum{{{labels}}} {hist.sum}"
+        yield f"netapp_tracker_{name}_count{{{labels}}} {hist.count}"
+
+metrics = TrackerMetrics()
+
+class InstrumentedLock:
+    """Bọc một lock (RLock) để đo thời gian chờ khi lock đang bị thread khác giữ.
+
+    Lần acquire không bị tranh chấp chỉ tốn một lần thử non-blocking nên gần như không
+    làm chậm đường đi thường gặp.
+    """
+    def __init__(self, name, lock=None):
+        self.name = name
+        self._lock = lock if lock is not None else threading.RLock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            metrics.observe_lock(self.name, None)
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        if acquired:
+            metrics.observe_lock(self.name, time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
 class Peer:
     def __init__(self, ip, port, username, status):
         self.ip = ip
@@ -22,6 +279,7 @@ class Peer:
         self.username = username
         self.status = status
         self.last_seen = datetime.now()  # Thêm timestamp cho lần cuối cùng peer được thấy
+        self.expired = False  # True nếu bị LivenessMonitor đánh dấu offline (không phải do client tự báo)
 
     def to_dict(self):
         return {
@@ -49,20 +307,72 @@ class Peer:
         time_diff = (now - self.last_seen).total_seconds()
         return time_diff > timeout_seconds
 
+def file_signature(path):
+    """(mtime_ns, size) của file, hoặc None nếu file không tồn tại"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+# Giới hạn mặc định của tầng nóng mỗi kênh (--retention-messages, --retention-days), 0: không giới hạn.
+# Tin nhắn vượt giới hạn được chuyển sang archive ngay, kèm tối đa ARCHIVE_BATCH tin để segment không quá nhỏ.
+RETENTION_MESSAGES = 0
+RETENTION_DAYS = 0
+ARCHIVE_BATCH = 1000
+RETENTION_SWEEP_INTERVAL = 3600  # Chu kỳ quét giới hạn tuổi cho các kênh không có ghi mới
+
+# Ước lượng bộ nhớ (byte) của một Message ngoài phần chuỗi, và của một Channel rỗng
+MESSAGE_OVERHEAD = 400
+CHANNEL_OVERHEAD = 2048
+# Lô sync_channel lớn hơn số tin này được gộp vào danh sách đã sắp xếp trong một lượt thay vì chèn từng tin
+MERGE_INSERT_MAX = 32
+
+def retention_limits(retention):
+    """(số tin nhắn tối đa, số ngày tối đa) theo cấu hình riêng của kênh hoặc mặc định của tracker"""
+    if retention is not None:
+        return retention.get("messages", 0), retention.get("days", 0)
+    return RETENTION_MESSAGES, RETENTION_DAYS
+
+def retention_cutoff(max_days):
+    return (datetime.now() - timedelta(days=max_days)).isoformat(sep=" ")
+
+def message_size(message):
+    return MESSAGE_OVERHEAD + len(message.sender) + len(message.content) + len(message.timestamp)
+
+def record_seq(record):
+    """seq của một bản ghi log kênh"""
+    if record.get("op") == "message":
+        return record["message"].get("seq") or 0
+    return record.get("seq") or 0
+
+def timestamp_key(timestamp):
+    """Timestamp dạng "YYYY-MM-DD HH:MM:SS[...]" để so sánh được cả với dạng isoformat ("T" ở giữa)"""
+    return (timestamp or "").replace("T", " ")
+
+def message_id(sender, timestamp, content):
+    """Định danh ổn định của tin nhắn: cùng người gửi, thời điểm và nội dung là cùng một tin"""
+    digest = hashlib.sha1(f"{sender}\x00{timestamp}\x00{content}".encode("utf-8", "replace")).hexdigest()
+    return digest[:20]
+
 # Message class for storing channel messages
 class Message:
-    def __init__(self, sender, content, channel, timestamp=None):
+    def __init__(self, sender, content, channel, timestamp=None, seq=0, id=None):
         self.sender = sender
         self.content = content
         self.channel = channel
         self.timestamp = timestamp or datetime.now().isoformat()
+        self.seq = seq  # Số thứ tự trong kênh, dùng làm cursor cho delta sync
+        self.id = id or message_id(sender, self.timestamp, content)
 
     def to_dict(self):
         return {
             "sender": self.sender,
             "content": self.content,
             "channel": self.channel,
-            "timestamp": self.timestamp
+            "timestamp": self.timestamp,
+            "seq": self.seq,
+            "id": self.id
         }
 
     @classmethod
@@ -71,92 +381,788 @@ class Message:
             sender=data["sender"],
             content=data["content"],
             channel=data["channel"],
-            timestamp=data["timestamp"]
+            timestamp=data["timestamp"],
+            seq=data.get("seq", 0)
         )
 
 # Channel class for centralized storage
 class Channel:
-    def __init__(self, name, host):
+    def __init__(self, name, host, persist=True):
         self.name = name
         self.host = host
         self.messages = []
         self.members = set()
         self.members.add(host)  # Add host as member
+        # seq tăng sau mỗi thay đổi của kênh (tin nhắn, thành viên, host) và là cursor của client.
+        # meta_seq là seq của lần đổi thành viên/host gần nhất.
+        self.seq = 0
+        self.meta_seq = 0
+        self._seq_keys = []  # seq của các tin nhắn theo thứ tự tăng dần
+        self._by_seq = []  # Tin nhắn theo thứ tự seq (song song với _seq_keys)
+        self._by_id = {}  # id tin nhắn -> Message, dùng để loại trùng trong O(1)
+        self._sort_keys = []  # (timestamp, id) song song với self.messages, để chèn đúng vị trí
+        self.approx_bytes = CHANNEL_OVERHEAD  # Ước lượng bộ nhớ của kênh, dùng cho ChannelCache
+        self.snapshot_entry = None  # Mục manifest của snapshot gộp nếu kênh được dựng từ đó
+        # Lưu trữ: tin nhắn có seq <= archived_seq đã chuyển sang các segment của ArchiveStore
+        self.retention = None  # {"messages": N, "days": D} riêng của kênh, None: dùng mặc định của tracker
+        self.archived_seq = 0
+        self.archived_until = ""  # timestamp mới nhất trong archive, để biết khi nào cần kiểm tra trùng ở đó
+        self._archive = None
+        self.log = ChannelLog(name)
+        if persist:
+            # Kênh mới: bản ghi đầu tiên trong log đủ để dựng lại kênh khi chưa có snapshot
+            self.seq = self.meta_seq = 1
+            self._record({"op": "create", "host": host, "seq": self.seq})
         logging.info(f"[Channel] Created channel {name} with host {host}")
 
-    def add_message(self, message_data):
+    def _record(self, record):
+        """Ghi bản ghi vào log của kênh và vào journal cho standby"""
+        self.log.append(record)
+        replication_log.append({"channel": self.name, "record": record})
+
+    def _next_seq(self, seq=None):
+        self.seq = max(self.seq + 1, seq or 0)
+        return self.seq
+
+    def _insert_sorted(self, message):
+        # Chèn vào đúng vị trí theo thời gian thay vì sắp xếp lại cả danh sách
+        key = (message.timestamp, message.id)
+        index = bisect.bisect_right(self._sort_keys, key)
+        self._sort_keys.insert(index, key)
+        self.messages.insert(index, message)
+
+    def _merge_sorted(self, new_messages):
+        """Gộp các tin nhắn mới vào self.messages trong một lượt O(n + k log k) thay vì k lần insert"""
+        new_messages.sort(key=lambda msg: (msg.timestamp, msg.id))
+        # Chỉ phần đuôi mới hơn tin nhắn mới nhỏ nhất cần gộp lại; thường là gắn thêm vào cuối
+        start = bisect.bisect_right(self._sort_keys, (new_messages[0].timestamp, new_messages[0].id))
+        tail = self.messages[start:]
+        if tail:
+            new_messages = list(heapq.merge(tail, new_messages, key=lambda msg: (msg.timestamp, msg.id)))
+        self.messages[start:] = new_messages
+        self._sort_keys[start:] = [(msg.timestamp, msg.id) for msg in new_messages]
+
+    def _apply_message(self, message_data, seq=None, insert=True):
         message = Message(
             message_data["sender"], 
             message_data["content"], 
             message_data["channel"],
-            message_data.get("timestamp")
+            message_data.get("timestamp"),
         )
-        self.messages.append(message)
-        
-        # Sắp xếp tin nhắn theo thời gian sau khi thêm
-        try:
-            self.messages.sort(key=lambda msg: msg.timestamp)
-            logging.info(f"[Channel] Messages sorted by timestamp after adding new message to channel {self.name}")
-        except Exception as e:
-            logging.error(f"[Channel] Error sorting messages: {e}")
-            
+        if message.id in self._by_id:
+            return None
+        if self.archived_seq and timestamp_key(message.timestamp) <= self.archived_until and self.archive.contains(message.id):
+            return None
+        message.seq = self._next_seq(seq)
+        self._by_id[message.id] = message
+        if insert:
+            self._insert_sorted(message)
+        self._seq_keys.append(message.seq)
+        self._by_seq.append(message)
+        self.approx_bytes += message_size(message)
+        return message
+
+    def has_message(self, message_data):
+        return message_id(message_data.get("sender"), message_data.get("timestamp"), message_data.get("content")) in self._by_id
+
+    def add_message(self, message_data, insert=True):
+        """Thêm tin nhắn nếu chưa có; trả về Message mới hoặc None nếu trùng"""
+        message = self._apply_message(message_data, insert=insert)
+        if message is None:
+            return None
+        # Chỉ ghi thêm một dòng vào log; commit do save_to_disk() trả về sẽ ghi cả lô
+        self._record({"op": "message", "message": message.to_dict()})
+        index_message(self.name, message)
         logging.info(f"[Channel] Added message from {message.sender} to channel {self.name}")
-        self.save_to_disk()
         return message
 
+    def merge_messages(self, message_list):
+        """Gộp một lô k tin nhắn vào kênh, bỏ qua tin đã có; trả về số tin được thêm"""
+        bulk = len(message_list) > MERGE_INSERT_MAX
+        added = []
+        for message_data in message_list:
+            message = self.add_message(message_data, insert=not bulk)
+            if message is not None:
+                added.append(message)
+        if bulk and added:
+            self._merge_sorted(added)
+        return len(added)
+
     def add_member(self, username):
-        if username and username != "visitor":
+        if username and username != "visitor" and username not in self.members:
             self.members.add(username)
+            self.meta_seq = self._next_seq()
+            self._record({"op": "member_add", "username": username, "seq": self.seq})
             logging.info(f"[Channel] Added member {username} to channel {self.name}")
-            self.save_to_disk()
 
     def remove_member(self, username):
         if username in self.members:
             self.members.discard(username)
+            self.meta_seq = self._next_seq()
+            self._record({"op": "member_remove", "username": username, "seq": self.seq})
             logging.info(f"[Channel] Removed member {username} from channel {self.name}")
-            self.save_to_disk()
+
+    def set_retention(self, max_messages, max_days):
+        """Đặt giới hạn riêng của kênh (0: không giới hạn); None cho cả hai để dùng mặc định của tracker"""
+        self.retention = None if max_messages is None and max_days is None else {"messages": max_messages or 0, "days": max_days or 0}
+        self._next_seq()
+        self._record({"op": "retention", "retention": self.retention, "seq": self.seq})
+        logging.info(f"[Channel] Set retention of channel {self.name} to {self.retention}")
+
+    def set_host(self, host):
+        if host != self.host:
+            self.host = host
+            self.meta_seq = self._next_seq()
+            self._record({"op": "host", "host": host, "seq": self.seq})
+
+    def apply_record(self, record):
+        """Áp dụng một bản ghi log (khi replay) mà không ghi lại vào log"""
+        op = record.get("op")
+        if op == "message":
+            self._apply_message(record["message"], record["message"].get("seq"))
+            return
+        if op == "retention":
+            self.retention = record.get("retention")
+            self._next_seq(record.get("seq"))
+            return
+        if op == "member_add":
+            self.members.add(record["username"])
+        elif op == "member_remove":
+            self.members.discard(record["username"])
+        elif op in ("host", "create"):
+            self.host = record["host"]
+            if op == "create" and record["host"]:
+                self.members.add(record["host"])
+        self.meta_seq = self._next_seq(record.get("seq"))
+
+    def _load_messages(self, message_dicts):
+        """Nạp tin nhắn từ snapshot; tin nhắn cũ chưa có seq được đánh số theo thứ tự thời gian"""
+        messages = []
+        for data in message_dicts:
+            message = Message.from_dict(data)
+            if message.id in self._by_id:
+                continue
+            self._by_id[message.id] = message
+            messages.append(message)
+        messages.sort(key=lambda msg: (msg.timestamp, msg.id))
+        for message in messages:
+            if not message.seq:
+                message.seq = self.seq + 1
+            self.seq = max(self.seq, message.seq)
+        self.messages = messages
+        self._sort_keys = [(msg.timestamp, msg.id) for msg in messages]
+        self._by_seq = sorted(messages, key=lambda msg: msg.seq)
+        self._seq_keys = [msg.seq for msg in self._by_seq]
+        self.approx_bytes = CHANNEL_OVERHEAD + sum(message_size(m) for m in messages)
+
+    def message_by_seq(self, seq):
+        """Tin nhắn tầng nóng có seq này, None nếu không có"""
+        index = bisect.bisect_left(self._seq_keys, seq)
+        if index < len(self._seq_keys) and self._seq_keys[index] == seq:
+            return self._by_seq[index]
+        return None
+
+    def messages_since(self, cursor):
+        """Các tin nhắn có seq > cursor, theo thứ tự seq; O(log n + k)"""
+        return self._by_seq[bisect.bisect_right(self._seq_keys, cursor):]
+
+    @property
+    def archive(self):
+        if self._archive is None:
+            self._archive = ArchiveStore(self.name)
+        return self._archive
+
+    def retention_limits(self):
+        """(số tin nhắn tối đa, số ngày tối đa) của tầng nóng; 0 là không giới hạn"""
+        return retention_limits(self.retention)
+
+    def enforce_retention(self, min_batch=ARCHIVE_BATCH):
+        """Chuyển các tin nhắn cũ nhất (theo seq) vượt giới hạn số lượng hoặc tuổi sang archive.
+
+        Vượt giới hạn số lượng thì archive ngay, kèm thêm tối đa min_batch tin (không quá nửa giới
+        hạn) để segment không quá nhỏ; tầng nóng không bao giờ vượt giới hạn. Tin quá tuổi chỉ được
+        chuyển khi đủ min_batch tin (vòng quét định kỳ dùng min_batch=1). Sau khi ghi segment, kênh
+        được compact nên snapshot và log không còn chứa các tin đã lưu trữ. Trả về số tin đã chuyển.
+        """
+        max_messages, max_days = self.retention_limits()
+        count = over = 0
+        if max_messages and len(self._by_seq) > max_messages:
+            over = len(self._by_seq) - max_messages
+            count = min(len(self._by_seq), over + min(min_batch, max_messages // 2))
+        if max_days:
+            cutoff = retention_cutoff(max_days)
+            while count < len(self._by_seq) and timestamp_key(self._by_seq[count].timestamp) < cutoff:
+                count += 1
+        if count == 0 or (not over and count < min_batch):
+            return 0
+
+        moved = self._by_seq[:count]
+        # Sau một lần tắt đột ngột, một phần có thể đã nằm trong archive (segment ghi xong trước compact)
+        archived_last = self.archive.last_seq()
+        to_write = [m.to_dict() for m in moved if m.seq > archived_last]
+        if to_write:
+            self.archive.write_segment(to_write)
+
+        moved_ids = {m.id for m in moved}
+        del self._by_seq[:count]
+        del self._seq_keys[:count]
+        self.messages = [m for m in self.messages if m.id not in moved_ids]
+        self._sort_keys = [(m.timestamp, m.id) for m in self.messages]
+        for message in moved:
+            del self._by_id[message.id]
+            self.approx_bytes -= message_size(message)
+            self.archived_until = max(self.archived_until, timestamp_key(message.timestamp))
+        self.archived_seq = max(self.archived_seq, moved[-1].seq)
+        self.log.compact(self.to_dict())
+        logging.info(f"[Channel] Archived {count} messages of channel {self.name} (up to seq {self.archived_seq})")
+        return count
+
+    def history_before(self, before, limit):
+        """Tin nhắn tầng nóng có seq < before (tối đa limit, gần before nhất), theo thứ tự seq"""
+        end = bisect.bisect_left(self._seq_keys, before)
+        return self._by_seq[max(0, end - limit):end]
+
+    def page_messages(self, after=None, before=None, limit=DEFAULT_PAGE_LIMIT):
+        """Một trang tin nhắn theo seq (get_channel phân trang); trả về (tin nhắn, cursor tiếp theo)"""
+        seqs, next_cursor = page_slice(self._seq_keys, after, before, limit)
+        if not seqs:
+            return [], None
+        start = bisect.bisect_left(self._seq_keys, seqs[0])
+        return self._by_seq[start:start + len(seqs)], next_cursor
+
+    def delta_since(self, cursor, limit=None):
+        """Dữ liệu cho get_channel_since: chỉ tin nhắn mới, kèm host/members nếu chúng đã đổi"""
+        if cursor > self.seq:
+            # Cursor của client không thuộc lịch sử này (ví dụ dữ liệu tracker đã bị xoá): gửi lại toàn bộ
+            data = self.to_dict()
+            data["cursor"] = self.seq
+            data["reset"] = True
+            return data
+        messages = self.messages_since(cursor)
+        data = {"name": self.name, "cursor": self.seq}
+        if limit is not None and len(messages) > limit:
+            # Còn tin nhắn sau trang này: client gọi tiếp với cursor là seq của tin nhắn cuối
+            messages = messages[:limit]
+            data["cursor"] = messages[-1].seq
+            data["more"] = True
+        data["messages"] = [m.to_dict() for m in messages]
+        if self.meta_seq > cursor:
+            data["host"] = self.host
+            data["members"] = list(self.members)
+        if cursor < self.archived_seq:
+            # Một phần tin nhắn client chưa có đã nằm trong archive, chỉ đọc được bằng get_history
+            data["archived_seq"] = self.archived_seq
+        return data
 
     def to_dict(self):
         return {
             "name": self.name,
             "host": self.host,
             "members": list(self.members),
-            "messages": [m.to_dict() for m in self.messages]
+            "messages": [m.to_dict() for m in self.messages],
+            "seq": self.seq,
+            "meta_seq": self.meta_seq,
+            "retention": self.retention,
+            "archived_seq": self.archived_seq,
+            "archived_until": self.archived_until
         }
 
-    def save_to_disk(self):
-        # Create data directory if it doesn't exist
-        os.makedirs("data", exist_ok=True)
-        
-        # Save channel data to JSON file
-        with open(f"data/{self.name}.json", "w") as f:
-            json.dump(self.to_dict(), f, indent=2)
-        logging.info(f"[Channel] Saved channel {self.name} to disk")
+    def save_to_disk(self, retention=True):
+        """Kết thúc một thay đổi của kênh (gọi khi giữ channel_lock); trả về hàm commit.
+
+        Người gọi chạy commit() sau khi nhả channel_lock và chỉ trả lời client sau đó: các lệnh
+        ghi cùng lúc chờ chung một lần write/fsync (group commit) thay vì lần lượt trong lock.
+        Archive và compact (hiếm) vẫn chạy ngay vì chúng thay đổi kênh. retention=False (standby)
+        bỏ qua archive: tầng nóng của standby chỉ đổi theo bản ghi của primary.
+        """
+        if not (retention and self.enforce_retention()) and self.log.needs_compaction(len(self.messages)):
+            self.log.compact(self.to_dict())
+        return functools.partial(self.log.commit, self.log.appended)
+
+    def snapshot_state(self):
+        """State của kênh cho snapshot gộp (SnapshotStore): metadata và các cột tin nhắn"""
+        messages = self.messages
+        return {
+            "name": self.name,
+            "host": self.host,
+            "members": list(self.members),
+            "seq": self.seq,
+            "meta_seq": self.meta_seq,
+            "retention": self.retention,
+            "archived_seq": self.archived_seq,
+            "archived_until": self.archived_until,
+            "count": len(messages),
+            "oldest": self._by_seq[0].timestamp if self._by_seq else "",
+            # Nếu snapshot riêng của kênh đổi sau lần ghi này, nó mới hơn snapshot gộp
+            "channel_file": file_signature(self.log.snapshot_path),
+            "columns": {
+                "sender": [m.sender for m in messages],
+                "content": [m.content for m in messages],
+                "channel": [m.channel for m in messages],
+                "timestamp": [m.timestamp for m in messages],
+                "seq": [m.seq for m in messages],
+                "id": [m.id for m in messages]
+            }
+        }
+
+    @classmethod
+    def load_from_snapshot(cls, channel_name, entry, columns):
+        """Dựng kênh từ khối dạng cột của snapshot gộp rồi replay phần log mới hơn snapshot"""
+        channel = cls(channel_name, entry["host"], persist=False)
+        channel.members = set(entry["members"])
+        # Các cột đã theo thứ tự (timestamp, id) và có sẵn id nên không cần sắp xếp hay băm lại
+        messages = [
+            Message(sender, content, ch, timestamp, seq, message_id)
+            for sender, content, ch, timestamp, seq, message_id in zip(
+                columns["sender"], columns["content"], columns["channel"],
+                columns["timestamp"], columns["seq"], columns["id"])
+        ]
+        channel.messages = messages
+        channel._by_id = {m.id: m for m in messages}
+        channel._sort_keys = list(zip(columns["timestamp"], columns["id"]))
+        channel._by_seq = sorted(messages, key=lambda msg: msg.seq)
+        channel._seq_keys = [msg.seq for msg in channel._by_seq]
+        channel.approx_bytes = CHANNEL_OVERHEAD + sum(message_size(m) for m in messages)
+        channel.seq = entry["seq"]
+        channel.meta_seq = entry["meta_seq"]
+        channel.retention = entry.get("retention")
+        channel.archived_seq = entry.get("archived_seq", 0)
+        channel.archived_until = entry.get("archived_until", "")
+        channel.snapshot_entry = entry
+
+        for record in channel.log.replay():
+            if record_seq(record) > entry["seq"]:
+                channel.apply_record(record)
+        return channel
 
     @classmethod
     def load_from_disk(cls, channel_name):
         try:
-            with open(f"data/{channel_name}.json", "r") as f:
-                data = json.load(f)
-                channel = cls(data["name"], data["host"])
+            log = ChannelLog(channel_name)
+            data = log.read_snapshot()
+            records = log.replay()
+            if data is None and not records:
+                return None
+
+            if data is not None:
+                channel = cls(data["name"], data["host"], persist=False)
                 channel.members = set(data["members"])
-                channel.messages = [Message.from_dict(m) for m in data["messages"]]
-                
-                # Sắp xếp tin nhắn theo thời gian
-                try:
-                    channel.messages.sort(key=lambda msg: msg.timestamp)
-                    logging.info(f"[Channel] Messages sorted by timestamp after loading channel {channel_name}")
-                except Exception as e:
-                    logging.error(f"[Channel] Error sorting messages for channel {channel_name}: {e}")
-                
-                return channel
-        except (FileNotFoundError, json.JSONDecodeError):
+                channel._load_messages(data["messages"])
+                channel.seq = max(channel.seq, data.get("seq", 0))
+                channel.meta_seq = data.get("meta_seq", 0)
+                channel.retention = data.get("retention")
+                channel.archived_seq = data.get("archived_seq", 0)
+                channel.archived_until = data.get("archived_until", "")
+            else:
+                # Kênh chưa từng được compact: dựng lại hoàn toàn từ log
+                channel = cls(channel_name, None, persist=False)
+                channel.members.clear()
+            channel.log = log
+
+            for record in records:
+                channel.apply_record(record)
+            
+            return channel
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
             return None
 
-peer_list = []
-channels = {}  # Store channels on the tracker
-peer_lock = threading.Lock()  # Lock for thread-safe access to peer_list
-channel_lock = threading.RLock()  # Lock for thread-safe access to channels (RLock allows recursive locking)
+class ChannelMeta:
+    """Metadata của kênh luôn nằm trong bộ nhớ, kể cả khi tin nhắn của kênh đã bị evict"""
+    __slots__ = ("name", "host", "members", "message_count", "seq", "meta_seq", "retention", "oldest")
+
+    def __init__(self, name, host, members, message_count, seq, meta_seq, retention=None, oldest=None):
+        self.name = name
+        self.host = host
+        self.members = members
+        self.message_count = message_count
+        self.seq = seq
+        self.meta_seq = meta_seq
+        self.retention = retention
+        self.oldest = oldest  # timestamp của tin có seq nhỏ nhất ở tầng nóng, None nếu không biết
+
+    @classmethod
+    def of(cls, channel):
+        oldest = channel._by_seq[0].timestamp if channel._by_seq else ""
+        return cls(channel.name, channel.host, set(channel.members), len(channel.messages), channel.seq, channel.meta_seq,
+                   channel.retention, oldest)
+
+    def needs_retention(self):
+        """Kênh chưa nạp có thể có tin vượt giới hạn lưu giữ (theo metadata, không đọc tin nhắn)"""
+        max_messages, max_days = retention_limits(self.retention)
+        if max_messages and self.message_count > max_messages:
+            return True
+        if max_days and self.message_count:
+            return self.oldest is None or timestamp_key(self.oldest) < retention_cutoff(max_days)
+        return False
+
+class ChannelCache:
+    """Tập kênh của tracker với ngân sách bộ nhớ, dùng như một dict tên -> Channel.
+
+    Metadata (host, members, số tin nhắn, seq) của mọi kênh luôn thường trú; tin nhắn chỉ
+    được nạp khi kênh được truy cập (channels[tên]) và kênh ít dùng nhất bị evict (LRU)
+    khi tổng approx_bytes vượt budget. Kênh bị evict đã nằm trọn trên disk (log đã commit)
+    nên được dựng lại từ snapshot gộp hoặc file riêng của kênh khi cần. Mọi truy cập phải
+    giữ channel_lock.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self._loaded = OrderedDict()  # tên -> Channel, kênh dùng gần nhất ở cuối
+        self._meta = {}  # tên -> ChannelMeta của kênh chưa nạp
+        self._entries = {}  # tên -> mục manifest, cho kênh chưa nạp còn dựng được từ snapshot gộp
+        self._bytes = {}  # tên -> approx_bytes đã tính vào tổng
+        self.total_bytes = 0
+        self._last_touched = None
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, name):
+        return name in self._loaded or name in self._meta
+
+    def __len__(self):
+        return len(self._loaded) + len(self._meta)
+
+    def __iter__(self):
+        return iter(list(self._loaded) + list(self._meta))
+
+    def __getitem__(self, name):
+        channel = self._loaded.get(name)
+        if channel is None:
+            if name not in self._meta:
+                raise KeyError(name)
+            channel = load_channel(name, self._entries.get(name))
+            if channel is None:
+                raise KeyError(name)
+            del self._meta[name]
+            self._entries.pop(name, None)
+            self._loaded[name] = channel
+            self.loads += 1
+            logging.info(f"[Tracker] Loaded channel {name} into cache ({len(channel.messages)} messages)")
+        else:
+            self._loaded.move_to_end(name)
+        self._touch(name)
+        return channel
+
+    def __setitem__(self, name, channel):
+        self._meta.pop(name, None)
+        self._entries.pop(name, None)
+        self._loaded[name] = channel
+        self._loaded.move_to_end(name)
+        self._touch(name)
+
+    def discard(self, name):
+        """Bỏ kênh khỏi cache (kênh đã bị xoá); trả về Channel nếu kênh đang nạp"""
+        channel = self._loaded.pop(name, None)
+        if channel is not None:
+            channel.log.close()
+        self._meta.pop(name, None)
+        self._entries.pop(name, None)
+        self._account(name)
+        if self._last_touched == name:
+            self._last_touched = None
+        return channel
+
+    def add_unloaded(self, name, entry):
+        """Đăng ký kênh có trong snapshot gộp mà không giải mã tin nhắn"""
+        self._meta[name] = ChannelMeta(name, entry["host"], set(entry["members"]), entry["count"], entry["seq"], entry["meta_seq"],
+                                       entry.get("retention"), entry.get("oldest"))
+        self._entries[name] = entry
+
+    def peek(self, name):
+        """Metadata của kênh mà không nạp tin nhắn (không đổi thứ tự LRU)"""
+        channel = self._loaded.get(name)
+        if channel is not None:
+            return ChannelMeta.of(channel)
+        return self._meta.get(name)
+
+    def loaded(self):
+        return list(self._loaded.values())
+
+    def unloaded_meta(self):
+        """[(tên, ChannelMeta)] của các kênh chưa nạp"""
+        return list(self._meta.items())
+
+    def peek_loaded(self, name):
+        """(Channel, None) nếu kênh đang nạp, (None, mục manifest) nếu chưa; không đổi thứ tự LRU"""
+        channel = self._loaded.get(name)
+        if channel is not None:
+            return channel, None
+        return None, self._entries.get(name)
+
+    def seqs(self):
+        current = {name: meta.seq for name, meta in self._meta.items()}
+        current.update((name, channel.seq) for name, channel in self._loaded.items())
+        return current
+
+    def snapshot_state(self, name):
+        """State cho snapshot gộp; kênh chưa nạp được chép nguyên khối cũ nếu khối đó còn dùng được"""
+        channel = self._loaded.get(name)
+        if channel is not None:
+            return channel.snapshot_state()
+        entry = self._entries.get(name)
+        if entry is None or not snapshot_entry_fresh(name, entry):
+            # Kênh bị evict khi chưa có trong snapshot gộp: đọc tạm từ file riêng, không đưa vào cache
+            channel = Channel.load_from_disk(name)
+            return channel.snapshot_state() if channel is not None else None
+        state = {key: value for key, value in entry.items() if key not in ("offset", "length")}
+        state["name"] = name
+        state["blob"] = get_snapshot_store().read_blob(entry)
+        return state
+
+    def rebind_snapshot(self, entries):
+        """Sau khi ghi snapshot gộp mới: trỏ các kênh sang mục manifest mới"""
+        for name, entry in entries.items():
+            channel = self._loaded.get(name)
+            if channel is not None:
+                channel.snapshot_entry = entry
+            elif name in self._meta:
+                self._entries[name] = entry
+
+    def _account(self, name):
+        channel = self._loaded.get(name)
+        size = channel.approx_bytes if channel is not None else 0
+        self.total_bytes += size - self._bytes.get(name, 0)
+        if channel is not None:
+            self._bytes[name] = size
+        else:
+            self._bytes.pop(name, None)
+
+    def _touch(self, name):
+        # Kênh được thay đổi ngay sau khi truy cập, nên kích thước của kênh truy cập trước đó
+        # được cập nhật ở lần truy cập kế tiếp
+        if self._last_touched is not None and self._last_touched != name:
+            self._account(self._last_touched)
+        self._account(name)
+        self._last_touched = name
+        self._evict(keep=name)
+
+    def _evict(self, keep):
+        if self.total_bytes <= self.budget:
+            return
+        for name in list(self._loaded):
+            if self.total_bytes <= self.budget:
+                break
+            if name == keep:
+                continue
+            channel = self._loaded.pop(name)
+            # Commit để mọi thay đổi đã nằm trên disk trước khi bỏ bản trong bộ nhớ
+            channel.log.close()
+            self._meta[name] = ChannelMeta.of(channel)
+            if channel.snapshot_entry is not None and snapshot_entry_fresh(name, channel.snapshot_entry):
+                self._entries[name] = channel.snapshot_entry
+            self._account(name)
+            if self._last_touched == name:
+                self._last_touched = None
+            self.evictions += 1
+            logging.info(f"[Tracker] Evicted channel {name} from cache")
+
+def snapshot_entry_fresh(name, entry):
+    """Mục manifest còn dùng được nếu snapshot riêng của kênh không đổi kể từ khi ghi snapshot gộp"""
+    return entry.get("channel_file") == file_signature(os.path.join("data", f"{name}.json"))
+
+def load_channel(name, entry=None):
+    """Dựng kênh từ snapshot gộp nếu mục manifest còn dùng được, nếu không thì từ file riêng của kênh"""
+    if entry is not None and snapshot_entry_fresh(name, entry):
+        return Channel.load_from_snapshot(name, entry, get_snapshot_store().read_columns(entry))
+    return Channel.load_from_disk(name)
+
+class PeerRegistry:
+    """Danh sách peer của tracker, có chỉ mục theo địa chỉ, username và trạng thái.
+
+    Mọi thay đổi username/status phải đi qua registry để các chỉ mục luôn đúng.
+    Danh sách JSON trả về cho get_list được cache và chỉ dựng lại khi registry thay đổi.
+    """
+    STATUSES = ("online", "invisible", "offline")
+
+    def __init__(self):
+        self.lock = InstrumentedLock("peer_lock")
+        self._by_addr = {}  # (ip, port) -> Peer
+        self._by_username = {}  # username -> {(ip, port): Peer}
+        self._by_ip = {}  # ip -> {(ip, port)}
+        self._by_status = {status: set() for status in self.STATUSES}  # status -> {(ip, port)}
+        self._version = 0
+        self._snapshot = None
+        self._snapshot_version = -1
+        self._sorted_keys = []  # Cursor "ip:port" đã sắp xếp, dùng cho get_list phân trang
+        self._sorted_version = -1
+
+    @staticmethod
+    def _key(ip, port):
+        return (ip, str(port))
+
+    def __len__(self):
+        return len(self._by_addr)
+
+    def _index(self, peer):
+        key = self._key(peer.ip, peer.port)
+        self._by_username.setdefault(peer.username, {})[key] = peer
+        self._by_ip.setdefault(peer.ip, set()).add(key)
+        self._by_status.setdefault(peer.status, set()).add(key)
+
+    def _unindex(self, peer):
+        key = self._key(peer.ip, peer.port)
+        same_name = self._by_username.get(peer.username)
+        if same_name is not None:
+            same_name.pop(key, None)
+            if not same_name:
+                del self._by_username[peer.username]
+        same_ip = self._by_ip.get(peer.ip)
+        if same_ip is not None:
+            same_ip.discard(key)
+            if not same_ip:
+                del self._by_ip[peer.ip]
+        self._by_status.get(peer.status, set()).discard(key)
+
+    def _changed(self):
+        self._version += 1
+
+    def add(self, peer):
+        with self.lock:
+            old = self._by_addr.get(self._key(peer.ip, peer.port))
+            if old is not None:
+                self._unindex(old)
+            self._by_addr[self._key(peer.ip, peer.port)] = peer
+            self._index(peer)
+            self._changed()
+            replication_log.append({"peer": peer.to_dict()})
+            return peer
+
+    def update(self, peer, username=None, status=None):
+        """Đổi username và/hoặc status của peer, cập nhật lại chỉ mục"""
+        with self.lock:
+            if (username is None or username == peer.username) and (status is None or status == peer.status):
+                return peer
+            self._unindex(peer)
+            if username is not None:
+                peer.username = username
+            if status is not None:
+                peer.status = status
+            self._index(peer)
+            self._changed()
+            replication_log.append({"peer": peer.to_dict()})
+            return peer
+
+    def remove(self, peer):
+        with self.lock:
+            key = self._key(peer.ip, peer.port)
+            if self._by_addr.get(key) is peer:
+                del self._by_addr[key]
+                self._unindex(peer)
+                self._changed()
+                replication_log.append({"peer_removed": [peer.ip, peer.port]})
+
+    def get_by_addr(self, ip, port):
+        return self._by_addr.get(self._key(ip, port))
+
+    def get_by_username(self, username):
+        """Trả về peer có username này; nếu nhiều peer trùng tên, ưu tiên peer được thấy gần nhất"""
+        with self.lock:
+            same_name = self._by_username.get(username)
+            if not same_name:
+                return None
+            if len(same_name) == 1:
+                return next(iter(same_name.values()))
+            return max(same_name.values(), key=lambda p: p.last_seen)
+
+    def get_by_ip(self, ip):
+        with self.lock:
+            keys = self._by_ip.get(ip)
+            if not keys:
+                return None
+            return self._by_addr[next(iter(keys))]
+
+    def with_status(self, *statuses):
+        with self.lock:
+            return [self._by_addr[key] for status in statuses for key in self._by_status.get(status, ())]
+
+    def all(self):
+        with self.lock:
+            return list(self._by_addr.values())
+
+    def snapshot_json(self):
+        """JSON (bytes) của toàn bộ danh sách peer, chỉ dựng lại khi registry đã thay đổi"""
+        with self.lock:
+            if self._snapshot_version != self._version:
+                self._snapshot = json.dumps([p.to_dict() for p in self._by_addr.values()]).encode()
+                self._snapshot_version = self._version
+            return self._snapshot
+
+    def page(self, after=None, before=None, limit=DEFAULT_PAGE_LIMIT):
+        """Một trang peer theo thứ tự cursor "ip:port": trả về (danh sách dict, cursor tiếp theo)"""
+        with self.lock:
+            if self._sorted_version != self._version:
+                self._sorted_keys = sorted(f"{ip}:{port}" for ip, port in self._by_addr)
+                self._sorted_version = self._version
+            keys, next_cursor = page_slice(self._sorted_keys, after, before, limit)
+            peers = []
+            for key in keys:
+                ip, _, port = key.rpartition(":")
+                peers.append(self._by_addr[(ip, port)].to_dict())
+            return peers, next_cursor
+
+replication_log = ReplicationLog()  # Journal thay đổi cho standby (lệnh replicate)
+peer_registry = PeerRegistry()
+CHANNEL_CACHE_MB = 512  # Ngân sách bộ nhớ cho tin nhắn của các kênh (--channel-cache-mb)
+channels = ChannelCache(CHANNEL_CACHE_MB * 1024 * 1024)  # Store channels on the tracker
+peer_lock = peer_registry.lock  # Lock của registry, dùng khi cần nhiều thao tác liên tiếp trên peer
+channel_lock = InstrumentedLock("channel_lock")  # Lock for thread-safe access to channels (RLock, đo thời gian chờ cho lệnh stats)
+
+TRACKER_PORT = 12345
+# Cấu hình cho chế độ asyncio
+MAX_CONNECTIONS = 10000  # Số kết nối đồng thời tối đa, kết nối vượt quá sẽ bị đóng ngay
+MAX_REQUEST_SIZE = 16 * 1024 * 1024  # Giới hạn kích thước một lệnh
+READ_BUFFER_LIMIT = 64 * 1024  # Bộ đệm đọc của mỗi kết nối; lệnh lớn hơn được đọc thành nhiều phần
+MAX_IN_FLIGHT = 256  # Số lệnh đang đọc, chờ hoặc chạy tối đa trên mọi kết nối (--max-in-flight)
+IDLE_TIMEOUT = 300  # Đóng kết nối không gửi gì trong 5 phút
+REQUEST_WORKERS = 32  # Số thread xử lý lệnh (lệnh có thể chạm disk hoặc kết nối tới peer)
+LISTEN_BACKLOG = 1024
+PIPELINE_DEPTH = 64  # Số lệnh có request id chạy cùng lúc tối đa trên một kết nối
+HEARTBEAT_TIMEOUT = 35  # Agent gửi heartbeat mỗi 10 giây; quá hạn này sẽ bị probe
+PURGE_AFTER = 300  # Xoá peer đã offline quá 5 phút
+STATUS_FRESHNESS = 15  # check_status tin trạng thái đã biết nếu peer được thấy trong chừng này giây
+STATUS_STALE_AFTER = HEARTBEAT_TIMEOUT  # Quá hạn này check_status trả về "stale" thay vì "online" khi chờ probe
+CHECK_STATUS_MANY_LIMIT = 1000  # Số username tối đa của một lệnh check_status_many
+FANOUT_WORKERS = 8  # Số thread gửi status_update tới các peer
+FANOUT_IDLE_TIMEOUT = 20  # Đóng kết nối status_update rảnh trước khi peer tự đóng (PEER_IDLE_TIMEOUT = 60)
+SUBSCRIBER_BUFFER_LIMIT = 4 * 1024 * 1024  # Dữ liệu chưa gửi tối đa của một subscriber (asyncio)
+SUBSCRIBER_QUEUE_LIMIT = 1000  # Số frame chờ gửi tối đa của một subscriber (threaded)
+# Chế độ shard: process chính (router) giữ registry peer, các process shard giữ kênh
+SHARD_INDEX = None  # Chỉ số shard nếu process này là một shard
+SHARD_COUNT = 0
+shard_router = None  # ShardRouter nếu process này là router
+SNAPSHOT_INTERVAL = 300  # Ghi snapshot gộp của mọi kênh mỗi 5 phút (nếu có thay đổi) và khi tắt
+snapshot_store = None
+# Chế độ standby: đọc theo journal của primary, chỉ phục vụ lệnh đọc cho tới khi được promote
+standby_of = None  # (host, port) của primary nếu process này là standby
+PROMOTE_AFTER = 5  # Tự promote khi mất liên lạc với primary quá số giây này (0: chỉ promote bằng lệnh)
+REPLICATION_POLL = 1  # Thời gian primary giữ một lệnh replicate khi chưa có thay đổi mới
+REPLICATION_BATCH = 1000  # Số bản ghi tối đa mỗi phản hồi replicate
+STANDBY_COMMANDS = ("get_list", "ping", "check_status", "check_status_many", "get_channel", "get_channel_since", "get_history",
+                    "search", "list_channels", "debug", "stats", "promote")
+SEARCH_INDEX = True  # Dựng chỉ mục tìm kiếm khi khởi động (--no-search-index để tắt)
+SEARCH_MAX_WINDOW = 1000  # offset + limit tối đa của lệnh search (kết quả xếp hạng, không đọc quá sâu)
+search_index = SearchIndex()
+search_indexed = {}  # tên kênh -> seq lớn nhất đã đưa vào chỉ mục (chỉ có khi kênh đã được dựng xong)
+search_index_ready = False  # Mọi kênh đã được dựng; kênh mới sau đó được index ngay từ tin đầu tiên
+# Giới hạn tần suất theo IP client và nhóm lệnh: (số lệnh mỗi giây, burst). Lệnh vượt giới hạn
+# nhận "RETRY_AFTER <giây>" mà không chiếm worker, nên client gửi dồn không làm chậm các peer khác.
+RATE_LIMITS = {
+    "cheap": (20, 60),  # heartbeat, ping, check_status
+    "read": (10, 50),  # danh sách, tải kênh, lịch sử
+    "write": (10, 50),  # đăng ký, gửi tin nhắn, join
+    "search": (2, 10),
+}
+COMMAND_GROUPS = {
+    "heartbeat": "cheap", "ping": "cheap", "check_status": "cheap", "check_status_many": "cheap",
+    "send_info": "write", "sync_channel": "write", "join_channel": "write", "set_retention": "write",
+    "search": "search",
+    # Kênh sự kiện và lệnh replicate của standby là kết nối giữ lâu, không giới hạn (các lệnh
+    # khác trên cùng kết nối, kể cả get_channel khi standby đồng bộ lại, vẫn bị giới hạn)
+    "subscribe": None, "replicate": None, "promote": None,
+}
+rate_limiter = RateLimiter(RATE_LIMITS)  # None: tắt giới hạn (--rate-limit 0, và trong các shard)
+active_connections = 0
+queued_requests = 0  # Số lệnh đang chờ hoặc đang chạy trong pool worker (chế độ asyncio)
+request_slots = None  # asyncio.Semaphore(MAX_IN_FLIGHT), tạo trong serve_async
 
 # Load saved channels from disk on startup
 def load_channels():
@@ -168,17 +1174,215 @@ def load_channels():
         
     try:
         # Load all channel files
+        channel_names = set()
         for filename in os.listdir("data"):
-            if filename.endswith(".json") and not filename.startswith("user_"):
-                channel_name = filename[:-5]  # Remove .json extension
-                channel = Channel.load_from_disk(channel_name)
-                if channel:
-                    with channel_lock:
-                        channels[channel_name] = channel
-                        logging.info(f"[Tracker] Loaded channel {channel_name} with {len(channel.messages)} messages")
+            if filename.startswith("user_"):
+                continue
+            if filename.endswith(".json"):
+                channel_names.add(filename[:-5])  # Remove .json extension
+            elif filename.endswith(".log"):
+                channel_names.add(filename[:-4])  # Kênh chỉ có log, chưa có snapshot
+        # Snapshot gộp: kênh có trong manifest được dựng từ file đã mmap thay vì parse file riêng
+        manifest = get_snapshot_store().open()
+        channel_names.update(manifest)
+        if SHARD_INDEX is not None:
+            # Mỗi shard chỉ nạp các kênh mà nó sở hữu
+            ring = HashRing(range(SHARD_COUNT))
+            channel_names = {name for name in channel_names if ring.owner(name) == SHARD_INDEX}
+        from_snapshot = 0
+        for channel_name in channel_names:
+            entry = manifest.get(channel_name)
+            if entry is not None and snapshot_entry_fresh(channel_name, entry):
+                # Chỉ metadata; tin nhắn được nạp khi kênh được truy cập lần đầu
+                with channel_lock:
+                    channels.add_unloaded(channel_name, entry)
+                from_snapshot += 1
+                continue
+            # Kênh mới hơn snapshot gộp (hoặc đã được compact riêng sau đó)
+            channel = Channel.load_from_disk(channel_name)
+            if channel:
+                with channel_lock:
+                    channels[channel_name] = channel
+                    logging.info(f"[Tracker] Loaded channel {channel_name} with {len(channel.messages)} messages")
+        logging.info(f"[Tracker] Loaded {len(channels)} channels ({from_snapshot} lazily from snapshot)")
     except Exception as e:
         logging.error(f"[Tracker] Error loading channels: {e}")
 
+def remove_channel_files(name):
+    """Xoá snapshot, log và archive của một kênh trên disk"""
+    for suffix in (".json", ".log"):
+        try:
+            os.remove(os.path.join("data", f"{name}{suffix}"))
+        except FileNotFoundError:
+            pass
+    shutil.rmtree(ArchiveStore(name).dir, ignore_errors=True)
+
+def get_snapshot_store():
+    global snapshot_store
+    if snapshot_store is None:
+        snapshot_store = SnapshotStore("tracker" if SHARD_INDEX is None else f"shard{SHARD_INDEX}")
+    return snapshot_store
+
+def write_snapshot():
+    """Ghi snapshot gộp của mọi kênh; mỗi kênh chỉ bị khoá trong lúc chép các cột của nó"""
+    with channel_lock:
+        names = list(channels)
+    states = []
+    for name in names:
+        with channel_lock:
+            state = channels.snapshot_state(name) if name in channels else None
+        if state is not None:
+            states.append(state)
+    store = get_snapshot_store()
+    manifest = store.write(states)
+    with channel_lock:
+        store.open()
+        channels.rebind_snapshot(manifest["channels"])
+
+def snapshot_loop(interval):
+    """Ghi snapshot định kỳ, bỏ qua nếu không kênh nào thay đổi kể từ lần trước"""
+    last = None
+    while True:
+        time.sleep(interval)
+        try:
+            with channel_lock:
+                current = channels.seqs()
+            if current != last:
+                write_snapshot()
+                last = current
+        except Exception as e:
+            logging.error(f"[Tracker] Error writing snapshot: {e}")
+
+def start_snapshot_thread(interval):
+    if interval > 0:
+        threading.Thread(target=snapshot_loop, args=(interval,), name="snapshot", daemon=True).start()
+
+def sweep_retention():
+    """Áp dụng giới hạn lưu giữ cho mọi kênh; trả về số tin đã archive.
+
+    Kênh đang nạp được kiểm tra trực tiếp; kênh chưa nạp hoặc đã bị evict chỉ được nạp khi
+    metadata của nó (số tin, timestamp tin cũ nhất) cho thấy có tin cần chuyển.
+    """
+    with channel_lock:
+        names = [channel.name for channel in channels.loaded()]
+        names += [name for name, meta in channels.unloaded_meta() if meta.needs_retention()]
+    archived = 0
+    for name in names:
+        with channel_lock:
+            if name in channels:
+                archived += channels[name].enforce_retention(min_batch=1)
+    return archived
+
+def retention_loop(interval):
+    """Định kỳ áp dụng giới hạn lưu giữ (giới hạn tuổi vẫn đến hạn khi kênh không có ghi mới)"""
+    while True:
+        time.sleep(interval)
+        if standby_of is not None:
+            continue  # Standby chỉ áp dụng thay đổi của primary
+        try:
+            archived = sweep_retention()
+            if archived:
+                logging.info(f"[Tracker] Retention sweep archived {archived} messages")
+        except Exception as e:
+            logging.error(f"[Tracker] Error enforcing retention: {e}")
+
+def start_retention_thread(interval=RETENTION_SWEEP_INTERVAL):
+    threading.Thread(target=retention_loop, args=(interval,), name="retention", daemon=True).start()
+
+def index_message(channel_name, message):
+    """Đưa một tin nhắn mới vào chỉ mục tìm kiếm (gọi khi giữ channel_lock).
+
+    Kênh chưa được thread dựng chỉ mục xử lý thì bỏ qua: thread đó sẽ đọc cả tin này.
+    """
+    last = search_indexed.get(channel_name)
+    if last is None:
+        if not (SEARCH_INDEX and search_index_ready):
+            return
+        last = 0
+    if message.seq > last:
+        search_index.add(channel_name, message.seq, message.sender, message.timestamp, message.content)
+        search_indexed[channel_name] = message.seq
+
+def index_new_messages(channel):
+    """Index các tin nhắn của kênh mới hơn phần đã index (sau khi standby áp dụng bản ghi hoặc tải lại kênh)"""
+    if channel.name not in search_indexed:
+        return
+    for message in channel.messages_since(search_indexed[channel.name]):
+        index_message(channel.name, message)
+
+def index_channel(name):
+    """Dựng chỉ mục cho một kênh: phần lưu trữ rồi tầng nóng, phần lớn công việc nằm ngoài channel_lock"""
+    with channel_lock:
+        if name in search_indexed or name not in channels:
+            return 0
+        channel, entry = channels.peek_loaded(name)
+        seq_seen = channels.peek(name).seq
+        hot = list(channel._by_seq) if channel is not None else None
+    if hot is None:
+        # Kênh chưa nạp: đọc một bản tạm, không đưa vào cache để không đẩy các kênh đang dùng ra ngoài
+        loaded = load_channel(name, entry)
+        hot = loaded._by_seq if loaded is not None else []
+    last = 0
+    count = 0
+    # Tin nhắn bị lưu trữ sau khi chép tầng nóng vẫn nằm trong hot, nên không bỏ sót tin nào
+    for message_data in ArchiveStore(name).iter_messages():
+        if message_data["seq"] > last:
+            search_index.add(name, message_data["seq"], message_data["sender"], message_data.get("timestamp"), message_data["content"])
+            last = message_data["seq"]
+            count += 1
+    for message in hot:
+        if message.seq > last:
+            search_index.add(name, message.seq, message.sender, message.timestamp, message.content)
+            last = message.seq
+            count += 1
+    with channel_lock:
+        search_indexed[name] = last
+        meta = channels.peek(name)
+        if meta is not None and meta.seq != seq_seen:
+            # Kênh có thay đổi trong lúc dựng: index phần còn thiếu
+            channel = channels[name]
+            if channel.archived_seq > last:
+                for message_data in channel.archive.iter_messages():
+                    if message_data["seq"] > search_indexed[name]:
+                        message = Message.from_dict(message_data)
+                        index_message(name, message)
+            index_new_messages(channel)
+    return count
+
+def build_search_index():
+    """Dựng chỉ mục tìm kiếm cho mọi kênh khi khởi động; tin nhắn mới được index ngay khi ghi"""
+    global search_index_ready
+    start = time.monotonic()
+    total = 0
+    while True:
+        with channel_lock:
+            pending = [name for name in channels if name not in search_indexed]
+            if not pending:
+                search_index_ready = True
+                break
+        for name in pending:
+            try:
+                total += index_channel(name)
+            except Exception as e:
+                logging.error(f"[Tracker] Error indexing channel {name}: {e}")
+                with channel_lock:
+                    search_indexed.setdefault(name, 0)
+    logging.info(f"[Tracker] Search index built: {total} messages in {time.monotonic() - start:.1f}s")
+
+def start_search_index_thread():
+    if SEARCH_INDEX:
+        threading.Thread(target=build_search_index, name="search-index", daemon=True).start()
+
+def shutdown_channels():
+    """Khi tắt: commit log của mọi kênh rồi ghi snapshot gộp để lần khởi động sau nhanh hơn"""
+    try:
+        with channel_lock:
+            for channel in channels.loaded():
+                channel.log.commit()
+        write_snapshot()
+    except Exception as e:
+        logging.error(f"[Tracker] Error writing snapshot on shutdown: {e}")
+
 def check_peer_status(peer):
     """Kiểm tra trạng thái của peer bằng cách kết nối tới nó"""
     try:
@@ -190,65 +1394,470 @@ def check_peer_status(peer):
     except Exception:
         return False  # Peer offline
 
-def _notify_peers_status_update_worker(changed_peer):
-    notification = json.dumps({
-        "type": "status_update",
-        "username": changed_peer.username,
-        "status": changed_peer.status
-    }).encode() + b'\n'
-    with peer_lock:
-        for peer in peer_list:
-            if peer.username != changed_peer.username and peer.status in ("online", "invisible"):
+class StatusFanout:
+    """Gửi thông báo status_update tới các peer bằng một pool thread cố định.
+
+    notify() chỉ ghi trạng thái mới nhất của người dùng vào một danh sách thay đổi có
+    đánh version (O(1)); một thread điều phối lấy danh sách người nhận từ snapshot của
+    registry một lần cho cả loạt thay đổi và xếp lịch những peer còn thiếu. Mỗi peer nhận
+    có một cursor version và một kết nối được giữ lại giữa các lần gửi, nên khi nhiều peer
+    đăng nhập cùng lúc mỗi peer nhận chỉ phải gửi trạng thái mới nhất của từng người.
+    Kết nối giữ sẵn bị đóng sau idle_timeout giây không dùng, nhỏ hơn hẳn thời gian peer
+    tự đóng kết nối rảnh, và được quét theo chu kỳ.
+    """
+    def __init__(self, workers=8, connect_timeout=2, idle_timeout=20):
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._version = 0
+        self._dispatched = 0  # version tại lần điều phối gần nhất
+        self._changes = OrderedDict()  # username -> (version, payload), version tăng dần
+        self._cursors = {}  # (ip, port) -> version mới nhất đã gửi tới peer đó
+        self._recipients = {}  # (ip, port) -> username của peer nhận
+        self._scheduled = set()  # Các peer đang nằm trong _ready hoặc đang được một worker phục vụ
+        self._conns = {}  # (ip, port) -> (socket, thời điểm dùng lần cuối)
+        self._ready = queue.Queue()
+        self._changed = threading.Event()
+        threading.Thread(target=self._dispatcher, name="status-fanout-dispatch", daemon=True).start()
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"status-fanout-{i}", daemon=True).start()
+
+    def notify(self, changed_peer):
+        payload = json.dumps({
+            "type": "status_update",
+            "username": changed_peer.username,
+            "status": changed_peer.status,
+            "ip": changed_peer.ip,
+            "port": changed_peer.port
+        })
+        with self._lock:
+            self._version += 1
+            self._changes.pop(changed_peer.username, None)
+            self._changes[changed_peer.username] = (self._version, payload)
+        if changed_peer.status == "offline":
+            self.forget((changed_peer.ip, int(changed_peer.port)))
+        self._changed.set()
+
+    def forget(self, key):
+        """Đóng kết nối giữ sẵn tới một peer (peer đã offline hoặc bị xoá)"""
+        with self._lock:
+            entry = self._conns.pop(key, None)
+        if entry is not None:
+            entry[0].close()
+
+    def _dispatcher(self):
+        last_sweep = time.monotonic()
+        while True:
+            if self._changed.wait(timeout=self.idle_timeout / 2):
+                self._changed.clear()
                 try:
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.settimeout(2)
-                    s.connect((peer.ip, int(peer.port)))
-                    s.send(notification)
-                    s.close()
-                except Exception:
-                    pass  # Không cần log lỗi ở đây để tránh spam log
+                    self._schedule()
+                except Exception as e:
+                    logging.error(f"[Tracker] Error scheduling status updates: {e}")
+            if time.monotonic() - last_sweep >= self.idle_timeout / 2:
+                last_sweep = time.monotonic()
+                self._sweep_idle()
+
+    def _schedule(self):
+        """Cập nhật danh sách người nhận và xếp lịch các peer chưa nhận thay đổi mới nhất"""
+        recipients = peer_registry.with_status("online", "invisible")
+        with self._lock:
+            version = self._version
+            cursors = {}
+            self._recipients = {}
+            for peer in recipients:
+                key = (peer.ip, int(peer.port))
+                self._recipients[key] = peer.username
+                if key not in self._cursors:
+                    # Peer mới: nhận các thay đổi từ lần điều phối trước, hoặc từ lần đăng nhập của chính nó nếu sau đó
+                    self._cursors[key] = max(self._dispatched, self._changes.get(peer.username, (0,))[0])
+                cursors[key] = self._cursors[key]
+            self._cursors = cursors
+            self._dispatched = version
+            for key, cursor in cursors.items():
+                if cursor < version and key not in self._scheduled:
+                    self._scheduled.add(key)
+                    self._ready.put(key)
+            # Thay đổi mọi người nhận đã có thì không cần giữ nữa
+            oldest = min(cursors.values(), default=version)
+            while self._changes:
+                name, (changed_version, _) = next(iter(self._changes.items()))
+                if changed_version > oldest:
+                    break
+                del self._changes[name]
+
+    def _sweep_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, (_, used) in self._conns.items()
+                    if now - used > self.idle_timeout and key not in self._scheduled]
+            conns = [self._conns.pop(key)[0] for key in idle]
+        for conn in conns:
+            conn.close()
+
+    def _send(self, key, data):
+        # Thử lại một lần với kết nối mới nếu kết nối cũ đã bị peer đóng
+        for attempt in range(2):
+            with self._lock:
+                entry = self._conns.pop(key, None)
+            conn = entry[0] if entry else None
+            try:
+                if conn is not None and select.select([conn], [], [], 0)[0]:
+                    # Peer không gửi gì trên kết nối này: đọc được nghĩa là đã nhận EOF (hoặc lỗi)
+                    conn.close()
+                    conn = entry = None
+                if conn is None:
+                    conn = socket.create_connection(key, timeout=self.connect_timeout)
+                conn.sendall(data)
+                with self._lock:
+                    self._conns[key] = (conn, time.monotonic())
+                return True
+            except OSError:
+                if conn is not None:
+                    conn.close()
+                if entry is None:
+                    break  # Kết nối mới cũng lỗi, peer không nhận được
+        return False
+
+    def _worker(self):
+        while True:
+            key = self._ready.get()
+            while True:
+                with self._lock:
+                    cursor = self._cursors.get(key)
+                    if cursor is None or cursor >= self._version:
+                        self._scheduled.discard(key)
+                        break
+                    username = self._recipients.get(key)
+                    payloads = []
+                    for name, (changed_version, payload) in reversed(self._changes.items()):
+                        if changed_version <= cursor:
+                            break
+                        if name != username:
+                            payloads.append(payload)
+                    self._cursors[key] = self._version
+                if payloads:
+                    # Lỗi gửi bị bỏ qua (không log) để tránh spam log khi peer đã tắt
+                    self._send(key, b"".join(encode_frame(payload) for payload in reversed(payloads)))
+
+status_fanout = StatusFanout(FANOUT_WORKERS, idle_timeout=FANOUT_IDLE_TIMEOUT)
 
 def notify_peers_status_update(changed_peer):
-    """Gửi thông báo trạng thái mới của peer đến các peer khác đang online trong một thread riêng"""
-    threading.Thread(target=_notify_peers_status_update_worker, args=(changed_peer,), daemon=True).start()
+    """Đưa thông báo trạng thái mới của peer vào hàng đợi gửi tới các peer khác đang online"""
+    status_fanout.notify(changed_peer)
 
-def update_peer_status():
-    """Cập nhật trạng thái của tất cả các peer theo định kỳ"""
-    while True:
+class SubscriptionHub:
+    """Các kết nối subscribe của client, theo kênh.
+
+    Sau mỗi thay đổi của một kênh, tracker đẩy một sự kiện (cùng định dạng với phản hồi
+    get_channel_since) tới các subscriber của kênh đó; sự kiện tạo kênh được đẩy tới mọi
+    subscriber. Subscriber "*" (router của chế độ shard) nhận sự kiện của mọi kênh.
+    Subscriber.send() không bao giờ chặn nên có thể gọi khi đang giữ channel_lock.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # subscriber -> set tên kênh
+        self._by_channel = {}  # tên kênh -> set subscriber
+        self._wildcard = set()
+
+    def subscribe(self, subscriber, channel_names, wildcard=False):
+        """Đăng ký (hoặc thay thế) danh sách kênh của subscriber"""
+        with self._lock:
+            self._remove(subscriber)
+            self._subscribers[subscriber] = set(channel_names)
+            for name in channel_names:
+                self._by_channel.setdefault(name, set()).add(subscriber)
+            if wildcard:
+                self._wildcard.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._remove(subscriber)
+
+    def _remove(self, subscriber):
+        for name in self._subscribers.pop(subscriber, ()):
+            subs = self._by_channel.get(name)
+            if subs is not None:
+                subs.discard(subscriber)
+                if not subs:
+                    del self._by_channel[name]
+        self._wildcard.discard(subscriber)
+
+    def has_subscribers(self, channel_name):
+        return bool(self._wildcard) or channel_name in self._by_channel
+
+    def publish(self, channel_name, frame):
+        with self._lock:
+            targets = self._by_channel.get(channel_name, set()) | self._wildcard
+        for subscriber in targets:
+            subscriber.send(frame)
+
+    def publish_all(self, frame):
+        with self._lock:
+            targets = list(self._subscribers)
+        for subscriber in targets:
+            subscriber.send(frame)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+subscription_hub = SubscriptionHub()
+
+class AsyncSubscriber:
+    """Subscriber trên một kết nối asyncio; send() có thể gọi từ bất kỳ thread nào"""
+    def __init__(self, username, loop, writer):
+        self.username = username
+        self.loop = loop
+        self.writer = writer
+
+    def send(self, frame):
+        self.loop.call_soon_threadsafe(self._write, frame)
+
+    def _write(self, frame):
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > SUBSCRIBER_BUFFER_LIMIT:
+            # Client đọc không kịp: đóng kết nối, client sẽ subscribe lại và bắt kịp theo cursor
+            logging.warning(f"[Tracker] Subscriber {self.username} is too slow, closing its connection")
+            self.writer.close()
+            return
+        self.writer.write(frame)
+
+class ThreadSubscriber:
+    """Subscriber trên một kết nối của chế độ threaded; một thread riêng ghi các frame theo thứ tự"""
+    def __init__(self, username, conn):
+        self.username = username
+        self.conn = conn
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_LIMIT)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def send(self, frame):
         try:
-            # Đảm bảo thread-safe khi truy cập peer_list
-            with peer_lock:
-                offline_peers = []
-                for i, peer in enumerate(peer_list):
-                    # Chỉ kiểm tra các peer mà status là "online" hoặc đã lâu không thấy
-                    if peer.status == "online" or peer.is_likely_offline() or peer.status == "invisible":
-                        # Nếu peer đã lâu không được thấy, kiểm tra trạng thái
-                        if peer.is_likely_offline():
-                            is_online = check_peer_status(peer)
-                            if not is_online and peer.status != "offline":
-                                logging.info(f"[Tracker] Peer {peer.username} ({peer.ip}:{peer.port}) is now offline")
-                                peer.status = "offline"
-                                notify_peers_status_update(peer)
-                            elif is_online and peer.status == "offline":
-                                logging.info(f"[Tracker] Peer {peer.username} ({peer.ip}:{peer.port}) is back online")
-                                peer.status = "online"
-                                peer.update_last_seen()
-                                notify_peers_status_update(peer)
-                        
-                        # Xóa các peer không còn hoạt động sau một thời gian rất dài (3 phút)
-                        if (datetime.now() - peer.last_seen).total_seconds() > 300 and peer.status == "offline":
-                            offline_peers.append(i)
-                
-                # Xóa các peer đã offline quá lâu (từ cuối danh sách để tránh lỗi index)
-                for idx in sorted(offline_peers, reverse=True):
-                    removed_peer = peer_list.pop(idx)
-                    logging.info(f"[Tracker] Removed inactive peer: {removed_peer.username} ({removed_peer.ip}:{removed_peer.port})")
-            
-            # Tạm dừng để tránh dùng quá nhiều CPU
-            time.sleep(30)  # Kiểm tra mỗi 30 giây
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            logging.warning(f"[Tracker] Subscriber {self.username} is too slow, closing its connection")
+            self.close()
+
+    def close(self):
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            try:
+                self.conn.sendall(frame)
+            except OSError:
+                break
+
+def parse_subscribe(data):
+    """subscribe <username> [*] [kênh=cursor ...] -> (username, wildcard, {kênh: cursor})"""
+    parts = data.split()
+    if len(parts) < 2:
+        raise ValueError("Missing username")
+    wildcard = False
+    cursors = {}
+    for arg in parts[2:]:
+        if arg == "*":
+            wildcard = True
+            continue
+        if "=" in arg:
+            name, _, cursor = arg.rpartition("=")
+            cursors[name] = int(cursor)
+        else:
+            cursors[arg] = None
+    return parts[1], wildcard, cursors
+
+def subscription_catch_up(cursors, sender_ip):
+    """Sự kiện cho những gì client còn thiếu trước khi subscribe (kênh có seq > cursor của client)"""
+    frames = []
+    for name, cursor in cursors.items():
+        if cursor is None:
+            continue
+        response = dispatch_request(f"get_channel_since {name} {cursor} limit={MAX_PAGE_LIMIT}", sender_ip)
+        if not response or response.startswith(b"ERROR"):
+            continue
+        delta = json.loads(response)
+        if delta["messages"] or "host" in delta or delta.get("reset"):
+            delta["type"] = "channel_event"
+            delta["since"] = cursor
+            frames.append(encode_frame(json.dumps(delta)))
+    return frames
+
+def publish_channel_changes(channel, seq_before, created=False):
+    """Đẩy các thay đổi của kênh sau seq_before tới subscriber; gọi khi đang giữ channel_lock"""
+    if created:
+        subscription_hub.publish_all(encode_frame(json.dumps({
+            "type": "channel_created",
+            "name": channel.name,
+            "host": channel.host
+        })))
+    if channel.seq > seq_before and subscription_hub.has_subscribers(channel.name):
+        delta = channel.delta_since(seq_before)
+        delta["type"] = "channel_event"
+        # Client chỉ áp dụng sự kiện khi cursor của nó >= since, nếu không thì tự tải phần còn thiếu
+        delta["since"] = seq_before
+        subscription_hub.publish(channel.name, encode_frame(json.dumps(delta)))
+
+class LivenessMonitor:
+    """Theo dõi peer còn sống dựa trên heartbeat, với một heap deadline.
+
+    Mỗi heartbeat/send_info đẩy deadline mới vào heap (O(log n)); các mục cũ được bỏ qua
+    khi lấy ra (lazy deletion). Khi một deadline hết hạn, peer được probe trong pool
+    riêng, song song và không giữ lock của registry; nếu probe thất bại peer bị đánh
+    dấu offline, và bị xoá khỏi registry sau PURGE_AFTER giây nếu không quay lại.
+    """
+    def __init__(self, registry, timeout, purge_after, probe_workers=16):
+        self.registry = registry
+        self.timeout = timeout
+        self.purge_after = purge_after
+        self._heap = []  # (deadline, counter, key, kind)
+        self._current = {}  # key -> (deadline, kind) đang có hiệu lực
+        self._counter = 0
+        self._cond = threading.Condition()
+        self._probing = set()  # key của các peer đang được probe
+        self._probe_pool = ThreadPoolExecutor(max_workers=probe_workers, thread_name_prefix="liveness-probe")
+
+    @staticmethod
+    def _key(peer):
+        return (peer.ip, str(peer.port))
+
+    def _schedule(self, key, deadline, kind):
+        with self._cond:
+            self._current[key] = (deadline, kind)
+            self._counter += 1
+            heapq.heappush(self._heap, (deadline, self._counter, key, kind))
+            # Dọn heap khi có quá nhiều mục cũ do heartbeat liên tục
+            if len(self._heap) > 4 * len(self._current) + 64:
+                self._heap = [entry for entry in self._heap if self._current.get(entry[2]) == (entry[0], entry[3])]
+                heapq.heapify(self._heap)
+            if self._heap[0][2] == key:
+                self._cond.notify()
+
+    def touch(self, peer):
+        """Ghi nhận peer vừa được thấy (heartbeat, send_info hoặc probe thành công)"""
+        now = time.monotonic()
+        if peer.status == "offline":
+            self._schedule(self._key(peer), now + self.purge_after, "purge")
+        else:
+            self._schedule(self._key(peer), now + self.timeout, "expire")
+
+    def forget(self, peer):
+        with self._cond:
+            self._current.pop(self._key(peer), None)
+
+    def request_probe(self, peer):
+        """Probe peer ở nền (cho check_status khi thông tin đã cũ); mỗi peer chỉ một probe cùng lúc"""
+        key = self._key(peer)
+        with self._cond:
+            if key in self._probing:
+                return
+            self._probing.add(key)
+        self._probe_pool.submit(self._probe, peer)
+
+    def _pop_due(self):
+        """Chờ tới deadline sớm nhất rồi trả về các mục đã hết hạn và còn hiệu lực"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, _, key, kind = heapq.heappop(self._heap)
+                    if self._current.get(key) == (deadline, kind):
+                        del self._current[key]
+                        due.append((key, kind))
+                if due:
+                    return due
+                wait = self._heap[0][0] - now if self._heap else None
+                self._cond.wait(wait)
+
+    def _probe(self, peer):
+        try:
+            is_online = check_peer_status(peer)
+            if is_online:
+                peer.update_last_seen()
+                if peer.status == "offline" and peer.expired:
+                    logging.info(f"[Tracker] Peer {peer.username} ({peer.ip}:{peer.port}) is back online")
+                    peer.expired = False
+                    peer_registry.update(peer, status="online")
+                    notify_peers_status_update(peer)
+            elif peer.status != "offline":
+                logging.info(f"[Tracker] Peer {peer.username} ({peer.ip}:{peer.port}) is now offline")
+                peer.expired = True
+                peer_registry.update(peer, status="offline")
+                notify_peers_status_update(peer)
+            self.touch(peer)
         except Exception as e:
-            logging.error(f"[Tracker] Error in status updating thread: {e}")
-            time.sleep(30)  # Nếu có lỗi, vẫn đợi trước khi thử lại
+            logging.error(f"[Tracker] Error probing peer {peer.username}: {e}")
+        finally:
+            with self._cond:
+                self._probing.discard(self._key(peer))
+
+    def run(self):
+        while True:
+            try:
+                for key, kind in self._pop_due():
+                    peer = self.registry.get_by_addr(*key)
+                    if peer is None:
+                        continue
+                    if kind == "purge":
+                        if peer.status == "offline":
+                            self.registry.remove(peer)
+                            status_fanout.forget((peer.ip, int(peer.port)))
+                            logging.info(f"[Tracker] Removed inactive peer: {peer.username} ({peer.ip}:{peer.port})")
+                        else:
+                            self.touch(peer)
+                    else:
+                        # Không nhận được heartbeat đúng hạn: probe song song, ngoài lock
+                        self.request_probe(peer)
+            except Exception as e:
+                logging.error(f"[Tracker] Error in liveness thread: {e}")
+                time.sleep(1)
+
+liveness = LivenessMonitor(peer_registry, HEARTBEAT_TIMEOUT, PURGE_AFTER)
+
+metrics.gauge("active_connections", lambda: active_connections)
+metrics.gauge("queued_requests", lambda: queued_requests)
+metrics.gauge("peers", lambda: len(peer_registry))
+metrics.gauge("channels", lambda: len(channels))
+metrics.gauge("channels_loaded", lambda: len(channels._loaded))
+metrics.gauge("channel_cache_bytes", lambda: channels.total_bytes)
+metrics.gauge("channel_cache_loads", lambda: channels.loads)
+metrics.gauge("channel_cache_evictions", lambda: channels.evictions)
+metrics.gauge("fanout_queue_depth", lambda: status_fanout._ready.qsize())
+metrics.gauge("fanout_pending_peers", lambda: len(status_fanout._scheduled))
+metrics.gauge("liveness_heap_size", lambda: len(liveness._heap))
+metrics.gauge("subscribers", lambda: len(subscription_hub))
+metrics.gauge("replication_seq", lambda: replication_log.seq)
+metrics.gauge("search_documents", lambda: len(search_index))
+metrics.gauge("rate_limited", lambda: rate_limiter.rejected if rate_limiter is not None else 0)
+metrics.gauge("rate_limit_buckets", lambda: len(rate_limiter) if rate_limiter is not None else 0)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Endpoint HTTP /metrics (định dạng text của Prometheus), bật bằng --metrics-port"""
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Không ghi mỗi lần scrape vào log
+
+def start_metrics_server(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"[Tracker] Metrics endpoint on http://{host}:{port}/metrics")
+    return server
 
 def ping_peer(peer):
     """Ping một peer để kiểm tra trạng thái và cập nhật last_seen"""
@@ -265,314 +1874,1034 @@ def ping_peer(peer):
     except Exception:
         return False
 
+class ShardRouter:
+    """Chuyển các lệnh về kênh tới process shard sở hữu kênh đó (chế độ --shards).
+
+    Router giữ registry peer, liveness và fan-out như bình thường; kênh được chia cho các
+    shard bằng HashRing theo tên kênh. Mỗi thread của router giữ một kết nối frame tới
+    từng shard nên việc chuyển tiếp không phải mở kết nối mới cho mỗi lệnh.
+    """
+    CHANNEL_COMMANDS = ("sync_channel", "get_channel", "get_channel_since", "get_history", "set_retention")
+    BROADCAST_COMMANDS = ("list_channels", "debug")
+
+    def __init__(self, shard_ports):
+        self.shard_ports = list(shard_ports)
+        self.ring = HashRing(range(len(self.shard_ports)))
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=len(self.shard_ports), thread_name_prefix="shard-broadcast")
+
+    def forward(self, index, payload):
+        """Gửi một lệnh tới shard index và trả về phản hồi (bytes kết thúc bằng newline)"""
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        for attempt in range(2):
+            conn = conns.get(index)
+            if conn is None:
+                sock = socket.create_connection(("127.0.0.1", self.shard_ports[index]))
+                conn = conns[index] = (sock, MessageReader(sock))
+            try:
+                send_frame(conn[0], payload)
+                reply, _ = conn[1].read_message()
+            except OSError:
+                reply = None
+            if reply is not None:
+                return reply + b"\n"
+            # Kết nối cũ đã bị shard đóng (idle timeout), mở lại và thử thêm một lần
+            conn[0].close()
+            del conns[index]
+        return b"ERROR: Shard unavailable\n"
+
+    def broadcast(self, payload, page=None):
+        """Gửi lệnh tới mọi shard và ghép các danh sách JSON trả về.
+
+        Với lệnh phân trang, mỗi shard trả về một trang theo tên kênh; router ghép các trang
+        rồi cắt lại đúng limit phần tử để kết quả giống như khi chỉ có một process.
+        """
+        results = []
+        shard_has_more = False
+        for reply in self._pool.map(lambda index: self.forward(index, payload), range(len(self.shard_ports))):
+            try:
+                data = json.loads(reply)
+            except ValueError:
+                data = None
+            if page is not None and isinstance(data, dict):
+                results.extend(data["items"])
+                shard_has_more = shard_has_more or data.get("next") is not None
+            elif page is None and isinstance(data, list):
+                results.extend(data)
+            else:
+                logging.error(f"[Tracker] Invalid shard reply: {reply[:200]!r}")
+        if page is None:
+            return json.dumps(results).encode() + b"\n"
+        by_name = {item["name"]: item for item in results}
+        names, next_cursor = page_slice(sorted(by_name), page.get("after"), page.get("before"), page["limit"])
+        if next_cursor is None and shard_has_more and names:
+            # Một shard còn phần tử sau trang của nó dù trang ghép vừa đủ limit
+            next_cursor = names[0] if "before" in page else names[-1]
+        return json.dumps({"items": [by_name[name] for name in names], "next": next_cursor}).encode() + b"\n"
+
+    def start_event_relay(self):
+        """Nhận sự kiện kênh từ mọi shard (subscribe "*") và chuyển cho subscriber của router"""
+        for index in range(len(self.shard_ports)):
+            threading.Thread(target=self._relay_events, args=(index,), name=f"shard-relay-{index}", daemon=True).start()
+
+    def _relay_events(self, index):
+        while True:
+            try:
+                sock = socket.create_connection(("127.0.0.1", self.shard_ports[index]))
+                try:
+                    send_frame(sock, "subscribe router *")
+                    reader = MessageReader(sock)
+                    while True:
+                        payload, _ = reader.read_message()
+                        if payload is None:
+                            break
+                        if not payload.startswith(b"{"):
+                            continue  # "OK" của lệnh subscribe
+                        event = json.loads(payload)
+                        frame = encode_frame(payload)
+                        if event.get("type") == "channel_created":
+                            subscription_hub.publish_all(frame)
+                        else:
+                            subscription_hub.publish(event.get("name"), frame)
+                finally:
+                    sock.close()
+            except (OSError, ValueError) as e:
+                logging.warning(f"[Tracker] Event relay from shard {index} interrupted: {e}")
+            time.sleep(1)
+
+    def search(self, rest):
+        """search có lọc theo kênh đi tới shard sở hữu; không có thì hỏi mọi shard và ghép theo điểm.
+
+        Mỗi shard tính idf trên các tin nhắn của nó nên điểm giữa các shard chỉ xấp xỉ so sánh được.
+        """
+        try:
+            query = parse_search_query(rest)
+        except ValueError:
+            return None  # Để handle_request trả lỗi tham số như bình thường
+        if query.get("channel"):
+            return self.forward(self.ring.owner(query["channel"]), "search " + json.dumps(query))
+        offset, limit = query["offset"], query["limit"]
+        payload = "search " + json.dumps(dict(query, offset=0, limit=offset + limit))
+        total = 0
+        partial = truncated = False
+        results = []
+        for reply in self._pool.map(lambda index: self.forward(index, payload), range(len(self.shard_ports))):
+            try:
+                data = json.loads(reply)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                logging.error(f"[Tracker] Invalid shard reply: {reply[:200]!r}")
+                partial = True
+                continue
+            total += data["total"]
+            partial = partial or data["partial"]
+            truncated = truncated or data["truncated"]
+            results.extend(data["results"])
+        results.sort(key=lambda r: (r["score"], timestamp_key(r["timestamp"])), reverse=True)
+        results = results[offset:offset + limit]
+        next_offset = offset + len(results)
+        if next_offset >= min(total, SEARCH_MAX_WINDOW):
+            next_offset = None
+        return json.dumps({"total": total, "results": results, "next": next_offset, "partial": partial,
+                           "truncated": truncated}).encode() + b"\n"
+
+    def shard_stats(self):
+        """Lệnh stats của từng shard"""
+        stats = []
+        for reply in self._pool.map(lambda index: self.forward(index, "stats"), range(len(self.shard_ports))):
+            try:
+                stats.append(json.loads(reply))
+            except ValueError:
+                stats.append(None)
+        return stats
+
+    def route(self, data, sender_ip):
+        """Trả về phản hồi nếu lệnh thuộc về shard, None nếu router tự xử lý"""
+        stripped = data.strip()
+        try:
+            if stripped.startswith("{"):
+                msg = json.loads(stripped)
+                if msg.get("type") != "join_channel" or not msg.get("channel"):
+                    return None
+                return self.forward(self.ring.owner(msg["channel"]), stripped)
+        except ValueError:
+            return b"ERROR: Invalid join_channel message\n"
+
+        cmd, _, rest = stripped.partition(" ")
+        if cmd in self.BROADCAST_COMMANDS:
+            try:
+                page = parse_page_args(rest.split())
+            except ValueError:
+                return None  # Để handle_request trả lỗi tham số như bình thường
+            return self.broadcast(stripped, page)
+        if cmd == "search":
+            return self.search(rest)
+        if cmd not in self.CHANNEL_COMMANDS:
+            return None
+        if cmd != "sync_channel":
+            if not rest:
+                return None  # Để handle_request trả lỗi thiếu tham số như bình thường
+            return self.forward(self.ring.owner(rest.split()[0]), stripped)
+
+        json_start = rest.find("{")
+        if json_start == -1:
+            return b"ERROR: Invalid JSON format\n"
+        try:
+            channel_name = json.loads(rest[json_start:])["name"]
+        except (ValueError, KeyError, TypeError):
+            return b"ERROR: Invalid JSON\n"
+        # Shard không có registry peer nên router gửi kèm username của người gửi
+        sender_peer = peer_registry.get_by_ip(sender_ip)
+        sender_username = sender_peer.username if sender_peer is not None else ""
+        return self.forward(self.ring.owner(channel_name), f"sync_channel @{sender_username} {rest[json_start:]}")
+
+def run_shard(index, count, port, snapshot_interval=SNAPSHOT_INTERVAL, cache_mb=CHANNEL_CACHE_MB, retention=(0, 0),
+              search=True):
+    """Điểm vào của một process shard: chỉ nạp và phục vụ các kênh mà shard sở hữu"""
+    global SHARD_INDEX, SHARD_COUNT, RETENTION_MESSAGES, RETENTION_DAYS, SEARCH_INDEX, rate_limiter
+    SHARD_INDEX = index
+    SHARD_COUNT = count
+    RETENTION_MESSAGES, RETENTION_DAYS = retention
+    SEARCH_INDEX = search
+    rate_limiter = None  # Mọi lệnh đến từ router, router đã áp dụng giới hạn theo client
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    channels.budget = cache_mb * 1024 * 1024
+    load_channels()
+    start_snapshot_thread(snapshot_interval)
+    start_retention_thread()
+    start_search_index_thread()
+    logging.info(f"[Tracker] Shard {index}/{count} serving {len(channels)} channels on port {port}")
+    try:
+        asyncio.run(serve_async(port, host="127.0.0.1"))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Router gửi SIGTERM sau SIGINT khi tắt; không để tín hiệu thứ hai cắt ngang lúc ghi snapshot
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        shutdown_channels()
+
+def start_shards(count, base_port, snapshot_interval=SNAPSHOT_INTERVAL, cache_mb=CHANNEL_CACHE_MB):
+    """Khởi động count process shard lắng nghe trên các port base_port, base_port + 1, ..."""
+    ctx = multiprocessing.get_context("spawn")
+    processes = []
+    retention = (RETENTION_MESSAGES, RETENTION_DAYS)
+    for index in range(count):
+        p = ctx.Process(target=run_shard, args=(index, count, base_port + index, snapshot_interval, cache_mb, retention, SEARCH_INDEX), name=f"tracker-shard-{index}", daemon=True)
+        p.start()
+        processes.append(p)
+    # Chờ các shard sẵn sàng nhận kết nối trước khi router mở port
+    for index in range(count):
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", base_port + index), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or not processes[index].is_alive():
+                    raise RuntimeError(f"Shard {index} failed to start")
+                time.sleep(0.1)
+    logging.info(f"[Tracker] Started {count} shard processes on ports {base_port}-{base_port + count - 1}")
+    return processes
+
+class StandbyReplicator:
+    """Phía standby: đọc journal của primary qua một kết nối giữ lâu và áp dụng vào dữ liệu cục bộ.
+
+    Bản ghi kênh giữ nguyên seq của primary nên cursor của agent vẫn đúng sau khi chuyển sang
+    standby. Khi không liên lạc được primary quá PROMOTE_AFTER giây, standby tự promote.
+    """
+    def __init__(self, primary):
+        self.primary = primary
+        self.epoch = None
+        self.seq = 0
+        self.sock = None
+
+    def start(self):
+        threading.Thread(target=self.run, name="standby-replicator", daemon=True).start()
+
+    def _call(self, command):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.primary, timeout=REPLICATION_POLL + 5)
+        while True:
+            send_frame(self.sock, command)
+            reply = recv_reply(self.sock)
+            if reply is None or not reply.startswith("RETRY_AFTER"):
+                break
+            # Lệnh get_channel khi đồng bộ lại toàn bộ chịu giới hạn tần suất của primary
+            time.sleep(float(reply.split()[1]))
+        if reply is None:
+            raise ConnectionError("Primary closed the replication connection")
+        if reply.startswith("ERROR"):
+            raise ConnectionError(reply.strip())
+        return json.loads(reply)
+
+    def run(self):
+        last_contact = time.monotonic()
+        while standby_of is not None:
+            try:
+                data = self._call(f"replicate {self.epoch} {self.seq}")
+                last_contact = time.monotonic()
+                if data.get("reset"):
+                    self.resync(data)
+                else:
+                    self.apply(data["records"])
+                    self.seq = data["seq"]
+            except (OSError, ValueError, ProtocolError) as e:
+                if self.sock is not None:
+                    logging.warning(f"[Tracker] Lost replication connection to primary: {e}")
+                    self.sock.close()
+                    self.sock = None
+                if PROMOTE_AFTER and time.monotonic() - last_contact > PROMOTE_AFTER:
+                    logging.warning(f"[Tracker] Primary unreachable for {PROMOTE_AFTER}s, promoting standby")
+                    promote()
+                    return
+                time.sleep(0.5)
+        if self.sock is not None:
+            self.sock.close()
+
+    def resync(self, data):
+        """Đồng bộ lại toàn bộ: thay registry peer rồi tải từng kênh theo trang"""
+        logging.info(f"[Tracker] Full resync from primary (epoch {data['epoch']}, {len(data['channels'])} channels)")
+        with peer_lock:
+            for peer in peer_registry.all():
+                peer_registry.remove(peer)
+            for peer_data in data["peers"]:
+                peer_registry.add(Peer.from_dict(peer_data))
+        # Kênh không còn trên primary (ví dụ primary đã mất dữ liệu) không được giữ lại trên standby
+        primary = set(data["channels"])
+        with channel_lock:
+            stale = [name for name in channels if name not in primary]
+            for name in stale:
+                channels.discard(name)
+                remove_channel_files(name)
+                search_indexed.pop(name, None)
+        if stale:
+            logging.info(f"[Tracker] Dropped {len(stale)} channels missing on primary")
+        for name in data["channels"]:
+            messages = []
+            cursor = None
+            while True:
+                page = self._call(f"get_channel {name} limit={MAX_PAGE_LIMIT}" + (f" after={cursor}" if cursor is not None else ""))
+                messages.extend(page["messages"])
+                cursor = page.get("next")
+                if cursor is None:
+                    break
+            channel = Channel(name, page["host"], persist=False)
+            channel.members = set(page["members"])
+            channel._load_messages(messages)
+            channel.seq = max(channel.seq, page["seq"])
+            channel.meta_seq = page["meta_seq"]
+            with channel_lock:
+                if name in channels:
+                    channels[name].log.close()
+                channel.log.compact(channel.to_dict())
+                channels[name] = channel
+                index_new_messages(channel)
+        if stale:
+            # Snapshot gộp cũ vẫn liệt kê các kênh đã xoá
+            write_snapshot()
+        # Bản ghi sau seq này có thể đã nằm trong dữ liệu vừa tải; apply() bỏ qua những bản ghi đó
+        self.epoch = data["epoch"]
+        self.seq = data["seq"]
+
+    def apply(self, records):
+        touched = {}
+        with channel_lock:
+            for entry in records:
+                if "peer" in entry:
+                    peer_data = entry["peer"]
+                    peer = peer_registry.get_by_addr(peer_data["ip"], peer_data["port"])
+                    if peer is None:
+                        peer_registry.add(Peer.from_dict(peer_data))
+                    else:
+                        peer_registry.update(peer, username=peer_data["username"], status=peer_data["status"])
+                    continue
+                if "peer_removed" in entry:
+                    peer = peer_registry.get_by_addr(*entry["peer_removed"])
+                    if peer is not None:
+                        peer_registry.remove(peer)
+                    continue
+                name, record = entry["channel"], entry["record"]
+                if name not in channels:
+                    if record.get("op") != "create":
+                        raise ValueError(f"Missing channel {name} in replica")
+                    channels[name] = Channel(name, record["host"], persist=False)
+                    touched.setdefault(name, (0, True))
+                channel = channels[name]
+                if record_seq(record) <= channel.seq:
+                    continue
+                touched.setdefault(name, (channel.seq, False))
+                channel.apply_record(record)
+                channel.log.append(record)
+            commits = []
+            for name, (seq_before, created) in touched.items():
+                channel = channels[name]
+                # Không archive trên standby: segment do primary quyết định
+                commits.append(channel.save_to_disk(retention=False))
+                index_new_messages(channel)
+                publish_channel_changes(channel, seq_before, created)
+        for commit in commits:
+            commit()
+
+def promote():
+    """Standby trở thành primary: nhận mọi lệnh, journal mới cho các standby sau này"""
+    global standby_of
+    if standby_of is None:
+        return False
+    standby_of = None
+    replication_log.reset()
+    # Peer được tính từ lúc promote; peer không gửi heartbeat tới tracker mới sẽ bị probe như bình thường
+    for peer in peer_registry.all():
+        liveness.touch(peer)
+    logging.info("[Tracker] Promoted to primary")
+    return True
+
+def parse_search_query(text):
+    """Kiểm tra tham số JSON của lệnh search; trả về dict đã chuẩn hoá (offset, limit là số)"""
+    try:
+        query = json.loads(text)
+    except ValueError:
+        raise ValueError("Invalid JSON")
+    if not isinstance(query, dict) or not isinstance(query.get("q"), str) or not query["q"].strip():
+        raise ValueError("search requires a non-empty \"q\"")
+    for key in ("channel", "sender", "since", "until"):
+        if query.get(key) is not None and not isinstance(query[key], str):
+            raise ValueError(f"Invalid {key}")
+    for key in ("since", "until"):
+        if query.get(key):
+            try:
+                timestamp_value(query[key])
+            except ValueError:
+                raise ValueError(f"Invalid {key}")
+    try:
+        query["offset"] = max(0, int(query.get("offset", 0)))
+        query["limit"] = max(1, int(query.get("limit", 20)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid offset or limit")
+    if query["offset"] >= SEARCH_MAX_WINDOW:
+        raise ValueError(f"offset must be below {SEARCH_MAX_WINDOW}")
+    query["limit"] = min(query["limit"], SEARCH_MAX_WINDOW - query["offset"])
+    return query
+
+def search_result_messages(results):
+    """Điền người gửi, thời gian và nội dung cho kết quả search từ tầng nóng hoặc archive của kênh.
+
+    Chỉ mục chỉ giữ (kênh, seq); kết quả của kênh đã bị xoá hoặc tin không còn tìm thấy bị bỏ qua.
+    """
+    filled = []
+    for result in results:
+        message = archive = None
+        with channel_lock:
+            if result["channel"] in channels:
+                channel = channels[result["channel"]]
+                if result["seq"] > channel.archived_seq:
+                    message = channel.message_by_seq(result["seq"])
+                else:
+                    archive = channel.archive
+        if message is not None:
+            message = message.to_dict()
+        elif archive is not None:
+            # Đọc segment ngoài channel_lock
+            message = archive.get(result["seq"])
+        if message is None:
+            continue
+        filled.append({
+            "channel": result["channel"],
+            "seq": result["seq"],
+            "sender": message["sender"],
+            "timestamp": message["timestamp"],
+            "content": message["content"],
+            "score": result["score"]
+        })
+    return filled
+
+def cached_peer_status(username):
+    """Trạng thái của peer theo thông tin liveness đã có, không kết nối tới peer.
+
+    Thông tin cũ hơn STATUS_FRESHNESS giây vẫn được trả về ("online"), đồng thời một probe được
+    chạy ở nền để các lần hỏi sau có kết quả mới. Peer không được thấy quá STATUS_STALE_AFTER giây
+    (hạn của heartbeat) là "stale" cho tới khi probe trả lời. None nếu không có peer nào với username này.
+    """
+    peer = peer_registry.get_by_username(username)
+    if peer is None:
+        return None
+    if peer.status == "offline":
+        return "offline"
+    if peer.is_likely_offline(STATUS_FRESHNESS):
+        liveness.request_probe(peer)
+        if peer.is_likely_offline(STATUS_STALE_AFTER):
+            return "stale"
+    return "online"
+
+def request_command_name(data):
+    """Tên lệnh dùng làm nhãn thống kê"""
+    stripped = data.lstrip()
+    if stripped.startswith("{"):
+        return "join_channel"
+    cmd = stripped.split(None, 1)[0] if stripped else ""
+    return cmd if cmd in KNOWN_COMMANDS else "other"
+
+class ClientIdentity:
+    """Danh tính của một kết nối dùng cho giới hạn tần suất.
+
+    Mặc định là IP của kết nối. Khi kết nối gửi send_info/heartbeat với port của một peer đã
+    đăng ký ở đúng IP đó, bucket được tính theo IP:port để các peer sau cùng một NAT không dùng
+    chung bucket. Port chưa đăng ký không đổi bucket (đổi port liên tục không được bucket mới),
+    và mỗi kết nối chỉ đổi bucket một lần.
+    """
+    __slots__ = ("ip", "key", "claimed")
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.key = ip
+        self.claimed = None  # Port đã khai báo nhưng chưa thấy trong peer_registry
+
+    def observe(self, data):
+        if self.key != self.ip:
+            return
+        parts = data.split(None, 3)
+        cmd = parts[0] if parts else ""
+        if cmd in ("send_info", "heartbeat") and len(parts) > 2 and parts[2].isdigit():
+            self.claimed = parts[2]
+        if self.claimed is not None:
+            # send_info đăng ký peer sau lệnh này, nên port được kiểm tra lại ở các lệnh sau
+            with peer_lock:
+                registered = peer_registry.get_by_addr(self.ip, self.claimed) is not None
+            if registered:
+                self.key = f"{self.ip}:{self.claimed}"
+                self.claimed = None
+
+def admission_delay(data, client):
+    """0 nếu lệnh được chạy, nếu không thì số giây client phải chờ (token bucket của peer và nhóm lệnh)"""
+    client.observe(data)
+    if rate_limiter is None:
+        return 0
+    cmd = request_command_name(data)
+    return rate_limiter.acquire(client.key, COMMAND_GROUPS.get(cmd, "read"))
+
+def retry_after_reply(delay):
+    return f"RETRY_AFTER {delay:.3f}\n".encode()
+
+def handle_request(data, sender_ip):
+    """Xử lý một lệnh hoàn chỉnh từ client và trả về phản hồi (bytes) hoặc None nếu không cần phản hồi"""
+    start = time.perf_counter()
+    try:
+        response = dispatch_request(data, sender_ip)
+    except Exception as e:
+        # Lỗi của một lệnh chỉ trả về ERROR cho lệnh đó, không làm đóng kết nối (và các lệnh pipelining khác)
+        logging.error(f"[Tracker] Error handling {request_command_name(data)}: {e}")
+        response = b"ERROR: Internal error\n"
+    metrics.observe_request(
+        request_command_name(data),
+        len(data),
+        len(response) if response else 0,
+        time.perf_counter() - start,
+        error=bool(response) and response.startswith(b"ERROR")
+    )
+    return response
+
+def dispatch_request(data, sender_ip):
+    """Thực hiện lệnh (không đo đạc); handle_request gọi hàm này và ghi lại số liệu"""
+    global channels
+    if standby_of is not None and request_command_name(data) not in STANDBY_COMMANDS:
+        # Agent nhận lỗi này sẽ thử tracker kế tiếp trong danh sách của nó
+        return f"ERROR: STANDBY of {standby_of[0]}:{standby_of[1]}\n".encode()
+    if shard_router is not None:
+        routed = shard_router.route(data, sender_ip)
+        if routed is not None:
+            return routed
+    # --- Bổ sung: Kiểm tra nếu là JSON (join_channel) ---
+    if data.strip().startswith("{"):
+        try:
+            msg = json.loads(data.strip())
+            if msg.get("type") == "join_channel":
+                channel_name = msg.get("channel")
+                username = msg.get("username")
+                with channel_lock:
+                    if channel_name not in channels or not username:
+                        return b"ERROR: Channel not found or invalid username\n"
+                    channel = channels[channel_name]
+                    seq_before = channel.seq
+                    channel.add_member(username)
+                    logging.info(f"[Tracker] Added member {username} to channel {channel_name} via join_channel")
+                    commit = channel.save_to_disk()
+                    publish_channel_changes(channel, seq_before)
+                commit()
+                return b"OK\n"
+        except Exception as e:
+            logging.error(f"[Tracker] Error processing join_channel: {e}")
+            return b"ERROR: Invalid join_channel message\n"
+    # --- Kết thúc bổ sung ---
+    parts = data.strip().split()
+    if not parts:
+        return None
+    cmd = parts[0]
+
+    if cmd == "send_info":
+        if len(parts) < 5 or not parts[2].isdigit():
+            return b"ERROR: Usage: send_info <ip> <port> <username> <status> [get_peers]\n"
+        ip, port, username, status = parts[1], parts[2], parts[3], parts[4]
+        # Kiểm tra nếu có "get_peers" ở cuối lệnh
+        get_peers = False
+        if len(parts) > 5 and parts[5] == "get_peers":
+            get_peers = True
+        # Đảm bảo thread-safe khi truy cập registry
+        with peer_lock:
+            # Update or add peer
+            p = peer_registry.get_by_addr(ip, port)
+            if p is not None:
+                # Nếu username thay đổi, cập nhật
+                if p.username != username:
+                    logging.info(f"[Tracker] Username changed for peer at {ip}:{port} from {p.username} to {username}")
+                    peer_registry.update(p, username=username)
+
+                # Nếu trạng thái là offline, cập nhật ngay lập tức
+                old_status = p.status
+                if status == "offline":
+                    peer_registry.update(p, status="offline")
+                    logging.info(f"[Tracker] Peer {username} at {ip}:{port} set to offline by client exit")
+                elif status != "offline" or p.status == "offline":
+                    peer_registry.update(p, status=status)
+                p.update_last_seen()
+                p.expired = False
+                liveness.touch(p)
+                logging.info(f"[Tracker] Updated peer {username} at {ip}:{port} with status {p.status}")
+                if old_status != p.status:
+                    notify_peers_status_update(p)
+            else:
+                # Peer mới
+                new_peer = peer_registry.add(Peer(ip, port, username, status))
+                liveness.touch(new_peer)
+                logging.info(f"[Tracker] Registered new peer {username} at {ip}:{port} with status {status}")
+                notify_peers_status_update(new_peer)
+
+        if get_peers:
+            # Trả về danh sách peers ngay lập tức (bản JSON đã cache)
+            return peer_registry.snapshot_json() + b'\n'
+        return b"OK\n"
+
+    elif cmd == "get_list":
+        # get_list limit=N after=<ip:port>|before=<ip:port>: trả về một trang {"items", "next"}
+        try:
+            page = parse_page_args(parts[1:])
+        except ValueError as e:
+            return f"ERROR: {e}\n".encode()
+        if page is not None:
+            peers, next_cursor = peer_registry.page(page.get("after"), page.get("before"), page["limit"])
+            return json.dumps({"items": peers, "next": next_cursor}).encode() + b'\n'
+        # Bản JSON chỉ được dựng lại khi registry thay đổi
+        peer_data = peer_registry.snapshot_json()
+        logging.info(f"[Tracker] Sent list of {len(peer_registry)} peers")
+        return peer_data + b'\n'
+
+    elif cmd == "ping":
+        # Phản hồi lại ping từ client
+        return b"pong\n"
+
+    elif cmd == "heartbeat":
+        # heartbeat <ip> <port>: agent báo vẫn còn sống, gia hạn deadline trong LivenessMonitor
+        if len(parts) >= 3:
+            peer = peer_registry.get_by_addr(parts[1], parts[2])
+            if peer is not None:
+                peer.update_last_seen()
+                if peer.status == "offline" and peer.expired:
+                    # Peer bị coi là offline do lỡ heartbeat nay đã quay lại
+                    logging.info(f"[Tracker] Peer {peer.username} ({peer.ip}:{peer.port}) is back online")
+                    peer.expired = False
+                    peer_registry.update(peer, status="online")
+                    notify_peers_status_update(peer)
+                liveness.touch(peer)
+        return b"pong\n"
+
+    elif cmd == "check_status":
+        # Cho phép client kiểm tra trạng thái của một peer cụ thể
+        if len(parts) < 2:
+            return b"ERROR: Missing peer username\n"
+
+        target_username = parts[1]
+
+        # Trả lời từ liveness cache (heartbeat và probe nền), không probe peer trong lệnh
+        status = cached_peer_status(target_username)
+        if status is not None:
+            return f"STATUS: {target_username} is {status}\n".encode()
+
+        return f"ERROR: Peer {target_username} not found\n".encode()
+
+    elif cmd == "check_status_many":
+        # check_status_many <user1> <user2> ...: {"user": "online" | "offline" | "stale" | null (không có peer)}
+        usernames = parts[1:]
+        if len(usernames) > CHECK_STATUS_MANY_LIMIT:
+            return f"ERROR: At most {CHECK_STATUS_MANY_LIMIT} usernames per request\n".encode()
+        return json.dumps({username: cached_peer_status(username) for username in usernames}).encode() + b'\n'
+
+    elif cmd == "sync_channel":
+        # Receive channel data from a host for backup
+        try:
+            buffer = data.strip()
+
+            # Find where the JSON starts
+            json_start = buffer.find('{')
+            if json_start == -1:
+                return b"ERROR: Invalid JSON format\n"
+
+            json_buffer = buffer[json_start:]
+
+            # Now try to parse the complete JSON
+            logging.info(f"[Tracker] Received complete JSON data ({len(json_buffer)} bytes)")
+            channel_data = json.loads(json_buffer)
+            channel_name = channel_data["name"]
+
+            logging.info(f"[Tracker] Received sync request for channel {channel_name}")
+
+            # Kiểm tra xem sender có phải là host không
+            sender_is_host = False
+            sender_port = None
+            sender_username = None
+
+            if SHARD_INDEX is not None and len(parts) > 1 and parts[1].startswith("@"):
+                # Trong shard, router đã tra registry và gửi kèm username của người gửi
+                sender_username = parts[1][1:] or None
+            else:
+                sender_peer = peer_registry.get_by_ip(sender_ip)
+                if sender_peer is not None:
+                    sender_username = sender_peer.username
+                    sender_port = sender_peer.port
+
+            logging.info(f"[Tracker] Sync request from {sender_username if sender_username else 'unknown'} ({sender_ip})")
+
+            # Sử dụng channel_lock để đảm bảo thread-safe khi truy cập và sửa đổi channels
+            with channel_lock:
+                # Check if sender is the host
+                if channel_name in channels:
+                    if sender_username and sender_username == channels[channel_name].host:
+                        sender_is_host = True
+                        logging.info(f"[Tracker] Sender is the host of channel {channel_name}")
+
+                created = channel_name not in channels
+                if created:
+                    logging.info(f"[Tracker] Creating new channel {channel_name} from sync")
+                    channels[channel_name] = Channel(channel_name, channel_data["host"])
+                    seq_before = 0
+                else:
+                    seq_before = channels[channel_name].seq
+
+                # Nếu người gửi không phải là host, chỉ thêm tin nhắn mới
+                # Giữ nguyên thông tin host và members
+                if not sender_is_host:
+                    logging.info(f"[Tracker] Non-host sync from {sender_username}, preserving host and member data")
+
+                    # Cho phép client không phải host đồng bộ tin nhắn bất kể host có online hay không
+                    host_is_online = False
+                    host_username = channels[channel_name].host
+
+                    if host_username:
+                        host_peer = peer_registry.get_by_username(host_username)
+                        if host_peer is not None and host_peer.status in ("online", "invisible"):
+                            host_is_online = True
+
+                    if host_is_online:
+                        logging.info(f"[Tracker] Host {host_username} is online, but accepting non-host message sync")
+
+                    # Chỉ thêm tin nhắn mới từ client không phải host
+                    if "messages" in channel_data and channel_data["messages"]:
+                        # Thêm các tin nhắn chưa có (loại trùng theo id của tin nhắn)
+                        new_messages = channels[channel_name].merge_messages(channel_data["messages"])
+
+                        logging.info(f"[Tracker] Added {new_messages} new messages from non-host client {sender_username}")
+                else:
+                    # Update channel data
+                    channels[channel_name].set_host(channel_data["host"])
+
+                    # Ensure host is a member
+                    channels[channel_name].add_member(channel_data["host"])
+
+                    # Add other members
+                    if "members" in channel_data:
+                        for member in channel_data["members"]:
+                            channels[channel_name].add_member(member)
+
+                    # Add new messages
+                    if "messages" in channel_data and channel_data["messages"]:
+                        # Check if message is already in channel by its id
+                        new_messages = channels[channel_name].merge_messages(channel_data["messages"])
+
+                        logging.info(f"[Tracker] Added {new_messages} messages from host {sender_username}")
+
+                # Save to disk
+                commit = channels[channel_name].save_to_disk()
+                publish_channel_changes(channels[channel_name], seq_before, created)
+                logging.info(f"[Tracker] Synced channel {channel_name} with {len(channels[channel_name].messages)} messages")
+                reply = f"OK {channels[channel_name].seq}\n".encode()
+            # Ghi xuống disk ngoài channel_lock, trả lời sau khi đã commit
+            commit()
+            return reply
+        except json.JSONDecodeError as e:
+            logging.error(f"[Tracker] JSON decode error: {e}")
+            logging.error(f"[Tracker] Received data: {' '.join(parts[1:])}")
+            return b"ERROR: Invalid JSON\n"
+        except Exception as e:
+            logging.error(f"[Tracker] Error during sync: {str(e)}")
+            return f"ERROR: {str(e)}\n".encode()
+
+    elif cmd == "get_channel":
+        # Send channel data to a peer
+        try:
+            channel_name = parts[1]
+            page = parse_page_args(parts[2:])
+            # Sử dụng channel_lock để đảm bảo thread-safe khi đọc dữ liệu channels
+            with channel_lock:
+                if channel_name in channels and page is not None:
+                    # get_channel <kênh> limit=N after=<seq>|before=<seq>: một trang tin nhắn theo seq
+                    channel = channels[channel_name]
+                    after = int(page["after"]) if "after" in page else None
+                    before = int(page["before"]) if "before" in page else None
+                    messages, next_cursor = channel.page_messages(after, before, page["limit"])
+                    channel_data = {
+                        "name": channel.name,
+                        "host": channel.host,
+                        "members": list(channel.members),
+                        "messages": [m.to_dict() for m in messages],
+                        "seq": channel.seq,
+                        "meta_seq": channel.meta_seq,
+                        "next": next_cursor
+                    }
+                    return json.dumps(channel_data).encode() + b'\n'
+                if channel_name in channels:
+                    channel_data = channels[channel_name].to_dict()
+                    logging.info(f"[Tracker] Sent channel {channel_name} data with {len(channel_data['messages'])} messages")
+                    return json.dumps(channel_data).encode() + b'\n'
+                else:
+                    logging.warning(f"[Tracker] Channel {channel_name} not found on request")
+                    return b"ERROR: Channel not found\n"
+        except ValueError as e:
+            return f"ERROR: {e}\n".encode()
+        except Exception as e:
+            logging.error(f"[Tracker] Error sending channel data: {str(e)}")
+            return f"ERROR: {str(e)}\n".encode()
+
+    elif cmd == "get_channel_since":
+        # Delta sync: chỉ gửi những gì mới hơn cursor (seq) mà client đã có
+        try:
+            channel_name = parts[1]
+            cursor = int(parts[2]) if len(parts) > 2 else 0
+            page = parse_page_args(parts[3:])
+            with channel_lock:
+                meta = channels.peek(channel_name)
+                if meta is None:
+                    logging.warning(f"[Tracker] Channel {channel_name} not found on request")
+                    return b"ERROR: Channel not found\n"
+                if cursor == meta.seq:
+                    # Client đã có mọi thay đổi: trả lời từ metadata, không cần nạp tin nhắn của kênh
+                    delta = {"name": channel_name, "cursor": meta.seq, "messages": []}
+                else:
+                    delta = channels[channel_name].delta_since(cursor, page["limit"] if page else None)
+            logging.info(f"[Tracker] Sent {len(delta['messages'])} messages of channel {channel_name} after cursor {cursor}")
+            return json.dumps(delta).encode() + b'\n'
+        except ValueError as e:
+            return f"ERROR: Invalid cursor ({e})\n".encode()
+        except Exception as e:
+            logging.error(f"[Tracker] Error sending channel delta: {str(e)}")
+            return f"ERROR: {str(e)}\n".encode()
+
+    elif cmd == "get_history":
+        # get_history <kênh> [before=<seq>] [limit=N]: tin nhắn cũ hơn before, kể cả phần đã lưu trữ.
+        # Trả về "next" để đọc trang cũ hơn tiếp theo (None khi đã tới đầu lịch sử).
+        try:
+            if len(parts) < 2:
+                return b"ERROR: Missing channel name\n"
+            channel_name = parts[1]
+            page = parse_page_args(parts[2:]) or {"limit": DEFAULT_PAGE_LIMIT}
+            if "after" in page:
+                return b"ERROR: get_history only supports before=\n"
+            with channel_lock:
+                if channel_name not in channels:
+                    return b"ERROR: Channel not found\n"
+                channel = channels[channel_name]
+                before = int(page["before"]) if "before" in page else channel.seq + 1
+                limit = page["limit"]
+                messages = [m.to_dict() for m in channel.history_before(before, limit)]
+                archive = channel.archive if channel.archived_seq else None
+            # Segment lưu trữ không đổi sau khi ghi nên được đọc ngoài channel_lock
+            if archive is not None and len(messages) < limit:
+                boundary = messages[0]["seq"] if messages else before
+                messages = archive.page_before(boundary, limit - len(messages)) + messages
+            next_cursor = messages[0]["seq"] if len(messages) == limit and messages[0]["seq"] > 1 else None
+            return json.dumps({"name": channel_name, "messages": messages, "next": next_cursor}).encode() + b'\n'
+        except ValueError as e:
+            return f"ERROR: {e}\n".encode()
+
+    elif cmd == "set_retention":
+        # set_retention <kênh> messages=N days=D (0: không giới hạn) | set_retention <kênh> default
+        if len(parts) < 3:
+            return b"ERROR: Usage: set_retention <channel> messages=N days=D | default\n"
+        limits = {}
+        if parts[2] != "default":
+            try:
+                for arg in parts[2:]:
+                    key, _, value = arg.partition("=")
+                    if key not in ("messages", "days") or int(value) < 0:
+                        raise ValueError(arg)
+                    limits[key] = int(value)
+            except ValueError as e:
+                return f"ERROR: Invalid retention argument {e}\n".encode()
+        with channel_lock:
+            if parts[1] not in channels:
+                return b"ERROR: Channel not found\n"
+            channel = channels[parts[1]]
+            if limits:
+                channel.set_retention(limits.get("messages", 0), limits.get("days", 0))
+            else:
+                channel.set_retention(None, None)
+            commit = channel.save_to_disk()
+            # Áp dụng ngay giới hạn mới, kể cả khi chưa đủ một lô
+            channel.enforce_retention(min_batch=1)
+        commit()
+        return b"OK\n"
+
+    elif cmd == "search":
+        # search {"q": "...", "channel", "sender", "since", "until", "limit", "offset"}: tin nhắn chứa mọi từ
+        # của q, xếp hạng theo mức liên quan. "partial" là true khi chỉ mục còn đang được dựng, "truncated"
+        # khi có quá nhiều tin khớp bộ lọc chứa các từ đó và chỉ các tin mới nhất được xét.
+        if not SEARCH_INDEX:
+            return b"ERROR: Search index is disabled\n"
+        try:
+            query = parse_search_query(data.strip()[len("search"):])
+        except ValueError as e:
+            return f"ERROR: {e}\n".encode()
+        total, results, truncated = search_index.search(query["q"], query.get("channel"), query.get("sender"),
+                                             query.get("since"), query.get("until"), query["offset"], query["limit"])
+        next_offset = query["offset"] + len(results)
+        if next_offset >= min(total, SEARCH_MAX_WINDOW):
+            next_offset = None
+        results = search_result_messages(results)
+        logging.info(f"[Tracker] Search {query['q']!r} matched {total} messages")
+        return json.dumps({"total": total, "results": results, "next": next_offset, "partial": not search_index_ready,
+                           "truncated": truncated}).encode() + b'\n'
+
+    elif cmd == "list_channels":
+        # list_channels limit=N after=<tên>|before=<tên>: trả về một trang {"items", "next"} theo tên kênh
+        try:
+            page = parse_page_args(parts[1:])
+        except ValueError as e:
+            return f"ERROR: {e}\n".encode()
+        channel_list = []
+        # Sử dụng channel_lock để đảm bảo thread-safe khi đọc dữ liệu channels
+        with channel_lock:
+            if page is not None:
+                names, next_cursor = page_slice(sorted(channels), page.get("after"), page.get("before"), page["limit"])
+            else:
+                names = list(channels)
+            # Chỉ đọc metadata thường trú, không nạp tin nhắn của các kênh
+            for name in names:
+                meta = channels.peek(name)
+                channel_list.append({
+                    "name": name,
+                    "host": meta.host,
+                    "members": len(meta.members),
+                    "messages": meta.message_count
+                })
+            if page is not None:
+                return json.dumps({"items": channel_list, "next": next_cursor}).encode() + b'\n'
+        logging.info(f"[Tracker] Sent list of {len(channel_list)} channels")
+        return json.dumps(channel_list).encode() + b'\n'
+
+    elif cmd == "subscribe":
+        # Chỉ dùng được trên kết nối giữ lâu (handle_client / handle_client_async xử lý trực tiếp)
+        return b"ERROR: subscribe requires a persistent connection\n"
+
+    elif cmd == "replicate":
+        # replicate <epoch> <seq>: standby đọc tiếp journal sau seq (chờ tối đa REPLICATION_POLL giây)
+        if len(parts) < 3:
+            return b"ERROR: Usage: replicate <epoch> <seq>\n"
+        try:
+            result = replication_log.read(parts[1], int(parts[2]), REPLICATION_BATCH, REPLICATION_POLL)
+        except ValueError:
+            return b"ERROR: Invalid replication seq\n"
+        if result is not None:
+            last_seq, records = result
+            return json.dumps({"seq": last_seq, "records": records}).encode() + b'\n'
+        # Standby mới hoặc tụt lại quá xa: gửi registry và danh sách kênh để nó tải lại toàn bộ.
+        # seq được lấy trước nên mọi thay đổi sau thời điểm này đều còn trong journal.
+        reset_seq = replication_log.seq
+        with channel_lock:
+            channel_names = list(channels)
+        logging.info(f"[Tracker] Standby at {sender_ip} needs a full resync")
+        return json.dumps({
+            "reset": True,
+            "epoch": replication_log.epoch,
+            "seq": reset_seq,
+            "peers": [p.to_dict() for p in peer_registry.all()],
+            "channels": channel_names
+        }).encode() + b'\n'
+
+    elif cmd == "promote":
+        # Chuyển standby thành primary bằng tay (ví dụ khi bảo trì primary)
+        if promote():
+            return b"OK\n"
+        return b"ERROR: Not a standby\n"
+
+    elif cmd == "stats":
+        # Số liệu vận hành: lệnh, độ trễ, thời gian chờ lock, hàng đợi
+        snapshot = metrics.snapshot()
+        if shard_router is not None:
+            snapshot["shards"] = shard_router.shard_stats()
+        return json.dumps(snapshot).encode() + b'\n'
+
+    elif cmd == "debug":
+        # Debug command to list all channels
+        debug_info = []
+        # Sử dụng channel_lock để đảm bảo thread-safe khi đọc dữ liệu channels
+        with channel_lock:
+            for name in channels:
+                meta = channels.peek(name)
+                debug_info.append({
+                    "name": name,
+                    "host": meta.host,
+                    "members": list(meta.members),
+                    "message_count": meta.message_count
+                })
+        logging.info(f"[Tracker] Sent debug info for {len(debug_info)} channels")
+        return json.dumps(debug_info).encode() + b'\n'
+
+    logging.warning(f"[Tracker] Unknown command: {cmd}")
+    return f"ERROR: Unknown command {cmd}\n".encode()
+
 def handle_client(conn):
-    global peer_list, channels
+    """Xử lý một kết nối client trong chế độ threaded (mỗi kết nối một thread)"""
+    subscriber = None
     try:
+        sender_ip = conn.getpeername()[0]
+        client = ClientIdentity(sender_ip)
+        reader = MessageReader(conn)
         while True:
-            data = conn.recv(1024).decode()
-            if not data:
+            payload, framed = reader.read_message()
+            if payload is None:
                 break
-            # --- Bổ sung: Kiểm tra nếu là JSON (join_channel) ---
-            if data.strip().startswith("{"):
+            data = payload.decode(errors="replace")
+            if data.startswith("subscribe "):
+                # Kết nối trở thành kênh đẩy sự kiện; mọi thứ ghi ra đi qua hàng đợi của subscriber
                 try:
-                    msg = json.loads(data.strip())
-                    if msg.get("type") == "join_channel":
-                        channel_name = msg.get("channel")
-                        username = msg.get("username")
-                        with channel_lock:
-                            if channel_name in channels and username:
-                                channels[channel_name].add_member(username)
-                                logging.info(f"[Tracker] Added member {username} to channel {channel_name} via join_channel")
-                                channels[channel_name].save_to_disk()
-                                conn.send(b"OK\n")
-                            else:
-                                conn.send(b"ERROR: Channel not found or invalid username\n")
-                        continue
-                except Exception as e:
-                    logging.error(f"[Tracker] Error processing join_channel: {e}")
-                    conn.send(b"ERROR: Invalid join_channel message\n")
+                    username, wildcard, cursors = parse_subscribe(data)
+                except ValueError as e:
+                    conn.sendall(encode_reply(f"ERROR: {e}", framed))
                     continue
-            # --- Kết thúc bổ sung ---
-            parts = data.strip().split()
-            if not parts:
+                if subscriber is None:
+                    subscriber = ThreadSubscriber(username, conn)
+                subscription_hub.subscribe(subscriber, cursors, wildcard)
+                subscriber.send(encode_reply(f"OK {len(cursors)}", framed))
+                for frame in subscription_catch_up(cursors, sender_ip):
+                    subscriber.send(frame)
                 continue
-            cmd = parts[0]
-            
-            if cmd == "send_info":
-                ip, port, username, status = parts[1], parts[2], parts[3], parts[4]
-                # Kiểm tra nếu có "get_peers" ở cuối lệnh
-                get_peers = False
-                if len(parts) > 5 and parts[5] == "get_peers":
-                    get_peers = True
-                new_peer = Peer(ip, port, username, status)
-                
-                # Đảm bảo thread-safe khi truy cập peer_list
-                with peer_lock:
-                    # Update or add peer
-                    for i, p in enumerate(peer_list):
-                        if p.ip == ip and p.port == port:
-                            # Nếu username thay đổi, cập nhật
-                            if p.username != username:
-                                logging.info(f"[Tracker] Username changed for peer at {ip}:{port} from {p.username} to {username}")
-                                p.username = username
-                            
-                            # Nếu trạng thái là offline, cập nhật ngay lập tức
-                            old_status = p.status
-                            if status == "offline":
-                                p.status = "offline"
-                                logging.info(f"[Tracker] Peer {username} at {ip}:{port} set to offline by client exit")
-                            elif status != "offline" or p.status == "offline":
-                                p.status = status
-                            p.update_last_seen()
-                            logging.info(f"[Tracker] Updated peer {username} at {ip}:{port} with status {p.status}")
-                            if old_status != p.status:
-                                notify_peers_status_update(p)
-                            break
-                    else:
-                        # Peer mới
-                        peer_list.append(new_peer)
-                        logging.info(f"[Tracker] Registered new peer {username} at {ip}:{port} with status {status}")
-                        notify_peers_status_update(new_peer)
-                
-                if get_peers:
-                    # Trả về danh sách peers ngay lập tức
-                    with peer_lock:
-                        peer_data = [p.to_dict() for p in peer_list]
-                    conn.send(json.dumps(peer_data).encode() + b'\n')
+            delay = admission_delay(data, client)
+            response = retry_after_reply(delay) if delay else handle_request(data, sender_ip)
+            if response:
+                if subscriber is not None:
+                    subscriber.send(encode_reply(response, framed))
                 else:
-                    conn.send(b"OK\n")
-                
-            elif cmd == "get_list":
-                # Đảm bảo thread-safe khi truy cập peer_list
-                with peer_lock:
-                    # Send peer list as JSON
-                    peer_data = [p.to_dict() for p in peer_list]
-                conn.send(json.dumps(peer_data).encode() + b'\n')
-                logging.info(f"[Tracker] Sent list of {len(peer_data)} peers")
-                
-            elif cmd == "ping":
-                # Phản hồi lại ping từ client
-                conn.send(b"pong\n")
-
-            elif cmd == "check_status":
-                # Cho phép client kiểm tra trạng thái của một peer cụ thể
-                if len(parts) < 2:
-                    conn.send(b"ERROR: Missing peer username\n")
-                    continue
-                
-                target_username = parts[1]
-                found = False
-                
-                # Đảm bảo thread-safe khi truy cập peer_list
-                with peer_lock:
-                    for peer in peer_list:
-                        if peer.username == target_username:
-                            # Kiểm tra trạng thái thực tế của peer
-                            is_online = check_peer_status(peer)
-                            if is_online:
-                                conn.send(f"STATUS: {peer.username} is online\n".encode())
-                            else:
-                                conn.send(f"STATUS: {peer.username} is offline\n".encode())
-                            found = True
-                            break
-                
-                if not found:
-                    conn.send(f"ERROR: Peer {target_username} not found\n".encode())
-            
-            elif cmd == "sync_channel":
-                # Receive channel data from a host for backup
-                try:
-                    # Read the initial data
-                    buffer = data.strip()
-                    
-                    # Find where the JSON starts
-                    json_start = buffer.find('{')
-                    if json_start == -1:
-                        conn.send(b"ERROR: Invalid JSON format\n")
-                        continue
-                    
-                    # Extract the command prefix and JSON part
-                    command_prefix = buffer[:json_start].strip()
-                    json_buffer = buffer[json_start:]
-                    
-                    # Check if JSON is complete by counting brackets
-                    open_braces = json_buffer.count('{')
-                    close_braces = json_buffer.count('}')
-                    
-                    # If JSON is incomplete, keep reading until it's complete
-                    while open_braces > close_braces:
-                        logging.info(f"[Tracker] JSON incomplete, reading more data ({open_braces} vs {close_braces})")
-                        
-                        # Set a timeout for the socket to avoid hanging
-                        conn.settimeout(5.0)
-                        try:
-                            more_data = conn.recv(4096).decode()
-                            if not more_data:
-                                break
-                            
-                            json_buffer += more_data
-                            open_braces = json_buffer.count('{')
-                            close_braces = json_buffer.count('}')
-                        except socket.timeout:
-                            logging.warning("[Tracker] Timeout while reading JSON data")
-                            break
-                    
-                    # Reset timeout
-                    conn.settimeout(None)
-                    
-                    # Now try to parse the complete JSON
-                    logging.info(f"[Tracker] Received complete JSON data ({len(json_buffer)} bytes)")
-                    channel_data = json.loads(json_buffer)
-                    channel_name = channel_data["name"]
-                    
-                    logging.info(f"[Tracker] Received sync request for channel {channel_name}")
-                    
-                    # Kiểm tra xem sender có phải là host không
-                    sender_is_host = False
-                    sender_ip = conn.getpeername()[0]
-                    sender_port = None
-                    sender_username = None
-                    
-                    with peer_lock:
-                        for peer in peer_list:
-                            if peer.ip == sender_ip:
-                                sender_username = peer.username
-                                sender_port = peer.port
-                                break
-                    
-                    logging.info(f"[Tracker] Sync request from {sender_username if sender_username else 'unknown'} ({sender_ip})")
-                    
-                    # Sử dụng channel_lock để đảm bảo thread-safe khi truy cập và sửa đổi channels
-                    with channel_lock:
-                        # Check if sender is the host
-                        if channel_name in channels:
-                            if sender_username and sender_username == channels[channel_name].host:
-                                sender_is_host = True
-                                logging.info(f"[Tracker] Sender is the host of channel {channel_name}")
-                        
-                        if channel_name not in channels:
-                            logging.info(f"[Tracker] Creating new channel {channel_name} from sync")
-                            channels[channel_name] = Channel(channel_name, channel_data["host"])
-                        
-                        # Nếu người gửi không phải là host, chỉ thêm tin nhắn mới
-                        # Giữ nguyên thông tin host và members
-                        if not sender_is_host:
-                            logging.info(f"[Tracker] Non-host sync from {sender_username}, preserving host and member data")
-                            
-                            # Cho phép client không phải host đồng bộ tin nhắn bất kể host có online hay không
-                            host_is_online = False
-                            host_username = channels[channel_name].host
-                            
-                            if host_username:
-                                with peer_lock:
-                                    for peer in peer_list:
-                                        if peer.username == host_username and (peer.status == "online" or peer.status == "invisible"):
-                                            host_is_online = True
-                                            break
-                            
-                            if host_is_online:
-                                logging.info(f"[Tracker] Host {host_username} is online, but accepting non-host message sync")
-                            
-                            # Chỉ thêm tin nhắn mới từ client không phải host
-                            if "messages" in channel_data and channel_data["messages"]:
-                                # Lấy các timestamp hiện có
-                                existing_timestamps = set()
-                                for msg in channels[channel_name].messages:
-                                    existing_timestamps.add(msg.timestamp)
-                                
-                                # Thêm các tin nhắn chưa có
-                                new_messages = 0
-                                for msg in channel_data["messages"]:
-                                    if msg.get("timestamp") not in existing_timestamps:
-                                        channels[channel_name].add_message(msg)
-                                        new_messages += 1
-                                
-                                logging.info(f"[Tracker] Added {new_messages} new messages from non-host client {sender_username}")
-                        else:
-                            # Update channel data
-                            channels[channel_name].host = channel_data["host"]
-                            
-                            # Ensure host is a member
-                            if channel_data["host"] and channel_data["host"] != "visitor":
-                                channels[channel_name].members.add(channel_data["host"])
-                            
-                            # Add other members
-                            if "members" in channel_data:
-                                for member in channel_data["members"]:
-                                    if member and member != "visitor":
-                                        channels[channel_name].members.add(member)
-                            
-                            # Add new messages
-                            if "messages" in channel_data and channel_data["messages"]:
-                                # Check if message is already in channel by timestamp
-                                timestamps = [m.timestamp for m in channels[channel_name].messages]
-                                new_messages = 0
-                                for msg in channel_data["messages"]:
-                                    if msg.get("timestamp") not in timestamps:
-                                        channels[channel_name].add_message(msg)
-                                        new_messages += 1
-                                
-                                logging.info(f"[Tracker] Added {new_messages} messages from host {sender_username}")
-                        
-                        # Save to disk
-                        channels[channel_name].save_to_disk()
-                        conn.send(b"OK\n")
-                        logging.info(f"[Tracker] Synced channel {channel_name} with {len(channels[channel_name].messages)} messages")
-                except json.JSONDecodeError as e:
-                    logging.error(f"[Tracker] JSON decode error: {e}")
-                    logging.error(f"[Tracker] Received data: {' '.join(parts[1:])}")
-                    conn.send(b"ERROR: Invalid JSON\n")
-                except Exception as e:
-                    logging.error(f"[Tracker] Error during sync: {str(e)}")
-                    conn.send(f"ERROR: {str(e)}\n".encode())
-                    
-            elif cmd == "get_channel":
-                # Send channel data to a peer
-                try:
-                    channel_name = parts[1]
-                    # Sử dụng channel_lock để đảm bảo thread-safe khi đọc dữ liệu channels
-                    with channel_lock:
-                        if channel_name in channels:
-                            channel_data = channels[channel_name].to_dict()
-                            conn.send(json.dumps(channel_data).encode() + b'\n')
-                            logging.info(f"[Tracker] Sent channel {channel_name} data with {len(channel_data['messages'])} messages")
-                        else:
-                            conn.send(b"ERROR: Channel not found\n")
-                            logging.warning(f"[Tracker] Channel {channel_name} not found on request")
-                except Exception as e:
-                    logging.error(f"[Tracker] Error sending channel data: {str(e)}")
-                    conn.send(f"ERROR: {str(e)}\n".encode())
-                    
-            elif cmd == "list_channels":
-                # Send list of available channels
-                channel_list = []
-                # Sử dụng channel_lock để đảm bảo thread-safe khi đọc dữ liệu channels
-                with channel_lock:
-                    for name, channel in channels.items():
-                        channel_list.append({
-                            "name": name,
-                            "host": channel.host,
-                            "members": len(channel.members),
-                            "messages": len(channel.messages)
-                        })
-                conn.send(json.dumps(channel_list).encode() + b'\n')
-                logging.info(f"[Tracker] Sent list of {len(channel_list)} channels")
-                
-            elif cmd == "debug":
-                # Debug command to list all channels
-                debug_info = []
-                # Sử dụng channel_lock để đảm bảo thread-safe khi đọc dữ liệu channels
-                with channel_lock:
-                    for name, channel in channels.items():
-                        debug_info.append({
-                            "name": name,
-                            "host": channel.host,
-                            "members": list(channel.members),
-                            "message_count": len(channel.messages)
-                        })
-                conn.send(json.dumps(debug_info).encode() + b'\n')
-                logging.info(f"[Tracker] Sent debug info for {len(debug_info)} channels")
-                
+                    conn.sendall(encode_reply(response, framed))
     except Exception as e:
         # Chỉ in lỗi nếu không phải lỗi đóng kết nối thông thường
         if isinstance(e, ConnectionResetError) or isinstance(e, ConnectionAbortedError) or (
@@ -582,32 +2911,269 @@ def handle_client(conn):
         else:
             logging.error(f"[Tracker] Client handling error: {e}")
     finally:
+        if subscriber is not None:
+            subscription_hub.unsubscribe(subscriber)
+            subscriber.queue.put(None)
         conn.close()
 
-def main():
-    # Load channels from disk
-    load_channels()
-    
-    # Bắt đầu thread kiểm tra trạng thái
-    status_thread = threading.Thread(target=update_peer_status, daemon=True)
-    status_thread.start()
-    logging.info("[Tracker] Started peer status monitoring thread")
-    
+async def handle_client_async(reader, writer, executor):
+    """Xử lý một kết nối client trên event loop (chế độ asyncio)"""
+    global active_connections, queued_requests
+    sender_ip = writer.get_extra_info("peername")[0]
+    loop = asyncio.get_running_loop()
+
+    if active_connections >= MAX_CONNECTIONS:
+        logging.warning(f"[Tracker] Connection limit ({MAX_CONNECTIONS}) reached, rejecting {sender_ip}")
+        writer.close()
+        return
+    active_connections += 1
+    subscriber = None
+    client = ClientIdentity(sender_ip)
+    pipeline = asyncio.Semaphore(PIPELINE_DEPTH)
+    in_flight = set()
+    # Slot của request_slots đang giữ cho message đang đọc; được chuyển cho lệnh cho tới khi trả lời xong
+    slot = [False]
+
+    async def take_slot():
+        await request_slots.acquire()
+        slot[0] = True
+
+    def release_slot():
+        if slot[0]:
+            slot[0] = False
+            request_slots.release()
+
+    async def run_request(data, framed):
+        global queued_requests
+        delay = admission_delay(data, client)
+        if delay:
+            # Trả lời ngay trên event loop, lệnh bị từ chối không chờ trong hàng đợi của pool
+            writer.write(encode_reply(retry_after_reply(delay), framed))
+            await writer.drain()
+            return
+        # Các lệnh có thể chạm tới disk hoặc kết nối peer nên chạy trong pool giới hạn; hàng đợi
+        # của pool không vượt quá MAX_IN_FLIGHT lệnh vì mỗi lệnh giữ một slot của request_slots
+        queued_requests += 1
+        try:
+            response = await loop.run_in_executor(executor, handle_request, data, sender_ip)
+        finally:
+            queued_requests -= 1
+        if response and not writer.is_closing():
+            writer.write(encode_reply(response, framed))
+            await writer.drain()
+
+    async def run_pipelined(data, framed):
+        try:
+            await run_request(data, framed)
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            pass
+        except Exception as e:
+            logging.error(f"[Tracker] Error handling pipelined request: {e}")
+        finally:
+            request_slots.release()
+            pipeline.release()
+
+    try:
+        while True:
+            try:
+                # Kết nối subscribe được phép im lặng lâu dài (client chỉ nhận sự kiện)
+                payload, framed = await asyncio.wait_for(read_message_async(reader, MAX_REQUEST_SIZE, take_slot),
+                                                         None if subscriber is not None else IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.info(f"[Tracker] Closing idle connection from {sender_ip}")
+                break
+            except ProtocolError as e:
+                # Lệnh vượt quá MAX_REQUEST_SIZE hoặc frame không hợp lệ: trả lời theo kiểu đóng gói của client
+                logging.warning(f"[Tracker] Rejecting request from {sender_ip}: {e}")
+                writer.write(encode_reply(b"ERROR: Request too large or malformed", e.framed))
+                await writer.drain()
+                break
+            if payload is None:
+                break
+
+            data = payload.decode(errors="replace")
+            if data.startswith("subscribe "):
+                release_slot()
+                try:
+                    username, wildcard, cursors = parse_subscribe(data)
+                except ValueError as e:
+                    writer.write(encode_reply(f"ERROR: {e}", framed))
+                    continue
+                if subscriber is None:
+                    subscriber = AsyncSubscriber(username, loop, writer)
+                    sock = writer.get_extra_info("socket")
+                    if sock is not None:
+                        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                subscription_hub.subscribe(subscriber, cursors, wildcard)
+                writer.write(encode_reply(f"OK {len(cursors)}", framed))
+                frames = await loop.run_in_executor(executor, subscription_catch_up, cursors, sender_ip)
+                for frame in frames:
+                    writer.write(frame)
+                await writer.drain()
+                continue
+
+            if framed is not True and framed is not False:
+                # Lệnh có request id: chạy song song với các lệnh khác của kết nối, phản hồi được
+                # gửi ngay khi xong (có thể khác thứ tự gửi). Tối đa PIPELINE_DEPTH lệnh cùng lúc.
+                await pipeline.acquire()
+                slot[0] = False  # run_pipelined trả slot khi xong
+                task = asyncio.ensure_future(run_pipelined(data, framed))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                continue
+
+            try:
+                await run_request(data, framed)
+            finally:
+                release_slot()
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+        logging.info("[Tracker] Client disconnected.")
+    except Exception as e:
+        logging.error(f"[Tracker] Client handling error: {e}")
+    finally:
+        release_slot()
+        if in_flight:
+            # Client có thể đóng chiều gửi ngay sau lệnh cuối; vẫn trả lời các lệnh đang chạy
+            await asyncio.wait(in_flight)
+        if subscriber is not None:
+            subscription_hub.unsubscribe(subscriber)
+        active_connections -= 1
+        writer.close()
+
+async def serve_async(port, host="0.0.0.0"):
+    global request_slots
+    executor = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="tracker-worker")
+    request_slots = asyncio.Semaphore(MAX_IN_FLIGHT)
+    server = await asyncio.start_server(
+        lambda r, w: handle_client_async(r, w, executor),
+        host, port,
+        limit=READ_BUFFER_LIMIT,
+        backlog=LISTEN_BACKLOG
+    )
+    logging.info(f"Tracker (asyncio) is running on port {port}...")
+    print(f"Tracker (asyncio) is running on port {port}...")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=False)
+
+def serve_threaded(port):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Avoid bind errors
-    server.bind(("0.0.0.0", 12345))  # Lắng nghe trên mọi IP, cho phép các máy khác truy cập
+    server.bind(("0.0.0.0", port))  # Lắng nghe trên mọi IP, cho phép các máy khác truy cập
     # Lưu ý: Các client phải kết nối bằng IP LAN thực tế của máy chủ tracker (ví dụ "192.168.x.x"), không dùng "127.0.0.1" hoặc "localhost".
     server.listen()
-    logging.info("Tracker is running on port 12345...")
-    print("Tracker is running on port 12345...")
+    logging.info(f"Tracker is running on port {port}...")
+    print(f"Tracker is running on port {port}...")
 
     try:
         while True:
             conn, addr = server.accept()
             threading.Thread(target=handle_client, args=(conn,), daemon=True).start()
+    finally:
+        server.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Netapp tracker server")
+    parser.add_argument("--port", type=int, default=TRACKER_PORT, help="Port lắng nghe (mặc định 12345)")
+    parser.add_argument("--threaded", action="store_true",
+                        help="Dùng server cũ: mỗi kết nối một thread thay vì event loop asyncio")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="Số kết nối đồng thời tối đa trong chế độ asyncio")
+    parser.add_argument("--workers", type=int, default=REQUEST_WORKERS,
+                        help="Số thread xử lý lệnh trong chế độ asyncio")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT,
+                        help="Số lệnh đang xử lý tối đa trên mọi kết nối trong chế độ asyncio; vượt quá thì ngừng đọc")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Mở endpoint Prometheus http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--snapshot-interval", type=int, default=SNAPSHOT_INTERVAL,
+                        help="Số giây giữa hai lần ghi snapshot gộp của các kênh (0: chỉ ghi khi tắt)")
+    parser.add_argument("--channel-cache-mb", type=int, default=CHANNEL_CACHE_MB,
+                        help="Ngân sách bộ nhớ (MB) cho tin nhắn của các kênh; kênh ít dùng bị evict khi vượt")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="Chia kênh cho N process shard (mặc định 0: một process giữ mọi kênh)")
+    parser.add_argument("--shard-base-port", type=int, default=None,
+                        help="Port nội bộ đầu tiên của các shard (mặc định port + 1)")
+    parser.add_argument("--retention-messages", type=int, default=RETENTION_MESSAGES,
+                        help="Số tin nhắn tối đa trong tầng nóng của mỗi kênh, tin cũ hơn chuyển sang archive (0: không giới hạn)")
+    parser.add_argument("--retention-days", type=int, default=RETENTION_DAYS,
+                        help="Tuổi tối đa (ngày) của tin nhắn trong tầng nóng (0: không giới hạn)")
+    parser.add_argument("--rate-limit", type=float, default=1.0,
+                        help="Hệ số nhân cho giới hạn tần suất lệnh của mỗi client (0: tắt giới hạn)")
+    parser.add_argument("--no-search-index", action="store_true",
+                        help="Không dựng chỉ mục tìm kiếm (tiết kiệm bộ nhớ; lệnh search bị tắt)")
+    parser.add_argument("--standby-of", default=None, metavar="HOST:PORT",
+                        help="Chạy làm standby, đọc theo journal của tracker primary tại HOST:PORT")
+    parser.add_argument("--promote-after", type=int, default=PROMOTE_AFTER,
+                        help="Standby tự promote khi mất liên lạc với primary quá số giây này (0: chỉ dùng lệnh promote)")
+    args = parser.parse_args()
+    if args.standby_of and args.shards > 0:
+        parser.error("--standby-of cannot be combined with --shards")
+    return args
+
+def main():
+    global MAX_CONNECTIONS, REQUEST_WORKERS, MAX_IN_FLIGHT, PROMOTE_AFTER, RETENTION_MESSAGES, RETENTION_DAYS, SEARCH_INDEX, shard_router, standby_of, rate_limiter
+    args = parse_args()
+    MAX_CONNECTIONS = args.max_connections
+    REQUEST_WORKERS = args.workers
+    MAX_IN_FLIGHT = args.max_in_flight
+    PROMOTE_AFTER = args.promote_after
+    RETENTION_MESSAGES = args.retention_messages
+    RETENTION_DAYS = args.retention_days
+    SEARCH_INDEX = not args.no_search_index
+    if args.rate_limit > 0:
+        rate_limiter = RateLimiter({group: (rate * args.rate_limit, burst * args.rate_limit)
+                                    for group, (rate, burst) in RATE_LIMITS.items()})
+    else:
+        rate_limiter = None
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    if args.shards > 0:
+        # Router: kênh nằm trong các process shard, process này chỉ giữ registry peer
+        base_port = args.shard_base_port or args.port + 1
+        # Mỗi shard có ngân sách riêng bằng một phần tổng ngân sách
+        shard_processes = start_shards(args.shards, base_port, args.snapshot_interval,
+                                       max(1, args.channel_cache_mb // args.shards))
+        shard_router = ShardRouter(range(base_port, base_port + args.shards))
+        shard_router.start_event_relay()
+    else:
+        # Load channels from disk
+        channels.budget = args.channel_cache_mb * 1024 * 1024
+        load_channels()
+        start_snapshot_thread(args.snapshot_interval)
+        start_retention_thread()
+        start_search_index_thread()
+        if args.standby_of:
+            host, _, port = args.standby_of.rpartition(":")
+            standby_of = (host or "127.0.0.1", int(port))
+            StandbyReplicator(standby_of).start()
+            logging.info(f"[Tracker] Running as standby of {standby_of[0]}:{standby_of[1]}")
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    
+    # Bắt đầu thread kiểm tra trạng thái
+    status_thread = threading.Thread(target=liveness.run, daemon=True)
+    status_thread.start()
+    logging.info("[Tracker] Started peer liveness monitoring thread")
+
+    try:
+        if args.threaded:
+            serve_threaded(args.port)
+        else:
+            asyncio.run(serve_async(args.port))
     except KeyboardInterrupt:
         logging.info("[Tracker] Shutting down gracefully...")
-        server.close()
+    finally:
+        if shard_router is not None:
+            # Mỗi shard tự ghi snapshot khi nhận SIGTERM
+            for process in shard_processes:
+                process.terminate()
+            for process in shard_processes:
+                process.join(30)
+        else:
+            shutdown_channels()
 
 if __name__ == "__main__":
     main()